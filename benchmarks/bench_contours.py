@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# Copyright (c) 2018 Ivor Wanders
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    Microbenchmark of the contour extraction of the SAM backend; synthetic masks with a number of disconnected blobs
+    are converted to contours with the previous implementation, which filled every contour to determine its area,
+    and with Segmenter.create_contours.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "segment_backend_py"))
+import backend
+
+
+def legacy_area_of_contour(cnt):
+    max_x = cnt[:, 0].max()
+    min_x = cnt[:, 0].min()
+    max_y = cnt[:, 1].max()
+    min_y = cnt[:, 1].min()
+    img_shape = (max_y - min_y, max_x - min_x)
+    if img_shape[0] == 0 or img_shape[1] == 0:
+        return 0.0
+    blank_image = np.zeros(img_shape, np.uint8)
+    cv2.fillPoly(blank_image, pts=[cnt], color=255, offset=(-min_x, -min_y))
+    return np.count_nonzero(blank_image)
+
+
+def legacy_create_contours(mask, area_ratio_minimum=0.0):
+    """The previous create_contours, without printing the hierarchy."""
+    polygons_to_return = []
+    bw_img = mask.astype(np.uint8).squeeze()
+    total_area = bw_img.shape[0] * bw_img.shape[1]
+    h = bw_img.shape[0]
+    contours, hierarchy = cv2.findContours(bw_img, cv2.RETR_TREE, cv2.CHAIN_APPROX_TC89_L1)
+    for i, contour in enumerate(contours):
+        contour = contour[:, 0, :]
+        if hierarchy[0, i, 3] != -1:
+            continue
+        area = legacy_area_of_contour(contour)
+        if area < (total_area * area_ratio_minimum):
+            continue
+        contour = [(int(x[0]), h - int(x[1])) for x in contour]
+        contour.append(contour[0])
+        polygons_to_return.append((area, contour))
+    polygons_to_return.sort(reverse=True)
+    return polygons_to_return
+
+
+def synthetic_mask(width, height, blobs, seed=0):
+    """A mask with a number of randomly placed ellipses of varying size."""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for _ in range(blobs):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(2, width // 20)), int(rng.integers(2, height // 20)))
+        cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360, 1, -1)
+    return mask[None, :, :].astype(bool)
+
+
+def time_function(f, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the contour extraction on synthetic masks.")
+    parser.add_argument('--width', type=int, help="Width of the masks, defaults to %(default)s.", default=1920)
+    parser.add_argument('--height', type=int, help="Height of the masks, defaults to %(default)s.", default=1080)
+    parser.add_argument('--blobs', type=int, nargs="+", help="Blob counts to test, defaults to %(default)s.",
+                        default=[1, 10, 100, 1000])
+    parser.add_argument('--ratio', type=float, help="The minimum area ratio, defaults to %(default)s.", default=0.0001)
+    parser.add_argument('--max-vertices', type=int, help="Vertex budget for the simplified run, defaults to %(default)s.", default=32)
+    parser.add_argument('--repeat', type=int, help="Runs per mask, defaults to %(default)s.", default=5)
+    args = parser.parse_args()
+
+    for blobs in args.blobs:
+        mask = synthetic_mask(args.width, args.height, blobs)
+        legacy, legacy_polygons = time_function(lambda: legacy_create_contours(mask, args.ratio), args.repeat)
+        current, polygons = time_function(lambda: backend.Segmenter.create_contours(mask, args.ratio), args.repeat)
+        simplified, simplified_polygons = time_function(
+            lambda: backend.Segmenter.create_contours(mask, args.ratio, max_vertices=args.max_vertices), args.repeat)
+        print("blobs: {: >5d}  polygons: {: >5d}  legacy: {:8.2f}ms  current: {:8.2f}ms  simplified: {:8.2f}ms ({} points)".format(
+              blobs, len(polygons), legacy * 1000.0, current * 1000.0, simplified * 1000.0,
+              sum(len(p) for _, p in simplified_polygons)))
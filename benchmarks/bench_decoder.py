@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# Copyright (c) 2018 Ivor Wanders
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    Per click latency benchmark of the SAM backend on the cpu; the image embedding is calculated once, then the time
+    of predict is measured for a number of clicks with one to a few points, for each of the decoder implementations.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from PIL import Image
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "segment_backend_py"))
+import backend
+
+
+def synthetic_image(width, height, seed=0):
+    """Returns png bytes of an image with a few rectangles, such that the masks aren't empty."""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 40, dtype=np.uint8)
+    for _ in range(8):
+        x, y = rng.integers(0, width // 2), rng.integers(0, height // 2)
+        img[y:y + height // 4, x:x + width // 4] = rng.integers(0, 255, size=3)
+    buffer = BytesIO()
+    Image.fromarray(img).save(buffer, format="png")
+    return buffer.getvalue()
+
+
+def time_clicks(segmenter, width, height, clicks, max_points):
+    """Returns the per click durations in seconds, after a few warmup clicks."""
+    rng = np.random.default_rng(1)
+    durations = []
+    for i in range(clicks + 3):
+        count = int(rng.integers(1, max_points + 1))
+        points = [((float(rng.uniform(0, width)), float(rng.uniform(0, height))), int(rng.integers(0, 2)))
+                  for _ in range(count)]
+        start = time.perf_counter()
+        segmenter.predict(points)
+        if i >= 3:
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the per click decoder latency on the cpu.")
+    parser.add_argument('--pth', help="The pth file to load, by default read from SAM_PTH, which currently is: %(default)s", default=os.environ.get("SAM_PTH"))
+    parser.add_argument('--image', help="Image to use, a synthetic image is used if not given.", default=None)
+    parser.add_argument('--decoders', nargs="+", choices=backend.Segmenter.DECODERS, help="Decoders to test, defaults to %(default)s.",
+                        default=list(backend.Segmenter.DECODERS))
+    parser.add_argument('--threads', type=int, nargs="+", help="Thread counts to test, defaults to %(default)s.", default=[1, 4])
+    parser.add_argument('--clicks', type=int, help="Clicks per configuration, defaults to %(default)s.", default=50)
+    parser.add_argument('--points', type=int, help="Maximum number of points per click, defaults to %(default)s.", default=4)
+    args = parser.parse_args()
+
+    if args.image is None:
+        image_bytes = synthetic_image(1280, 720)
+    else:
+        image_bytes = backend.Segmenter.read_file_from_disk(args.image)
+    width, height = Image.open(BytesIO(image_bytes)).size
+
+    embedding = None
+    for decoder in args.decoders:
+        for threads in args.threads:
+            segmenter = backend.Segmenter(args.pth, device="cpu", threads=threads, decoder=decoder)
+            image_hash = segmenter.register_image(image_bytes)
+            if embedding is None:
+                # The encoder is the same for every configuration, so only run it once.
+                start = time.perf_counter()
+                segmenter.update_image_hash(image_hash)
+                print("encoder: {:8.1f}ms".format((time.perf_counter() - start) * 1000.0))
+                embedding = (segmenter.predictor.features, segmenter.predictor.original_size,
+                             segmenter.predictor.input_size)
+            else:
+                segmenter.restore_embedding(embedding)
+            durations = np.array(time_clicks(segmenter, width, height, args.clicks, args.points)) * 1000.0
+            print("decoder: {: >5s}  threads: {: >3d}  p50: {:7.2f}ms  p90: {:7.2f}ms  max: {:7.2f}ms".format(
+                  decoder, threads, np.percentile(durations, 50), np.percentile(durations, 90), durations.max()))
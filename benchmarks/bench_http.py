@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# Copyright (c) 2018 Ivor Wanders
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    End to end benchmark of the labelling server and the SAM backend; generates a synthetic dataset with a deep
+    folder tree, large images and big sidecars, times the loader, then serves both apps in process with CherryPy
+    and drives every scenario with a number of concurrent keep-alive clients. The model of the SAM backend is
+    replaced by a stub that returns synthetic masks, such that the rest of its pipeline runs on any machine.
+    Throughput and the p50 and p99 latency of every scenario are written as json, a previous result passed with
+    --compare is printed next to it.
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import math
+import base64
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+import collections
+import http.client
+
+import numpy as np
+import PIL.Image
+import cherrypy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import server
+
+
+def synthetic_png(width, height, seed=0):
+    """Returns the bytes of a png with blocks of random colour and some noise, compressing like a photo would."""
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 255, (max(1, height // 64), max(1, width // 64), 3), dtype=np.uint8)
+    image = np.array(PIL.Image.fromarray(blocks).resize((width, height), PIL.Image.BILINEAR))
+    image = np.clip(image.astype(np.int16) + rng.integers(-8, 8, image.shape), 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    PIL.Image.fromarray(image).save(buffer, format="png")
+    return buffer.getvalue()
+
+
+def synthetic_features(width, height, polygons, vertices, rng):
+    """Returns a feature collection with star shaped polygons spread over the image."""
+    features = []
+    for i in range(polygons):
+        cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+        radius = rng.uniform(10, min(width, height) / 8)
+        ring = []
+        for j in range(vertices):
+            angle = 2 * math.pi * j / vertices
+            r = radius * rng.uniform(0.5, 1.0)
+            ring.append([round(cx + r * math.cos(angle), 2), round(cy + r * math.sin(angle), 2)])
+        ring.append(ring[0])
+        features.append({"type": "Feature", "id": "f{}".format(i), "geometry": {"type": "Polygon",
+                         "coordinates": [ring]}, "properties": {"label": "class_{}".format(i % 4)}})
+    return {"type": "FeatureCollection", "features": features}
+
+
+def generate_dataset(root, depth, fanout, files_per_dir, width, height, polygons, vertices, labelled=0.5, seed=0):
+    """Creates a tree of depth levels with fanout subdirectories, leaves hold images and sidecars for a fraction."""
+    rng = random.Random(seed)
+    with open(os.path.join(root, "root.yaml"), "w") as f:
+        f.write("classes:\n" + "".join("  - label: class_{}\n    color: 4CAF50\n".format(i) for i in range(4)))
+    image = synthetic_png(width, height, seed)
+    directories = [root]
+    for level in range(depth):
+        directories = [os.path.join(d, "level{}_{:03d}".format(level, i)) for d in directories for i in range(fanout)]
+    count = 0
+    for d in directories:
+        os.makedirs(d)
+        for i in range(files_per_dir):
+            path = os.path.join(d, "frame_{:06d}.png".format(i))
+            with open(path, "wb") as f:
+                f.write(image)
+            if rng.random() < labelled:
+                with open(path[:-len(".png")] + ".json", "w") as f:
+                    json.dump(synthetic_features(width, height, polygons, vertices, rng), f)
+            count += 1
+    return count, image
+
+
+def make_stub_segmenter(backend, encoder_seconds, decoder_seconds):
+    """Returns a segmenter of the backend that doesn't load a model, the encoder and decoder only sleep."""
+    class StubSegmenter(backend.Segmenter):
+        def __init__(self):
+            self.current_file_hash = None
+            self.exported_decoder = None
+            self.images = collections.OrderedDict()
+            self.images_bytes = 0
+            self.image_store_bytes = 256 * 2**20
+            self.embeddings = backend.EmbeddingCache(0)
+            self.sessions = collections.OrderedDict()
+            self.max_sessions = 256
+            self.size = None
+
+        def update_image_hash(self, new_hash):
+            if self.current_file_hash == new_hash:
+                return
+            image = PIL.Image.open(io.BytesIO(self.images[new_hash])).convert("RGB")
+            self.size = (image.height, image.width)
+            time.sleep(encoder_seconds)
+            self.current_file_hash = new_hash
+
+        def predict_batch(self, prompts):
+            """A disc around every foreground point, without the background points in it."""
+            time.sleep(decoder_seconds)
+            height, width = self.size
+            radius = min(width, height) / 8
+            y, x = np.ogrid[:height, :width]
+            results = []
+            for points, _, _ in prompts:
+                mask = np.zeros((height, width), dtype=bool)
+                for (px, py), foreground in points:
+                    disc = (x - px) ** 2 + (y - py) ** 2 < radius ** 2
+                    mask = (mask | disc) if foreground else (mask & ~disc)
+                results.append((mask[None], np.ones(1), np.zeros((1, 256, 256), dtype=np.float32)))
+            return results
+
+    return StubSegmenter()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def run_load(port, make_request, clients, requests_per_client):
+    """
+        Runs clients threads that each send requests over one keep-alive connection, make_request(rng) returns the
+        (method, path, body) of a request. Returns the throughput and latencies in milliseconds.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client(index):
+        rng = random.Random(index)
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        own = []
+        for _ in range(requests_per_client):
+            method, path, body = make_request(rng)
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                ok = response.status in (200, 304)
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port)
+                ok = False
+            own.append(time.perf_counter() - start)
+            if not ok:
+                with lock:
+                    errors[0] += 1
+        connection.close()
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    latencies.sort()
+    return {"clients": clients, "requests": len(latencies), "errors": errors[0], "seconds": round(duration, 4),
+            "throughput": round(len(latencies) / duration, 2),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3)}
+
+
+def server_scenarios(data, count):
+    """Returns name -> make_request for the endpoints of the labelling server."""
+    def entry(rng):
+        return rng.randrange(count)
+
+    def save(rng):
+        features = synthetic_features(1000, 1000, 20, 32, rng)
+        return ("POST", "/server/entry_save_features", json.dumps({"entry": entry(rng), "features": features}))
+
+    def patch(rng):
+        feature = synthetic_features(1000, 1000, 1, 32, rng)["features"][0]
+        feature["id"] = "bench{}".format(rng.randrange(8))
+        return ("POST", "/server/entry_patch_features",
+                json.dumps({"entry": entry(rng), "ops": [{"op": "modify", "feature": feature}]}))
+
+    return collections.OrderedDict([
+        ("entry_info", lambda rng: ("GET", "/server/entry_info?entry={}".format(entry(rng)), None)),
+        ("entry_data", lambda rng: ("GET", "/server/entry_data?entry={}".format(entry(rng)), None)),
+        ("entry_features", lambda rng: ("GET", "/server/entry_features?entry={}".format(entry(rng)), None)),
+        ("entry_batch", lambda rng: ("GET", "/server/entry_batch?entry={}&count=4".format(entry(rng)), None)),
+        ("entry_save_features", save),
+        ("entry_patch_features", patch),
+    ])
+
+
+def sam_scenarios(image, width, height, image_hash):
+    """Returns name -> make_request for sam_trigger, on an image registered with sam_image beforehand."""
+    def trigger(mask_format, refine):
+        def make_request(rng):
+            points = [{"x": rng.uniform(0, width), "y": rng.uniform(0, height),
+                       "category": "Include" if i == 0 or rng.random() < 0.7 else "Exclude"}
+                      for i in range(1 if refine else rng.randint(1, 4))]
+            return ("POST", "/sam/sam_trigger", json.dumps({"points": points, "image_hash": image_hash,
+                                                            "threshold": 0.0, "mask_format": mask_format,
+                                                            "client": "bench{}".format(rng.random()),
+                                                            "max_vertices": 64}))
+        return make_request
+
+    def with_image(rng):
+        points = [{"x": rng.uniform(0, width), "y": rng.uniform(0, height), "category": "Include"}]
+        return ("POST", "/sam/sam_trigger", json.dumps({"points": points, "image": image, "threshold": 0.0,
+                                                        "mask_format": "rle"}))
+
+    return collections.OrderedDict([
+        ("sam_trigger_png", trigger("png", False)),
+        ("sam_trigger_rle", trigger("rle", False)),
+        ("sam_trigger_none", trigger("none", False)),
+        ("sam_trigger_image", with_image),
+    ])
+
+
+def compare(results, previous):
+    """Prints the change in throughput and p99 latency against a previous result."""
+    before = {r["scenario"]: r for r in previous["results"]}
+    for result in results:
+        old = before.get(result["scenario"])
+        if old is None:
+            continue
+        if "p99_ms" not in result:
+            print("{: <24s} throughput {:9.1f} -> {:9.1f} ({:+6.1f}%)".format(result["scenario"], old["throughput"],
+                  result["throughput"], 100.0 * (result["throughput"] / old["throughput"] - 1.0)))
+            continue
+        print("{: <24s} throughput {:9.1f} -> {:9.1f} ({:+6.1f}%)  p99 {:8.2f} -> {:8.2f} ms ({:+6.1f}%)".format(
+              result["scenario"], old["throughput"], result["throughput"],
+              100.0 * (result["throughput"] / old["throughput"] - 1.0), old["p99_ms"], result["p99_ms"],
+              100.0 * (result["p99_ms"] / old["p99_ms"] - 1.0)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the labelling server and the SAM backend in process.")
+    parser.add_argument('--depth', type=int, help="Depth of the folder tree, defaults to %(default)s.", default=3)
+    parser.add_argument('--fanout', type=int, help="Subdirectories per directory, defaults to %(default)s.", default=4)
+    parser.add_argument('--files', type=int, help="Images per leaf directory, defaults to %(default)s.", default=8)
+    parser.add_argument('--width', type=int, help="Width of the images, defaults to %(default)s.", default=2048)
+    parser.add_argument('--height', type=int, help="Height of the images, defaults to %(default)s.", default=1536)
+    parser.add_argument('--polygons', type=int, help="Polygons per sidecar, defaults to %(default)s.", default=200)
+    parser.add_argument('--vertices', type=int, help="Vertices per polygon, defaults to %(default)s.", default=64)
+    parser.add_argument('--clients', type=int, nargs="+", help="Concurrent client counts to test, defaults to %(default)s.", default=[1, 8])
+    parser.add_argument('--requests', type=int, help="Requests per client, defaults to %(default)s.", default=50)
+    parser.add_argument('--threads', type=int, help="CherryPy worker threads, defaults to %(default)s.", default=16)
+    parser.add_argument('--port', type=int, help="Port to serve on, defaults to %(default)s.", default=18090)
+    parser.add_argument('--scenarios', nargs="+", help="Only run the scenarios starting with these names.", default=None)
+    parser.add_argument('--no-sam', help="Skip the SAM backend, which needs its dependencies installed.", action="store_true", default=False)
+    parser.add_argument('--encoder-ms', type=float, help="Time the stub encoder takes per image, defaults to %(default)s.", default=0.0)
+    parser.add_argument('--decoder-ms', type=float, help="Time the stub decoder takes per batch, defaults to %(default)s.", default=0.0)
+    parser.add_argument('--output', help="File to write the json results to, printed if not given.", default=None)
+    parser.add_argument('--compare', help="Previous json results to compare against.", default=None)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        count, image = generate_dataset(root, args.depth, args.fanout, args.files, args.width, args.height,
+                                        args.polygons, args.vertices)
+        print("Generated {} entries in {:.1f}s".format(count, time.perf_counter() - start), file=sys.stderr)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            data = server.Data(root, root, persistent_index=False, save_delay=0.5)
+        duration = time.perf_counter() - start
+        results.append({"scenario": "loader", "entries": len(data.entries), "seconds": round(duration, 4),
+                        "throughput": round(len(data.entries) / duration, 2)})
+        # The label statistics are built in the background, which would slow down the first scenario.
+        while data.labels.stats()["building"]:
+            time.sleep(0.1)
+
+        cherrypy.config.update({"server.socket_port": args.port, "server.socket_host": "127.0.0.1",
+                                "server.thread_pool": args.threads, "log.screen": False,
+                                "engine.autoreload.on": False, "checker.on": False})
+        cherrypy.tree.mount(server.Web(data), "/server")
+        scenarios = server_scenarios(data, len(data.entries))
+
+        scheduler = None
+        if not args.no_sam:
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "segment_backend_py"))
+            import backend
+            segmenter = make_stub_segmenter(backend, args.encoder_ms / 1000.0, args.decoder_ms / 1000.0)
+            scheduler = backend.Scheduler(segmenter)
+            cherrypy.tree.mount(backend.Web(segmenter, scheduler), "/sam")
+            image_hash = segmenter.register_image(image)
+            scenarios.update(sam_scenarios(base64.b64encode(image).decode("ascii"), args.width, args.height,
+                                           image_hash))
+
+        cherrypy.engine.start()
+        cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+        try:
+            for name, make_request in scenarios.items():
+                if args.scenarios and not any(name.startswith(s) for s in args.scenarios):
+                    continue
+                for clients in args.clients:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        result = run_load(args.port, make_request, clients, args.requests)
+                    result["scenario"] = "{}_c{}".format(name, clients)
+                    results.append(result)
+                    print("{: <28s} {:9.1f} req/s  p50 {:8.2f} ms  p99 {:8.2f} ms  errors {}".format(
+                          result["scenario"], result["throughput"], result["p50_ms"], result["p99_ms"],
+                          result["errors"]), file=sys.stderr)
+        finally:
+            cherrypy.engine.exit()
+            if scheduler is not None:
+                scheduler.stop()
+            data.writer.flush()
+
+    report = {"config": vars(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# Copyright (c) 2018 Ivor Wanders
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    Startup benchmark for the data loader; generates a synthetic campaign/session/camera tree and times how long
+    Data.data_loader takes to index it with a varying number of threads, and how long a restart from the stored index
+    takes when nothing changed.
+"""
+
+import os
+import sys
+import io
+import time
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import server
+
+
+def generate_tree(root, depth, fanout, files_per_dir):
+    """Create a tree of `depth` levels with `fanout` subdirectories each, leaves hold empty png files."""
+    with open(os.path.join(root, "root.yaml"), "w") as f:
+        f.write("classes:\n  - label: anything\n    color: 4CAF50\n")
+    directories = [root]
+    for level in range(depth):
+        next_directories = []
+        for d in directories:
+            for i in range(fanout):
+                sub = os.path.join(d, "level{}_{:03d}".format(level, i))
+                os.mkdir(sub)
+                next_directories.append(sub)
+        directories = next_directories
+    for d in directories:
+        with open(os.path.join(d, "spec.yaml"), "w") as f:
+            f.write("classes:\n  - label: {}\n    color: FFAE20\n".format(os.path.basename(d)))
+        for i in range(files_per_dir):
+            open(os.path.join(d, "frame_{:06d}.png".format(i)), "wb").close()
+    return len(directories) * files_per_dir
+
+
+def time_loader(root, threads, repeat):
+    """Returns the best time out of `repeat` runs and the number of entries found."""
+    best = None
+    entries = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            entries, _ = server.Data.data_loader(root, root, {"classes":[]}, threads)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, len(entries)
+
+
+def time_index_restart(root, threads, repeat):
+    """Returns the best time to start from a stored index on an unchanged tree, and the number of entries found."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        index = server.DataIndex(root, root, threads)
+        index.load()
+        index.refresh()
+        index.save()
+    best = None
+    entries = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            index = server.DataIndex(root, root, threads)
+            index.load()
+            index.refresh()
+            entries = index.entries({"classes":[]}, server.ConfigStore())
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, len(entries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the data loader on a synthetic tree.")
+    parser.add_argument('--depth', type=int, help="Depth of the tree, defaults to %(default)s.", default=3)
+    parser.add_argument('--fanout', type=int, help="Subdirectories per directory, defaults to %(default)s.", default=8)
+    parser.add_argument('--files', type=int, help="Files per leaf directory, defaults to %(default)s.", default=100)
+    parser.add_argument('--threads', type=int, nargs="+", help="Thread counts to test, defaults to %(default)s.",
+                        default=[1, 4, 8, 16])
+    parser.add_argument('--repeat', type=int, help="Runs per thread count, defaults to %(default)s.", default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        expected = generate_tree(root, args.depth, args.fanout, args.files)
+        print("Generated {} files in {}".format(expected, root))
+        for threads in args.threads:
+            duration, count = time_loader(root, threads, args.repeat)
+            if count != expected:
+                print("Expected {} entries, found {}".format(expected, count))
+            print("threads: {: >3d}  entries: {: >8d}  time: {:8.3f}s  {:10.0f} entries/s".format(
+                  threads, count, duration, count / duration))
+        for threads in args.threads:
+            duration, count = time_index_restart(root, threads, args.repeat)
+            print("threads: {: >3d}  entries: {: >8d}  time: {:8.3f}s  {:10.0f} entries/s  (stored index)".format(
+                  threads, count, duration, count / duration))
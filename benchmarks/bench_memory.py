@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# Copyright (c) 2018 Ivor Wanders
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    Memory benchmark for the entry representation; builds the entries for a synthetic index held in memory and
+    compares the previous representation (a dict backed Image with a deep copied config per directory) against the
+    slotted Image that refers to a deduplicated config by id. Also times creating the entry_info response for both.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import server
+
+
+class LegacyImage:
+    """The previous representation; every image holds its paths and a reference to the config of its directory."""
+    def __init__(self, path, sidecar_path, config):
+        self.config = config
+        self.path = path
+        self.data_path = sidecar_path[0:sidecar_path.rindex(".")] + ".json"
+
+    def get_info(self):
+        return {"path":self.path, "config":self.config}
+
+
+def synthetic_index(root, directories, files_per_dir, classes):
+    """Creates an index with a root yaml and a yaml in every directory, without touching the disk."""
+    index = server.DataIndex(root, root, persistent=False)
+    def record(files, subdirs, yamls):
+        return {"mtime": 0.0, "sidecar_mtime": 0.0, "files": files, "mtimes": [0.0] * len(files),
+                "labelled": [0] * len(files), "subdirs": subdirs, "yaml_mtimes": {}, "yamls": yamls, "lists": {}}
+    root_classes = [{"label": "class_{}".format(i), "description": "Description of class {}".format(i),
+                     "color": "4CAF50"} for i in range(classes)]
+    subdirs = ["session_{:05d}".format(i) for i in range(directories)]
+    index.records["."] = record([], subdirs, [{"classes": root_classes}])
+    for i, d in enumerate(subdirs):
+        files = ["frame_{:06d}.png".format(j) for j in range(files_per_dir)]
+        # A handful of distinct configurations, like a few campaigns with their own specification.
+        yamls = [{"classes": [{"label": "campaign_{}".format(i % 4), "color": "FFAE20"}]}]
+        index.records[d] = record(files, [], yamls)
+    return index
+
+
+def legacy_entries(index, context):
+    """Builds the entries like the previous recursive loader did; a deep copy of the context per directory."""
+    entries = []
+    root = index.records["."]
+    for loaded in root["yamls"]:
+        server.extend_dict(context, copy.deepcopy(loaded))
+    for d in root["subdirs"]:
+        record = index.records[d]
+        current_context = copy.deepcopy(context)
+        for loaded in record["yamls"]:
+            server.extend_dict(current_context, copy.deepcopy(loaded))
+        for name in record["files"]:
+            path = os.path.join(index.data_path, d, name)
+            entries.append(LegacyImage(path, os.path.join(index.sidecar_path, d, name), current_context))
+    return entries
+
+
+def measure(function):
+    """Returns the result of function and the memory it retains in bytes."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def time_info(function, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+    return (time.perf_counter() - start) / count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the memory use of the entry representations.")
+    parser.add_argument('--entries', type=int, help="Approximate number of entries, defaults to %(default)s.",
+                        default=1000000)
+    parser.add_argument('--files', type=int, help="Files per directory, defaults to %(default)s.", default=500)
+    parser.add_argument('--classes', type=int, help="Classes in the root yaml, defaults to %(default)s.", default=50)
+    args = parser.parse_args()
+
+    index = synthetic_index("/data/synthetic", max(1, args.entries // args.files), args.files, args.classes)
+
+    legacy, legacy_bytes = measure(lambda: legacy_entries(index, {"classes":[]}))
+    legacy_info = time_info(lambda: json.dumps(legacy[len(legacy) // 2].get_info()), 1000)
+    count = len(legacy)
+    del legacy
+
+    configs = server.ConfigStore()
+    current, current_bytes = measure(lambda: index.entries({"classes":[]}, configs))
+    current_info = time_info(lambda: current[len(current) // 2].get_info(configs), 1000)
+
+    print("entries: {}  distinct configs: {}".format(count, len(configs.configs)))
+    print("legacy:  {:10.1f} MiB  {:6.1f} bytes/entry  entry_info: {:8.2f} us".format(
+          legacy_bytes / 2**20, legacy_bytes / count, legacy_info * 1e6))
+    print("current: {:10.1f} MiB  {:6.1f} bytes/entry  entry_info: {:8.2f} us".format(
+          current_bytes / 2**20, current_bytes / len(current), current_info * 1e6))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# Copyright (c) 2018 Ivor Wanders
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    Benchmark of the feature transport; generates sidecars with dense polygons like the ones SAM produces, with
+    coordinates on the pixel grid, at two decimals and at full float precision, and compares the payload size, the
+    time to serialize (encode and compress) and the time to parse (decompress and decode) of json and of the compact
+    geometry encoding, each uncompressed, with gzip and with brotli if it is installed.
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import server
+from bench_http import synthetic_features
+
+
+def json_encode(document):
+    return json.dumps(document).encode("utf-8")
+
+
+def json_decode(payload):
+    return json.loads(payload)
+
+
+def compact_encode(document):
+    try:
+        return server.GeometryTransport.encode(document)
+    except ValueError:
+        # This is what the server does, documents that can't be encoded exactly are sent as json.
+        return json_encode(document)
+
+
+def compact_decode(payload):
+    if payload[:4] == server.GeometryTransport.MAGIC:
+        return server.GeometryTransport.decode(payload)
+    return json_decode(payload)
+
+
+def compressors():
+    """Returns the compressors as name: (compress, decompress), with the settings the server uses."""
+    result = {"none": (lambda b: b, lambda b: b),
+              "gzip": (lambda b: gzip.compress(b, compresslevel=6), gzip.decompress)}
+    if server.brotli is not None:
+        result["br"] = (lambda b: server.brotli.compress(b, quality=5), server.brotli.decompress)
+    return result
+
+
+def quantize(document, step):
+    """Rounds all polygon coordinates to a multiple of step, or leaves them at full precision if step is None."""
+    for feature in document["features"]:
+        for ring in feature["geometry"]["coordinates"]:
+            for point in ring:
+                if step is None:
+                    point[0] += random.random() / 3
+                    point[1] += random.random() / 3
+                else:
+                    point[0] = round(round(point[0] / step) * step, 2)
+                    point[1] = round(round(point[1] / step) * step, 2)
+    return document
+
+
+def time_function(f, argument, repeat):
+    """Returns the result of f and the fastest of repeat calls in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(argument)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return result, best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare payload size and (de)serialization time of the feature transport.")
+    parser.add_argument('--width', type=int, help="Width of the image, defaults to %(default)s.", default=2048)
+    parser.add_argument('--height', type=int, help="Height of the image, defaults to %(default)s.", default=1536)
+    parser.add_argument('--polygons', type=int, nargs="+", help="Polygons per sidecar to test, defaults to %(default)s.", default=[20, 200])
+    parser.add_argument('--vertices', type=int, help="Vertices per polygon, defaults to %(default)s.", default=256)
+    parser.add_argument('--repeat', type=int, help="Repetitions per measurement, the fastest is kept, defaults to %(default)s.", default=5)
+    parser.add_argument('--output', help="File to write the json results to.", default=None)
+    args = parser.parse_args()
+
+    precisions = {"pixel": 1.0, "decimals": 0.01, "float": None}
+    formats = {"json": (json_encode, json_decode), "compact": (compact_encode, compact_decode)}
+    results = []
+    print("{:>8s} {:>9s} {:>8s} {:>5s} {:>10s} {:>10s} {:>10s}".format("polygons", "precision", "format", "comp",
+                                                                     "bytes", "ser ms", "parse ms"))
+    for polygons in args.polygons:
+        for precision, step in precisions.items():
+            random.seed(0)
+            document = quantize(synthetic_features(args.width, args.height, polygons, args.vertices,
+                                                   random.Random(0)), step)
+            for format_name, (encode, decode) in formats.items():
+                for compression, (compress, decompress) in compressors().items():
+                    payload, serialize = time_function(lambda d: compress(encode(d)), document, args.repeat)
+                    parsed, parse = time_function(lambda p: decode(decompress(p)), payload, args.repeat)
+                    if parsed != document:
+                        raise RuntimeError("{} {} didn't round trip.".format(format_name, compression))
+                    result = {"polygons": polygons, "precision": precision, "format": format_name,
+                              "compression": compression, "bytes": len(payload),
+                              "serialize_ms": round(serialize * 1000, 3), "parse_ms": round(parse * 1000, 3)}
+                    results.append(result)
+                    print("{polygons:>8d} {precision:>9s} {format:>8s} {compression:>5s} {bytes:>10d} "
+                          "{serialize_ms:>10.3f} {parse_ms:>10.3f}".format(**result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# The MIT License (MIT)
+# Copyright (c) 2018 Ivor Wanders
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+    Load test of the SAM backend worker pool; registers a number of images, then a number of client threads click
+    on random images as fast as the backend answers. Reports the clicks per second for each number of workers.
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "segment_backend_py"))
+import backend
+from bench_decoder import synthetic_image
+
+
+def run_clients(pool, hashes, clients, clicks, width, height):
+    """Returns the duration in seconds and the per click latencies of all clients."""
+    latencies = []
+    lock = threading.Lock()
+
+    def client(index):
+        rng = np.random.default_rng(index)
+        own = []
+        for _ in range(clicks):
+            image_hash = hashes[int(rng.integers(0, len(hashes)))]
+            points = [((float(rng.uniform(0, width)), float(rng.uniform(0, height))), 1)]
+            start = time.perf_counter()
+            job = backend.Job("predict", image_hash, client="client{}".format(index), points=points, threshold=0.0)
+            pool.submit(job).wait()
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the SAM backend with a number of worker processes.")
+    parser.add_argument('--pth', help="The pth file to load, by default read from SAM_PTH, which currently is: %(default)s", default=os.environ.get("SAM_PTH"))
+    parser.add_argument('--device', help="The device to run the model on, defaults to %(default)s.", default="cpu")
+    parser.add_argument('--workers', type=int, nargs="+", help="Worker counts to test, defaults to %(default)s.", default=[1, 2, 4])
+    parser.add_argument('--images', type=int, help="Number of distinct images, defaults to %(default)s.", default=16)
+    parser.add_argument('--clients', type=int, help="Number of concurrent clients, defaults to %(default)s.", default=16)
+    parser.add_argument('--clicks', type=int, help="Clicks per client, defaults to %(default)s.", default=20)
+    args = parser.parse_args()
+
+    width, height = 640, 480
+    images = [synthetic_image(width, height, seed) for seed in range(args.images)]
+    for workers in args.workers:
+        threads = max(1, os.cpu_count() // workers)
+        pool = backend.WorkerPool(workers, {"model_file": args.pth, "device": args.device, "threads": threads},
+                                  max_queue=args.clients * 2)
+        # Register all images first, such that only the decoder is measured.
+        hashes = [pool.submit(backend.Job("image", backend.Segmenter.hash_bytes(b), image_bytes=b)).wait()["image_hash"]
+                  for b in images]
+        duration, latencies = run_clients(pool, hashes, args.clients, args.clicks, width, height)
+        latencies = np.array(latencies) * 1000.0
+        print("workers: {: >3d}  clicks: {: >6d}  {:8.1f} clicks/s  p50: {:7.1f}ms  p99: {:7.1f}ms".format(
+              workers, len(latencies), len(latencies) / duration, np.percentile(latencies, 50),
+              np.percentile(latencies, 99)))
+        pool.stop()
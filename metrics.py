@@ -0,0 +1,134 @@
+# The MIT License (MIT)
+# Copyright (c) 2018 Ivor Wanders
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+    Latency histograms and request profiling shared by server.py and the SAM backend, such that both expose the same
+    buckets and format on their /metrics endpoint.
+"""
+
+import cherrypy
+import os
+import time
+import threading
+import bisect
+import contextlib
+import cProfile
+import random
+import tempfile
+
+
+class Metrics:
+    """
+        Latency histograms of the endpoints and of the stages within them, such as reading an image or running the
+        decoder. Rendered in the Prometheus text format by the metrics endpoint, with the metric names prefixed by
+        the name of the server.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {}  # (kind, name) -> [bucket counts, count, sum]
+
+    def observe(self, kind, name, seconds):
+        """Records a duration for the endpoint or stage of this name, kind is "request" or "stage"."""
+        position = bisect.bisect_left(Metrics.BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get((kind, name))
+            if histogram is None:
+                histogram = [[0] * (len(Metrics.BUCKETS) + 1), 0, 0.0]
+                self.histograms[(kind, name)] = histogram
+            histogram[0][position] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Records the duration of the block as the named stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage", name, time.perf_counter() - start)
+
+    def render(self):
+        """Returns the histograms in the Prometheus text exposition format."""
+        with self.lock:
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items())
+        lines = []
+        for kind, label in (("request", "endpoint"), ("stage", "stage")):
+            metric = "{}_{}_seconds".format(self.prefix, kind)
+            lines.append("# TYPE {} histogram".format(metric))
+            for (histogram_kind, name), (buckets, count, total) in histograms:
+                if histogram_kind != kind:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(Metrics.BUCKETS + ("+Inf",), buckets):
+                    cumulative += bucket
+                    lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(metric, label, name, bound, cumulative))
+                lines.append('{}_count{{{}="{}"}} {}'.format(metric, label, name, count))
+                lines.append('{}_sum{{{}="{}"}} {:.6f}'.format(metric, label, name, total))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsTool(cherrypy.Tool):
+    """
+        CherryPy tool that records the latency of every request by endpoint, static files are recorded together.
+        With profile_slow set, a fraction of the requests runs under cProfile and the profiles of those that took
+        longer than profile_slow seconds are written to profile_dir. Only the request thread is profiled.
+    """
+    def __init__(self, metrics, root, profile_slow=0.0, profile_rate=0.1, profile_dir=None):
+        cherrypy.Tool.__init__(self, "on_start_resource", self.start, priority=10)
+        self.metrics = metrics
+        self.root = root
+        self.profile_slow = profile_slow
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir or os.path.join(tempfile.gettempdir(), metrics.prefix + "_profiles")
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach("on_end_request", self.end, priority=90)
+
+    def start(self):
+        request = cherrypy.request
+        request.metrics_start = time.perf_counter()
+        request.metrics_profile = None
+        if self.profile_slow > 0 and random.random() < self.profile_rate:
+            request.metrics_profile = cProfile.Profile()
+            request.metrics_profile.enable()
+
+    def end(self):
+        request = cherrypy.request
+        start = getattr(request, "metrics_start", None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        name = request.path_info.strip("/").split("/")[0]
+        if not getattr(getattr(self.root, name, None), "exposed", False):
+            name = "static"
+        self.metrics.observe("request", name, duration)
+        profile = request.metrics_profile
+        if profile is not None:
+            profile.disable()
+            if duration >= self.profile_slow:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                path = os.path.join(self.profile_dir, "{}-{}-{}ms.prof".format(name, time.strftime("%Y%m%d-%H%M%S"),
+                                                                              int(duration * 1000)))
+                profile.dump_stats(path)
+                print("Slow request {} took {:.3f}s, profile written to {}".format(request.path_info, duration, path))
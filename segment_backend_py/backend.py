@@ -21,29 +21,234 @@
 import cherrypy
 import os
 import sys
+import time
 import argparse
+import concurrent.futures
+import multiprocessing
+import multiprocessing.shared_memory
+import multiprocessing.connection
+import itertools
 import cherrypy_cors
 cherrypy_cors.install()
 
 curdir = os.path.join(os.getcwd(), os.path.dirname(__file__))
 
+# The metrics are shared with the labelling server, which lives in the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from metrics import Metrics, MetricsTool
+
 SAM_LOOKUP = {
     "sam_vit_b_01ec64.pth": "vit_b",
 }
 
 from segment_anything import SamPredictor, sam_model_registry
+from segment_anything.utils.transforms import ResizeLongestSide
 import numpy as np
 from PIL import Image
 from io import BytesIO
 import torchvision.transforms.functional as transform
 import torchvision
+import torch
+import json
+import threading
 import hashlib
 import base64
 import cv2
+import collections
+import tempfile
+import contextlib
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class EmbeddingCache:
+    """
+        Least recently used cache of image embeddings by image hash, bounded by the size of the embeddings in
+        bytes. If a directory is given, embeddings are also written there and loaded memory mapped when they are
+        not in memory, such that they survive restarts. The directory is bounded by evicting the oldest files.
+        Embeddings precomputed with the embed command are found by searching the precomputed folder for the
+        embedding directories next to the sidecar files, these are only read. That search runs in a background
+        thread, such that looking up an unknown hash never waits for it.
+    """
+    # Directory relative to the sidecar files in which the embed command writes the embeddings.
+    PRECOMPUTED_DIRECTORY = os.path.join(".labelling_tool", "embeddings")
+    PRECOMPUTED_RESCAN_INTERVAL = 60.0
+
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=8 * 2**30, precomputed=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.precomputed = precomputed
+        self.precomputed_dirs = {}  # hash -> directory
+        self.precomputed_scanned = None
+        self.precomputed_scanning = False
+        self.entries = collections.OrderedDict()  # hash -> (features, original_size, input_size)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def state_bytes(state):
+        features = state[0]
+        return features.element_size() * features.nelement()
+
+    @staticmethod
+    def paths(directory, image_hash):
+        return (os.path.join(directory, image_hash + ".npy"), os.path.join(directory, image_hash + ".json"))
+
+    @staticmethod
+    def write(directory, image_hash, state):
+        """
+            Writes the embedding to the directory as float16 to halve the size, the json file is written last
+            to mark completion.
+        """
+        features, original_size, input_size = state
+        npy_path, json_path = EmbeddingCache.paths(directory, image_hash)
+        with open(npy_path + ".tmp", "wb") as f:
+            np.save(f, features.detach().cpu().numpy().astype(np.float16))
+        os.replace(npy_path + ".tmp", npy_path)
+        with open(json_path + ".tmp", "w") as f:
+            json.dump({"original_size": list(original_size), "input_size": list(input_size)}, f)
+        os.replace(json_path + ".tmp", json_path)
+
+    def scan_precomputed(self, force=False):
+        """
+            Starts searching the precomputed folder for embeddings in a background thread, at most once per rescan
+            interval unless forced, and never while a search is in progress.
+        """
+        if self.precomputed is None:
+            return
+        now = time.time()
+        with self.lock:
+            recent = self.precomputed_scanned is not None and \
+                now - self.precomputed_scanned < EmbeddingCache.PRECOMPUTED_RESCAN_INTERVAL
+            if self.precomputed_scanning or (recent and not force):
+                return
+            self.precomputed_scanning = True
+            self.precomputed_scanned = now
+        threading.Thread(target=self.walk_precomputed, name="PrecomputedScan", daemon=True).start()
+
+    def walk_precomputed(self):
+        """Walks the precomputed folder and replaces the known precomputed embeddings with those found."""
+        found = {}
+        try:
+            for dirpath, dirnames, filenames in os.walk(self.precomputed):
+                if dirpath.endswith(EmbeddingCache.PRECOMPUTED_DIRECTORY):
+                    for name in filenames:
+                        if name.endswith(".json"):
+                            found[name[:-len(".json")]] = dirpath
+            with self.lock:
+                self.precomputed_dirs = found
+        finally:
+            with self.lock:
+                self.precomputed_scanning = False
+
+    def disk_paths(self, image_hash):
+        """Returns the paths of this embedding on disk, or None if it isn't stored."""
+        with self.lock:
+            directory = self.precomputed_dirs.get(image_hash)
+        if directory is None and self.directory is not None:
+            directory = self.directory
+        if directory is None:
+            return None
+        paths = EmbeddingCache.paths(directory, image_hash)
+        return paths if os.path.isfile(paths[1]) else None
+
+    def contains(self, image_hash):
+        with self.lock:
+            if image_hash in self.entries:
+                return True
+        if self.disk_paths(image_hash) is not None:
+            return True
+        # It may have been precomputed since the last search, that is only known once the next search finishes.
+        self.scan_precomputed()
+        return False
+
+    def get(self, image_hash, device):
+        """Returns the (features, original_size, input_size) state for this image, or None."""
+        with self.lock:
+            state = self.entries.get(image_hash)
+            if state is not None:
+                self.entries.move_to_end(image_hash)
+                self.hits += 1
+                return state
+        state = self.load(image_hash, device)
+        with self.lock:
+            if state is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.put(image_hash, state, write=False)
+        return state
+
+    def put(self, image_hash, state, write=True):
+        size = EmbeddingCache.state_bytes(state)
+        with self.lock:
+            if image_hash not in self.entries:
+                self.entries[image_hash] = state
+                self.size += size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= EmbeddingCache.state_bytes(evicted)
+        if write and self.directory is not None:
+            self.store(image_hash, state)
+
+    def load(self, image_hash, device):
+        paths = self.disk_paths(image_hash)
+        if paths is None:
+            return None
+        npy_path, json_path = paths
+        try:
+            with open(json_path, "r") as f:
+                sizes = json.load(f)
+            features = np.load(npy_path, mmap_mode="r")
+        except (OSError, ValueError, json.decoder.JSONDecodeError):
+            return None
+        features = torch.from_numpy(np.ascontiguousarray(features)).to(device=device, dtype=torch.float32)
+        return (features, tuple(sizes["original_size"]), tuple(sizes["input_size"]))
+
+    def store(self, image_hash, state):
+        EmbeddingCache.write(self.directory, image_hash, state)
+        self.evict_disk()
+
+    def evict_disk(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.name[:-len(".npy")]))
+        total = sum(f[1] for f in files)
+        for _, size, image_hash in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            for path in reversed(EmbeddingCache.paths(self.directory, image_hash)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "directory": self.directory, "precomputed": len(self.precomputed_dirs)}
 
 
 class Segmenter:
-    def __init__(self, model_file):
+    DECODERS = ("torch", "jit", "onnx")
+    MASK_FORMATS = ("png", "rle", "packbits", "none")
+
+    def __init__(self, model_file, image_store_bytes=512 * 2**20, embedding_cache_bytes=1024 * 2**20,
+                 embedding_dir=None, precomputed=None, device="auto", threads=0, decoder="torch", onnx_file=None,
+                 max_sessions=256):
         filename = os.path.basename(model_file)
         model_type = SAM_LOOKUP.get(filename, None)
         if model_type is None:
@@ -51,14 +256,49 @@ class Segmenter:
         checkpoint = model_file
         print(f"Determined model type: {model_type} from {filename}")
 
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if threads > 0:
+            torch.set_num_threads(threads)
+        print(f"Using device {device} with {torch.get_num_threads()} threads and the {decoder} decoder.")
+
         print("Loading model... ", end="", flush=True)
         self.sam = sam_model_registry[model_type](checkpoint=checkpoint)
-        self.sam.to(device='cuda')
+        self.sam.to(device=device)
+        self.sam.eval()
         self.predictor = SamPredictor(self.sam)
         print(" done!")
 
+        # The prompt encoder and mask decoder run on every click, they can be replaced with a traced or onnx version.
+        self.decoder = decoder
+        self.exported_decoder = None
+        if decoder == "jit":
+            self.exported_decoder = self.trace_decoder()
+        elif decoder == "onnx":
+            if onnx_file is None:
+                onnx_file = os.path.join(tempfile.gettempdir(), filename + ".decoder.onnx")
+            if not os.path.isfile(onnx_file):
+                self.export_onnx_decoder(onnx_file)
+            self.exported_decoder = self.load_onnx_decoder(onnx_file, threads)
+        elif decoder != "torch":
+            raise Exception(f"Unknown decoder {decoder}, should be one of {', '.join(Segmenter.DECODERS)}.")
+
         self.current_file_hash = None
 
+        # Registered images by their hash, such that clients only need to send the hash with the points.
+        self.images = collections.OrderedDict()
+        self.images_bytes = 0
+        self.image_store_bytes = image_store_bytes
+
+        # Embeddings of previous images, such that switching between images doesn't run the encoder again.
+        self.embeddings = EmbeddingCache(embedding_cache_bytes, embedding_dir, precomputed=precomputed)
+        self.embeddings.scan_precomputed(force=True)
+
+        # Points and low resolution logits of the last prediction by (client, image hash), such that refinement
+        # clicks only send the new points and the previous mask is passed to the decoder.
+        self.sessions = collections.OrderedDict()
+        self.max_sessions = max_sessions
+
     @staticmethod
     def read_file_from_disk(p):
         with open(p, "rb") as f:
@@ -75,14 +315,117 @@ class Segmenter:
         databytes = np.packbits(data, axis=1)
         return Image.frombytes(mode='1', size=size, data=databytes)
 
+    @staticmethod
+    def mask_to_png(data):
+        """Returns the bytes of a white png that is transparent outside of the mask."""
+        mask = Segmenter.mask_to_image(data)
+        mask_image = Image.new("RGB", (mask.width, mask.height), (255, 255, 255))
+        mask_image.putalpha(mask)
+        buffer = BytesIO()
+        mask_image.save(buffer, format="png")
+        return buffer.getvalue()
+
+    @staticmethod
+    def mask_to_rle(data):
+        """COCO style uncompressed run length encoding; column major, the first run counts zeros."""
+        data = data.squeeze()
+        flat = data.ravel(order="F")
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+        if flat.size and flat[0]:
+            counts = np.concatenate(([0], counts))
+        return {"size": list(data.shape), "counts": counts.tolist()}
+
+    @staticmethod
+    def mask_to_packbits(data):
+        """The row major mask packed to bits, base64 encoded."""
+        data = data.squeeze()
+        return {"size": list(data.shape), "bits": base64.b64encode(np.packbits(data).tobytes()).decode("ascii")}
+
+
+    def register_image(self, image_bytes):
+        """Stores the image by its hash, evicting the least recently used images, returns the hash."""
+        new_hash = Segmenter.hash_bytes(image_bytes)
+        if new_hash in self.images:
+            self.images.move_to_end(new_hash)
+            return new_hash
+        self.images[new_hash] = image_bytes
+        self.images_bytes += len(image_bytes)
+        while self.images_bytes > self.image_store_bytes and len(self.images) > 1:
+            _, evicted = self.images.popitem(last=False)
+            self.images_bytes -= len(evicted)
+        return new_hash
+
+    def has_image(self, image_hash):
+        return (image_hash == self.current_file_hash or image_hash in self.images or
+                self.embeddings.contains(image_hash))
+
+    def restore_embedding(self, state):
+        """Sets the predictor state as if set_image was called for the image of this embedding."""
+        self.predictor.reset_image()
+        self.predictor.features, self.predictor.original_size, self.predictor.input_size = state
+        self.predictor.is_image_set = True
 
     def update_image(self, image_bytes):
+        self.update_image_hash(self.register_image(image_bytes))
+
+    def decoder_model(self):
+        from segment_anything.utils.onnx import SamOnnxModel
+        return SamOnnxModel(self.sam, return_single_mask=True)
+
+    def decoder_example(self, point_count=2):
+        """Example inputs for the decoder, in the order of the SamOnnxModel forward arguments."""
+        embed_dim = self.sam.prompt_encoder.embed_dim
+        embed_size = self.sam.prompt_encoder.image_embedding_size
+        mask_input_size = [4 * x for x in embed_size]
+        device = self.predictor.device
+        return (torch.randn(1, embed_dim, *embed_size, dtype=torch.float, device=device),
+                torch.randint(low=0, high=1024, size=(1, point_count, 2), dtype=torch.float, device=device),
+                torch.randint(low=0, high=4, size=(1, point_count), dtype=torch.float, device=device),
+                torch.randn(1, 1, *mask_input_size, dtype=torch.float, device=device),
+                torch.tensor([1], dtype=torch.float, device=device),
+                torch.tensor([1500, 2250], dtype=torch.float, device=device))
+
+    def trace_decoder(self):
+        # The number of points is read from the input tensors, so the trace works for any number of points.
+        with torch.no_grad():
+            return torch.jit.trace(self.decoder_model(), self.decoder_example(), check_trace=False)
+
+    def export_onnx_decoder(self, onnx_file):
+        print(f"Exporting decoder to {onnx_file}... ", end="", flush=True)
+        with torch.no_grad():
+            torch.onnx.export(self.decoder_model(), self.decoder_example(), onnx_file, export_params=True,
+                              opset_version=17, do_constant_folding=True,
+                              input_names=["image_embeddings", "point_coords", "point_labels", "mask_input",
+                                           "has_mask_input", "orig_im_size"],
+                              output_names=["masks", "iou_predictions", "low_res_masks"],
+                              dynamic_axes={"point_coords": {1: "num_points"}, "point_labels": {1: "num_points"}})
+        print(" done!")
+
+    @staticmethod
+    def load_onnx_decoder(onnx_file, threads=0):
+        if onnxruntime is None:
+            raise Exception("The onnx decoder needs the onnxruntime package.")
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        return onnxruntime.InferenceSession(onnx_file, options, providers=["CPUExecutionProvider"])
+
+    def update_image_hash(self, new_hash):
         # Embeddings takes most of the time, so we check if we need to do it again, or whether
         # this is still the active file.
-        new_hash = Segmenter.hash_bytes(image_bytes)
         if self.current_file_hash == new_hash:
             return
 
+        state = self.embeddings.get(new_hash, self.predictor.device)
+        if state is not None:
+            self.restore_embedding(state)
+            self.current_file_hash = new_hash
+            return
+
+        image_bytes = self.images[new_hash]
+        self.images.move_to_end(new_hash)
+
         # The image comes in as a bytes, so we make it into an image here:
         img_buffer = BytesIO(image_bytes)
         img = Image.open(img_buffer)
@@ -92,95 +435,695 @@ class Segmenter:
         img = img.convert('RGB')
 
         # Then pass that to the predictor.
-        self.predictor.set_image(np.array(img))
+        with torch.inference_mode():
+            self.predictor.set_image(np.array(img))
+        self.embeddings.put(new_hash, (self.predictor.features, self.predictor.original_size,
+                                       self.predictor.input_size))
 
         # And update the current hash.
         self.current_file_hash = new_hash
 
+    @staticmethod
+    def load_for_encoder(path, directory, target_length):
+        """
+            Reads and resizes an image for the encoder, runs in the worker processes of the embed command.
+            Returns None if the embedding of this image is already in the directory.
+        """
+        image_bytes = Segmenter.read_file_from_disk(path)
+        image_hash = Segmenter.hash_bytes(image_bytes)
+        if os.path.isfile(EmbeddingCache.paths(directory, image_hash)[1]):
+            return None
+        img = np.array(Image.open(BytesIO(image_bytes)).convert('RGB'))
+        resized = ResizeLongestSide(target_length).apply_image(img)
+        return (image_hash, img.shape[:2], resized, directory)
+
+    @torch.inference_mode()
+    def embed_batch(self, loaded):
+        """Runs the encoder on a batch of images from load_for_encoder and writes the embeddings."""
+        device = self.predictor.device
+        batch = []
+        for image_hash, original_size, resized, directory in loaded:
+            image_torch = torch.as_tensor(resized, device=device).permute(2, 0, 1).contiguous()[None, :, :, :]
+            batch.append(self.sam.preprocess(image_torch))
+        features = self.sam.image_encoder(torch.cat(batch))
+        for i, (image_hash, original_size, resized, directory) in enumerate(loaded):
+            os.makedirs(directory, exist_ok=True)
+            EmbeddingCache.write(directory, image_hash, (features[i:i + 1], original_size, resized.shape[:2]))
+
     def set_threshold(self, threshold):
         self.predictor.model.mask_threshold = threshold
 
     def predict(self, points_with_labels, multimask_output=False):
+        if self.exported_decoder is not None and not multimask_output:
+            return self.predict_exported(points_with_labels)
         input_point = np.array([p[0] for p in points_with_labels])
         input_label = np.array([p[1] for p in points_with_labels])
-        masks, scores, logits = self.predictor.predict(
-            point_coords=input_point,
-            point_labels=input_label,
-            multimask_output=multimask_output,
-        )
+        with torch.inference_mode():
+            masks, scores, logits = self.predictor.predict(
+                point_coords=input_point,
+                point_labels=input_label,
+                multimask_output=multimask_output,
+            )
         return (masks, scores, logits)
 
+    def session_prompt(self, client, image_hash, points, threshold, refine):
+        """
+            Returns the (points_with_labels, threshold, mask_input) prompt for a request. If refine is set the points
+            are added to those of the session and the logits of its last prediction are the mask input, returns None
+            if there is no session to refine.
+        """
+        if not refine:
+            return (points, threshold, None)
+        session = self.sessions.get((client, image_hash))
+        if session is None:
+            return None
+        previous_points, logits = session
+        return (previous_points + points, threshold, logits)
+
+    def store_session(self, client, image_hash, points, logits):
+        if client is None:
+            return
+        key = (client, image_hash)
+        self.sessions[key] = (points, logits)
+        self.sessions.move_to_end(key)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def reset_session(self, client, image_hash):
+        self.sessions.pop((client, image_hash), None)
+
+    def predict_batch(self, prompts):
+        """
+            Runs the decoder for a list of (points_with_labels, threshold, mask_input) prompts on the current image,
+            returns a list of (masks, scores, logits) like predict does. Prompts with and without mask input are each
+            passed to the decoder as one batch, prompts with fewer points are padded with points that the prompt
+            encoder ignores.
+        """
+        if self.exported_decoder is not None:
+            return [self.predict_exported(*prompt) for prompt in prompts]
+        results = [None] * len(prompts)
+        for with_mask in (False, True):
+            indices = [i for i, prompt in enumerate(prompts) if (prompt[2] is not None) == with_mask]
+            if indices:
+                batch = self.decode_batch([prompts[i] for i in indices], with_mask)
+                for i, result in zip(indices, batch):
+                    results[i] = result
+        return results
+
+    def decode_batch(self, prompts, with_mask):
+        count = max(len(points) for points, _, _ in prompts)
+        coords = np.zeros((len(prompts), count, 2), dtype=np.float32)
+        labels = np.full((len(prompts), count), -1, dtype=np.float32)
+        for i, (points, _, _) in enumerate(prompts):
+            coords[i, :len(points)] = [p[0] for p in points]
+            labels[i, :len(points)] = [p[1] for p in points]
+        coords = self.predictor.transform.apply_coords(coords, self.predictor.original_size)
+        device = self.predictor.device
+        with torch.inference_mode():
+            mask_input = None
+            if with_mask:
+                mask_input = torch.as_tensor(np.stack([m for _, _, m in prompts]), dtype=torch.float, device=device)
+            masks, scores, logits = self.predictor.predict_torch(
+                torch.as_tensor(coords, dtype=torch.float, device=device),
+                torch.as_tensor(labels, dtype=torch.int, device=device),
+                mask_input=mask_input,
+                multimask_output=False,
+                return_logits=True,
+            )
+            masks, scores, logits = masks.cpu().numpy(), scores.cpu().numpy(), logits.cpu().numpy()
+        return [(masks[i] > threshold, scores[i], logits[i]) for i, (_, threshold, _) in enumerate(prompts)]
+
+    def predict_exported(self, points_with_labels, threshold=None, mask_input=None):
+        """Predict with the traced or onnx decoder, returns the same as predict with a single mask."""
+        # The exported model expects a padding point if there is no box.
+        coords = np.array([[p[0] for p in points_with_labels] + [(0.0, 0.0)]], dtype=np.float32)
+        labels = np.array([[p[1] for p in points_with_labels] + [-1]], dtype=np.float32)
+        coords = self.predictor.transform.apply_coords(coords, self.predictor.original_size).astype(np.float32)
+        if mask_input is None:
+            mask_input_size = [4 * x for x in self.sam.prompt_encoder.image_embedding_size]
+            mask_input = np.zeros((1, 1, *mask_input_size), dtype=np.float32)
+            has_mask_input = np.zeros(1, dtype=np.float32)
+        else:
+            mask_input = mask_input.reshape(1, 1, *mask_input.shape[-2:]).astype(np.float32)
+            has_mask_input = np.ones(1, dtype=np.float32)
+        original_size = np.array(self.predictor.original_size, dtype=np.float32)
+
+        if self.decoder == "onnx":
+            masks, scores, logits = self.exported_decoder.run(None, {
+                "image_embeddings": self.predictor.features.cpu().numpy(),
+                "point_coords": coords,
+                "point_labels": labels,
+                "mask_input": mask_input,
+                "has_mask_input": has_mask_input,
+                "orig_im_size": original_size})
+        else:
+            device = self.predictor.device
+            with torch.inference_mode():
+                inputs = [torch.as_tensor(v, device=device) for v in (coords, labels, mask_input, has_mask_input,
+                                                                      original_size)]
+                outputs = self.exported_decoder(self.predictor.features, *inputs)
+            masks, scores, logits = [v.cpu().numpy() for v in outputs]
+        if threshold is None:
+            threshold = self.predictor.model.mask_threshold
+        masks = masks[0] > threshold
+        return (masks, scores[0], logits[0])
+
     
     @staticmethod
     def mask_to_bw_img(mask):
         return mask.astype(np.uint8).squeeze()
 
     @staticmethod
-    def actual_area_of_contour(cnt):
-        max_x = cnt[:, 0].max()
-        min_x = cnt[:, 0].min()
-        max_y = cnt[:, 1].max()
-        min_y = cnt[:, 1].min()
-
-        img_shape = (max_y - min_y, max_x - min_x)
-        if img_shape[0] == 0 or img_shape[1] == 0:
-            return 0.0
-        
-        blank_image = np.zeros(img_shape, np.uint8)
-        cv2.fillPoly(blank_image, pts=[cnt], color= 255, offset=(-min_x, -min_y))
-        area = np.count_nonzero(blank_image)
-        # cv2.imwrite(f"/tmp/area_cnt_{area}.png", blank_image)
-        return area
+    def simplify_contour(contour, max_vertices):
+        """Simplifies the contour with increasing tolerance until it has at most max_vertices points."""
+        epsilon = 0.5
+        while len(contour) > max_vertices:
+            contour = cv2.approxPolyDP(contour, epsilon, True)
+            epsilon *= 2.0
+        return contour
 
     @staticmethod
-    def create_contours(mask, area_ratio_minimum = 0.0, write_contours_to_tmp=False):
-        polygons_to_return = []
+    def contour_areas(contours):
+        """
+            Returns the number of pixels enclosed by each contour, including the contour itself. This uses Pick's
+            theorem on all contours at once; the pixels are the lattice points inside plus those on the boundary,
+            which is the shoelace area plus half the boundary points plus one. That only holds if the segments pass
+            through every boundary pixel, as for contours from CHAIN_APPROX_NONE or CHAIN_APPROX_SIMPLE.
+        """
+        lengths = np.array([len(c) for c in contours])
+        starts = np.cumsum(lengths) - lengths
+        points = np.concatenate(contours)[:, 0, :].astype(np.int64)
+        following = np.arange(1, len(points) + 1)
+        following[starts + lengths - 1] = starts
+        x, y = points[:, 0], points[:, 1]
+        x_next, y_next = x[following], y[following]
+        doubled_area = np.abs(np.add.reduceat(x * y_next - x_next * y, starts))
+        boundary = np.add.reduceat(np.gcd(np.abs(x_next - x), np.abs(y_next - y)), starts)
+        return (doubled_area + boundary) // 2 + 1
+
+    @staticmethod
+    def scale_contours(contours, scale):
+        """Maps (area, contour) from create_contours to an image that is (scale x, scale y) times as large."""
+        scale = np.asarray(scale, dtype=np.float64)
+        return [(int(area * scale[0] * scale[1]), (np.asarray(contour) * scale).round(1).tolist())
+                for area, contour in contours]
 
+    @staticmethod
+    def create_contours(mask, area_ratio_minimum = 0.0, write_contours_to_tmp=False, max_vertices=0):
+        """
+            Returns (area, contour) of the outer contours in the mask, largest first. The area is the number of pixels
+            enclosed by the contour, contours smaller than area_ratio_minimum of the image are discarded before
+            they are converted. The contours are flipped vertically and closed. If max_vertices is given, contours
+            are simplified to at most that many points.
+        """
         bw_img = Segmenter.mask_to_bw_img(mask)
         total_area = bw_img.shape[0] * bw_img.shape[1]
         h = bw_img.shape[0]
 
-        # contours, hierarchy = cv2.findContours(bw_img, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        contours, hierarchy = cv2.findContours(bw_img, cv2.RETR_TREE, cv2.CHAIN_APPROX_TC89_L1)
-        # hierarchy = hierarchy.squeeze()
-        print(hierarchy)
-        for i, contour in enumerate(contours):
-            contour = contour[:,0,:]
-            hierarchy_info = hierarchy[0, i, :]
-            next_i, previous_i, child_i, parent_i = hierarchy_info
-
-            # we are only interested in contours at the root.
-            if (parent_i != -1):
-                continue
-
-            # Contour area is wrong, it is not in pixel space.
-            # area = cv2.contourArea(contour)
-            area = Segmenter.actual_area_of_contour(contour)
-
-            # Discard if it is not large enough.
-            if area < (total_area * area_ratio_minimum):
-                continue
+        # Only the outer contours are of interest, blobs in the holes of other blobs are part of those. The areas
+        # are computed on the contours that keep every boundary pixel, the returned polygons are approximated.
+        exact, _ = cv2.findContours(bw_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if not exact:
+            return []
+        areas = Segmenter.contour_areas(exact)
+        kept = np.flatnonzero(areas >= total_area * area_ratio_minimum)
+        kept = kept[np.argsort(areas[kept], kind="stable")[::-1]]
+        # The contours are traced in the same order for both approximations.
+        contours, _ = cv2.findContours(bw_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_L1)
 
-            contour = [(int(x[0]), h - int(x[1])) for x in contour]
-            contour.append(contour[0]) # close it.
-            polygons_to_return.append((area, contour))
+        polygons_to_return = []
+        for i in kept:
+            contour = contours[i]
+            if max_vertices > 0:
+                contour = Segmenter.simplify_contour(contour, max_vertices)
+            contour = contour[:, 0, :]
+
+            # Flip vertically and close it.
+            polygon = np.empty((len(contour) + 1, 2), dtype=np.int64)
+            polygon[:-1, 0] = contour[:, 0]
+            polygon[:-1, 1] = h - contour[:, 1]
+            polygon[-1] = polygon[0]
+            polygons_to_return.append((int(areas[i]), polygon.tolist()))
 
             # render a mask for inspection
             if write_contours_to_tmp:
                 blank_image = np.zeros(bw_img.shape, np.uint8)
                 cv2.fillPoly(blank_image, pts=[contour], color= (255,255,255))
-                # plt.imshow(blank_image)
                 cv2.imwrite(f"/tmp/contour_{i}.png", blank_image)
-                # print(contour)
-
-        polygons_to_return.sort(reverse=True)
-        
 
         return polygons_to_return
 
+class QueueFull(Exception):
+    pass
+
+
+class WorkerUnavailable(Exception):
+    pass
+
+
+class Job:
+    """A request for the scheduler, either registering an image or predicting masks for points on an image."""
+    def __init__(self, kind, image_hash, image_bytes=None, client=None, points=None, threshold=0.0, refine=False,
+                 request_id=None):
+        self.kind = kind
+        self.refine = refine
+        self.image_hash = image_hash
+        self.image_bytes = image_bytes
+        self.client = client
+        self.points = points
+        self.threshold = threshold
+        self.request_id = request_id  # id of the message exchanged with the worker process running this job.
+        self.done = threading.Event()
+        self.stale = False
+        self.result = None
+        self.error = None
+        self.callback = None
+        self.timings = {}  # stage -> seconds
+
+    def finish(self):
+        self.done.set()
+        if self.callback is not None:
+            self.callback(self)
+
+    def wait(self, timeout=None):
+        """Returns the result, raises the error of the job, or WorkerUnavailable if it didn't finish in time."""
+        if not self.done.wait(timeout):
+            raise WorkerUnavailable("No response within {} seconds.".format(timeout))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Scheduler:
+    """
+        Owns the segmenter, such that the predictor is only used from a single thread. Jobs are queued in a bounded
+        queue, a queued prediction of a client is dropped when a newer one of that client arrives, and predictions
+        that are queued for the same image are passed to the decoder in a single batch. If the newer prediction
+        refines the dropped one, it takes over the points of the dropped one.
+    """
+    def __init__(self, segmenter, max_queue=32, max_batch=8):
+        self.segmenter = segmenter
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.jobs = collections.deque()
+        self.clients = {}  # client -> queued prediction job
+        self.cond = threading.Condition()
+        self.running = True
+        self.processed = 0
+        self.batches = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        """Queues the job, raises QueueFull if there is no room."""
+        with self.cond:
+            if job.kind == "predict" and job.client is not None:
+                old = self.clients.pop(job.client, None)
+                if old is not None:
+                    if job.refine and old.image_hash == job.image_hash:
+                        job.points = old.points + job.points
+                        job.refine = old.refine
+                    self.jobs.remove(old)
+                    old.stale = True
+                    old.finish()
+                    self.dropped += 1
+            if len(self.jobs) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull()
+            self.jobs.append(job)
+            if job.kind == "predict" and job.client is not None:
+                self.clients[job.client] = job
+            self.cond.notify()
+        return job
+
+    def take(self):
+        """Takes the oldest job and the predictions for the same image queued after it, None when stopped."""
+        with self.cond:
+            while self.running and not self.jobs:
+                self.cond.wait()
+            if not self.running:
+                return None
+            batch = [self.jobs.popleft()]
+            if batch[0].kind == "predict":
+                for job in list(self.jobs):
+                    if len(batch) >= self.max_batch:
+                        break
+                    if job.kind == "predict" and job.image_hash == batch[0].image_hash:
+                        self.jobs.remove(job)
+                        batch.append(job)
+            for job in batch:
+                if job.client is not None and self.clients.get(job.client) is job:
+                    del self.clients[job.client]
+            return batch
+
+    @staticmethod
+    @contextlib.contextmanager
+    def timed(batch, stage):
+        """Records the duration of the block as a stage of every job in the batch."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            for job in batch:
+                job.timings[stage] = duration
+
+    def process(self, batch):
+        segmenter = self.segmenter
+        for job in batch:
+            if job.image_bytes is not None:
+                with Scheduler.timed([job], "register_image"):
+                    segmenter.register_image(job.image_bytes)
+        image_hash = batch[0].image_hash
+        if batch[0].kind == "reset":
+            segmenter.reset_session(batch[0].client, image_hash)
+            batch[0].result = {"reset": True}
+            return
+        if batch[0].kind == "image":
+            with Scheduler.timed(batch, "set_image"):
+                segmenter.update_image_hash(image_hash)
+            batch[0].result = {"image_hash": image_hash}
+            return
+        if not segmenter.has_image(image_hash):
+            for job in batch:
+                job.result = {"need_image": True, "image_hash": image_hash}
+            return
+        with Scheduler.timed(batch, "set_image"):
+            segmenter.update_image_hash(image_hash)
+        jobs = []
+        prompts = []
+        for job in batch:
+            prompt = segmenter.session_prompt(job.client, image_hash, job.points, job.threshold, job.refine)
+            if prompt is None:
+                # The session is gone, the client should send all points.
+                job.result = {"need_reset": True, "image_hash": image_hash}
+                continue
+            jobs.append(job)
+            prompts.append(prompt)
+        if not prompts:
+            return
+        with Scheduler.timed(jobs, "predict"):
+            results = segmenter.predict_batch(prompts)
+        for job, prompt, result in zip(jobs, prompts, results):
+            segmenter.store_session(job.client, image_hash, prompt[0], result[2])
+            job.result = result
+
+    def run(self):
+        while True:
+            batch = self.take()
+            if batch is None:
+                return
+            try:
+                self.process(batch)
+            except Exception as e:
+                for job in batch:
+                    job.error = e
+            finally:
+                for job in batch:
+                    job.finish()
+                with self.cond:
+                    self.processed += len(batch)
+                    self.batches += 1
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            for job in self.jobs:
+                job.error = Exception("Backend is stopping.")
+                job.finish()
+            self.jobs.clear()
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {"queued": len(self.jobs), "max_queue": self.max_queue, "processed": self.processed,
+                    "batches": self.batches, "dropped": self.dropped, "rejected": self.rejected}
+
+
+def segmenter_stats(segmenter, scheduler):
+    return {"embeddings": segmenter.embeddings.stats(),
+            "images": {"entries": len(segmenter.images), "bytes": segmenter.images_bytes},
+            "sessions": len(segmenter.sessions),
+            "scheduler": scheduler.stats()}
+
+
+def worker_main(segmenter_args, max_queue, max_batch, requests, responses):
+    """
+        Runs a segmenter and scheduler in a worker process of the WorkerPool. Image bytes arrive in shared memory
+        created by the front process, masks are returned as packed bits in shared memory created here, which is
+        unlinked when the front process releases it.
+    """
+    segmenter = Segmenter(**segmenter_args)
+    scheduler = Scheduler(segmenter, max_queue, max_batch)
+    masks = {}
+    masks_lock = threading.Lock()
+
+    def respond(job):
+        response = {"id": job.request_id, "timings": job.timings}
+        if job.stale:
+            response["stale"] = True
+        elif job.error is not None:
+            response["error"] = str(job.error)
+        elif isinstance(job.result, dict):
+            response["result"] = job.result
+        else:
+            mask, scores, logits = job.result
+            bits = np.packbits(mask)
+            shm = multiprocessing.shared_memory.SharedMemory(create=True, size=max(bits.nbytes, 1))
+            shm.buf[:bits.nbytes] = bits.tobytes()
+            with masks_lock:
+                masks[shm.name] = shm
+            response["mask"] = (shm.name, mask.shape, bits.nbytes)
+            response["scores"] = scores.tolist()
+        responses.put(response)
+
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        if "release" in message:
+            with masks_lock:
+                shm = masks.pop(message["release"])
+            shm.close()
+            shm.unlink()
+            continue
+        if "stats" in message:
+            responses.put({"id": message["id"], "result": segmenter_stats(segmenter, scheduler)})
+            continue
+        image_bytes = None
+        if message["image"] is not None:
+            name, size = message["image"]
+            shm = multiprocessing.shared_memory.SharedMemory(name=name)
+            image_bytes = bytes(shm.buf[:size])
+            shm.close()
+        job = Job(message["kind"], message["image_hash"], image_bytes=image_bytes, client=message["client"],
+                  points=message["points"], threshold=message["threshold"], refine=message["refine"],
+                  request_id=message["id"])
+        job.callback = respond
+        try:
+            scheduler.submit(job)
+        except QueueFull:
+            responses.put({"id": job.request_id, "queue_full": True})
+    scheduler.stop()
+
+
+class WorkerPool:
+    """
+        Runs a segmenter in each of a number of processes, jobs are routed by the image hash such that the same image
+        always goes to the worker that has its embedding. Has the same submit and stats as the Scheduler.
+
+        A monitor thread watches the processes, when one dies its outstanding jobs fail with WorkerUnavailable and
+        it is started again, at most once every RESPAWN_DELAY seconds. Jobs for a worker that is down fail right away.
+    """
+    RESPAWN_DELAY = 5.0
+
+    def __init__(self, workers, segmenter_args, max_queue=32, max_batch=8):
+        self.context = multiprocessing.get_context("spawn")
+        self.segmenter_args = segmenter_args
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.responses = self.context.Queue()
+        self.requests = [None] * workers
+        self.processes = [None] * workers  # None while a worker is down.
+        self.started = [0.0] * workers
+        self.ids = itertools.count()
+        self.pending = {}  # id -> (job, worker, shared memory with the image)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.respawned = 0
+        self.stopping = False
+        for worker in range(workers):
+            self.spawn(worker)
+        self.receiver = threading.Thread(target=self.receive, daemon=True)
+        self.receiver.start()
+        self.monitor_thread = threading.Thread(target=self.monitor, daemon=True)
+        self.monitor_thread.start()
+
+    def spawn(self, worker):
+        """Starts the process of a worker, with a new request queue as the old one may hold unread messages."""
+        requests = self.context.Queue()
+        process = self.context.Process(target=worker_main, daemon=True, args=(self.segmenter_args, self.max_queue,
+                                       self.max_batch, requests, self.responses))
+        process.start()
+        with self.lock:
+            self.requests[worker] = requests
+            self.processes[worker] = process
+            self.started[worker] = time.monotonic()
+
+    def failed(self, worker):
+        """Marks a worker as down and fails its outstanding jobs."""
+        with self.lock:
+            exitcode = self.processes[worker].exitcode
+            self.processes[worker] = None
+            lost = [k for k, v in self.pending.items() if v[1] == worker]
+            jobs = [self.pending.pop(k) for k in lost]
+        print(f"Worker {worker} exited with {exitcode}, failing {len(jobs)} jobs.")
+        for job, _, shm in jobs:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            job.error = WorkerUnavailable(f"Worker {worker} exited with {exitcode}.")
+            job.finish()
+
+    def monitor(self):
+        while True:
+            with self.lock:
+                sentinels = [p.sentinel for p in self.processes if p is not None]
+            multiprocessing.connection.wait(sentinels, timeout=1.0)
+            if self.stopping:
+                return
+            for worker, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    self.failed(worker)
+                elif process is None and time.monotonic() - self.started[worker] >= WorkerPool.RESPAWN_DELAY:
+                    self.spawn(worker)
+                    with self.lock:
+                        self.respawned += 1
+
+    def route(self, image_hash):
+        return int(image_hash[:16], 16) % len(self.requests)
+
+    def send(self, worker, message, job, shm=None):
+        with self.lock:
+            requests = self.requests[worker]
+            if self.processes[worker] is None:
+                requests = None
+            else:
+                message["id"] = job.request_id = next(self.ids)
+                self.pending[message["id"]] = (job, worker, shm)
+        if requests is None:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            raise WorkerUnavailable(f"Worker {worker} is down.")
+        requests.put(message)
+        return job
+
+    def submit(self, job):
+        shm = None
+        image = None
+        if job.image_bytes is not None:
+            shm = multiprocessing.shared_memory.SharedMemory(create=True, size=max(len(job.image_bytes), 1))
+            shm.buf[:len(job.image_bytes)] = job.image_bytes
+            image = (shm.name, len(job.image_bytes))
+        with self.lock:
+            self.submitted += 1
+        message = {"kind": job.kind, "image_hash": job.image_hash, "image": image, "client": job.client,
+                   "points": job.points, "threshold": job.threshold, "refine": job.refine}
+        return self.send(self.route(job.image_hash), message, job, shm)
+
+    def receive(self):
+        while True:
+            response = self.responses.get()
+            if response is None:
+                return
+            with self.lock:
+                pending = self.pending.pop(response["id"], None)
+            if pending is None:
+                # The job already failed because its worker died, it can't release the mask anymore.
+                if "mask" in response:
+                    mask_shm = multiprocessing.shared_memory.SharedMemory(name=response["mask"][0])
+                    mask_shm.close()
+                    mask_shm.unlink()
+                continue
+            job, worker, shm = pending
+            job.timings = response.get("timings", {})
+            if shm is not None:
+                # The worker copied the image before it responded.
+                shm.close()
+                shm.unlink()
+            if response.get("queue_full"):
+                with self.lock:
+                    self.rejected += 1
+                job.error = QueueFull()
+            elif response.get("stale"):
+                job.stale = True
+            elif "error" in response:
+                job.error = Exception(response["error"])
+            elif "result" in response:
+                job.result = response["result"]
+            else:
+                name, shape, nbytes = response["mask"]
+                mask_shm = multiprocessing.shared_memory.SharedMemory(name=name)
+                bits = np.ndarray((nbytes,), dtype=np.uint8, buffer=mask_shm.buf).copy()
+                mask_shm.close()
+                with self.lock:
+                    requests = self.requests[worker]
+                requests.put({"release": name})
+                mask = np.unpackbits(bits, count=int(np.prod(shape))).reshape(shape).astype(bool)
+                job.result = (mask, np.array(response["scores"]), None)
+            job.finish()
+
+    def worker_stats(self, timeout=10.0):
+        stats = []
+        for worker in range(len(self.requests)):
+            try:
+                stats.append(self.send(worker, {"stats": True}, Job("stats", None)).wait(timeout))
+            except WorkerUnavailable as e:
+                stats.append({"unavailable": str(e)})
+        return stats
+
+    def stats(self):
+        with self.lock:
+            return {"workers": len(self.processes), "alive": sum(p is not None for p in self.processes),
+                    "pending": len(self.pending), "submitted": self.submitted, "rejected": self.rejected,
+                    "respawned": self.respawned}
+
+    def stop(self):
+        self.stopping = True
+        self.monitor_thread.join()
+        for worker, process in enumerate(self.processes):
+            if process is not None:
+                self.requests[worker].put(None)
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout=5.0)
+        self.responses.put(None)
+        self.receiver.join()
+
+
 class Web:
-    def __init__(self, segmenter):
+    def __init__(self, segmenter, scheduler, metrics=None, job_timeout=60.0):
         self.segmenter = segmenter
+        self.scheduler = scheduler
+        self.latencies = metrics if metrics is not None else Metrics("sam_backend")
+        self.job_timeout = job_timeout
+
+    def schedule(self, job):
+        """Submits the job and waits for its result, at most job_timeout seconds."""
+        try:
+            result = self.scheduler.submit(job).wait(self.job_timeout)
+        except QueueFull:
+            raise cherrypy.HTTPError(429, "Too many queued requests, try again later.")
+        except WorkerUnavailable as e:
+            raise cherrypy.HTTPError(503, "Segmentation is unavailable, try again later: {}".format(e))
+        finally:
+            for stage, seconds in job.timings.items():
+                self.latencies.observe("stage", stage, seconds)
+        return result
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
@@ -208,6 +1151,22 @@ class Web:
                 #[serde(default)]
                 threshold: f64,
             }
+            The mask_format selects how the mask is returned next to the contours; "png" (default) returns a
+            transparent png in image, "rle" returns {"size": [h, w], "counts": [...]} in mask, the COCO style
+            uncompressed run lengths in column major order starting with a run of zeros, "packbits" returns
+            {"size": [h, w], "bits": base64} in mask, the row major mask packed to bits, "none" only returns the
+            contours.
+            Instead of the image, the image_hash returned by sam_image may be passed, if the image is not known
+            the response is {"need_image": true} and the image should be registered with sam_image again.
+            If a client id is passed, a queued request of that client is answered with {"stale": true} when a
+            newer request arrives. If the queue is full the response is a 429.
+            With a client id, the points and the low resolution logits of the prediction are kept for the image. If
+            refine is true, the points are added to those and the logits are passed to the decoder as mask input;
+            if those are no longer known the response is {"need_reset": true} and all points should be sent with
+            refine false. Sending no points, or sam_reset, forgets them.
+            If the image is a downscaled version of the image the points are on, scale holds [x, y] of the original
+            pixels per pixel of the image. The points are mapped to the image and the contours back to the original,
+            the mask has the size of the image.
             #[derive(Serialize, Deserialize, Debug, Copy, Clone)]
             pub struct Point {
                 /// The horizontal position in normalised coordinates [0, 1.0]
@@ -225,72 +1184,139 @@ class Web:
             foreground = 1 if p["category"] == "Include" else 0;
             points.append(((p["x"], p["y"]), foreground))
 
-        print(points)
-        if len(points) == 0:
-            # SAM fails with a backtrace in this case... so lets prevent that.
-            input_json["image"] = ""
-            return input_json
-            
-
-        # Obtain the image bytes.
-        img_data = base64.b64decode(input_json["image"])
+        scale = input_json.get("scale")
+        if scale is not None:
+            points = [((x / scale[0], y / scale[1]), foreground) for (x, y), foreground in points]
 
-        # Pass the img data to the segmenter
-        self.segmenter.update_image(img_data)
+        mask_format = input_json.get("mask_format", "png")
+        if mask_format not in Segmenter.MASK_FORMATS:
+            raise cherrypy.HTTPError(400, f"Unknown mask format {mask_format}.")
 
-        # Set the threshold
-        self.segmenter.set_threshold(input_json["threshold"])
+        if len(points) == 0:
+            # SAM fails with a backtrace in this case... so lets prevent that.
+            if input_json.get("client") is not None and "image_hash" in input_json:
+                self.schedule(Job("reset", input_json["image_hash"], client=input_json["client"]))
+            return {"contours": [], "mask_format": mask_format, "image": "", "mask": None}
+
+        if "image_hash" in input_json:
+            # The image was registered before with sam_image, if we don't have it (anymore), ask for it.
+            job = Job("predict", input_json["image_hash"])
+        else:
+            # Obtain the image bytes, the scheduler registers them.
+            with self.latencies.span("base64_decode"):
+                img_data = base64.b64decode(input_json["image"])
+            with self.latencies.span("hash"):
+                image_hash = Segmenter.hash_bytes(img_data)
+            job = Job("predict", image_hash, image_bytes=img_data)
+        job.client = input_json.get("client")
+        job.points = points
+        job.threshold = input_json["threshold"]
+        job.refine = bool(input_json.get("refine", False)) and job.client is not None
 
         # Next, run the prediction
-        mask, scores, logits = self.segmenter.predict(points, multimask_output=False)
+        result = self.schedule(job)
+        if job.stale:
+            return {"stale": True}
+        if isinstance(result, dict):
+            return result
+        mask, scores, logits = result
 
         # Create contours from this mask.
         area_ratio_minimum = input_json.get("area_ratio", 0.0);
-        contours = Segmenter.create_contours(mask, area_ratio_minimum)
-        input_json["contours"] = contours
+        with self.latencies.span("create_contours"):
+            contours = Segmenter.create_contours(mask, area_ratio_minimum,
+                                                 max_vertices=input_json.get("max_vertices", 0))
+            if scale is not None:
+                contours = Segmenter.scale_contours(contours, scale)
+        response = {"contours": contours, "mask_format": mask_format}
+
+        # Encode the mask in the requested format, the input isn't sent back.
+        with self.latencies.span("encode_" + mask_format):
+            if mask_format == "png":
+                response["image"] = base64.b64encode(Segmenter.mask_to_png(mask)).decode("ascii")
+            elif mask_format == "rle":
+                response["mask"] = Segmenter.mask_to_rle(mask)
+            elif mask_format == "packbits":
+                response["mask"] = Segmenter.mask_to_packbits(mask)
+        return response
 
-        # Convert the mask to an image
-        mask = Segmenter.mask_to_image(mask)
 
-        # Now we have an image, we need to use that to mask in a transparent png.
-        color_of_mask = (255, 255, 255)
-        mask_image = Image.new("RGB", (mask.width, mask.height), color_of_mask)
-        mask_image.putalpha(mask)
-
-        # Convert the image to png bytes
-        buffer = BytesIO()
-        mask_image.save(buffer, format="png")
-        mask_png = buffer.getvalue()
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in()
+    def sam_image(self, *args, **kwargs):
+        """
+            Registers an image, returns its hash to be used in sam_trigger. The embedding is calculated right away,
+            such that the first prediction on the image is fast.
+        """
+        if cherrypy.request.method == 'OPTIONS':
+            cherrypy_cors.preflight(allowed_methods=['GET', 'POST'])
+            return {}
 
+        img_data = base64.b64decode(cherrypy.request.json["image"])
+        return self.schedule(Job("image", Segmenter.hash_bytes(img_data), image_bytes=img_data))
 
-        with open("/tmp/pngmask.png", "wb") as f:
-            f.write(mask_png)
-        # Make that into a base64 encoded string
-        mask_png_b64 = base64.b64encode(mask_png)
-        
-        input_json["image"] = mask_png_b64.decode("ascii")
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in()
+    def sam_reset(self, *args, **kwargs):
+        """Forgets the points and the previous mask of a client for an image, takes client and image_hash."""
+        if cherrypy.request.method == 'OPTIONS':
+            cherrypy_cors.preflight(allowed_methods=['GET', 'POST'])
+            return {}
+        input_json = cherrypy.request.json
+        return self.schedule(Job("reset", input_json["image_hash"], client=input_json["client"]))
 
-        return input_json
+    @cherrypy.expose
+    def metrics(self):
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return self.latencies.render().encode("utf-8")
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def cache_stats(self):
+        if self.segmenter is None:
+            return {"pool": self.scheduler.stats(), "workers": self.scheduler.worker_stats()}
+        return segmenter_stats(self.segmenter, self.scheduler)
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
     @cherrypy.tools.json_in()
     def present(self, *args, **kwargs):
-        return {}
+        """
+            Tells the frontend that sam_trigger takes a scale, such that it can send downscaled images, and that
+            images can be registered once with sam_image.
+        """
+        return {"scale": True, "image_hash": True}
 
 
-def start_backend_server(http_port, http_host, model_pth):
+def start_backend_server(http_port, http_host, model_pth, embedding_cache_bytes=1024 * 2**20, embedding_dir=None,
+                         precomputed=None, max_queue=32, max_batch=8, workers=1, profile_slow=0.0, profile_rate=0.1,
+                         profile_dir=None, job_timeout=60.0, **segmenter_options):
     # set cherrypy configuration.
     cherrypy.config.update({"server.socket_port": http_port})
     cherrypy.config.update({"server.socket_host": http_host})
 
-    caching_segmenter = Segmenter(model_pth)
-
-    web_root = Web(caching_segmenter)
+    segmenter_args = dict(model_file=model_pth, embedding_cache_bytes=embedding_cache_bytes,
+                          embedding_dir=embedding_dir, precomputed=precomputed, **segmenter_options)
+    if workers > 1:
+        # Divide the cores over the workers, unless the number of threads is given.
+        if not segmenter_args.get("threads"):
+            segmenter_args["threads"] = max(1, os.cpu_count() // workers)
+        caching_segmenter = None
+        scheduler = WorkerPool(workers, segmenter_args, max_queue, max_batch)
+    else:
+        caching_segmenter = Segmenter(**segmenter_args)
+        scheduler = Scheduler(caching_segmenter, max_queue, max_batch)
+    cherrypy.engine.subscribe("stop", scheduler.stop)
+
+    metrics = Metrics("sam_backend")
+    web_root = Web(caching_segmenter, scheduler, metrics, job_timeout)
+    cherrypy.tools.metrics = MetricsTool(metrics, web_root, profile_slow, profile_rate, profile_dir)
     cherrypy.quickstart(web_root, "/", config={
         "/": {"tools.staticdir.on": True,
             'cors.expose.on': True,
+            "tools.metrics.on": True,
             "tools.staticdir.dir": os.path.join(curdir, "static"),
             "tools.staticdir.index": "index.html",
             'tools.staticdir.content_types' : {
@@ -300,28 +1326,96 @@ def start_backend_server(http_port, http_host, model_pth):
             },
     })
 
+def segmenter_options(args):
+    return {"device": args.device, "threads": args.threads, "decoder": args.decoder, "onnx_file": args.onnx_file}
+
 def run_host(args):
-    start_backend_server(args.port, args.host, args.pth)
+    start_backend_server(args.port, args.host, args.pth, args.embedding_cache * 2**20, args.embedding_dir,
+                         args.precomputed, args.queue_size, args.max_batch, args.workers, args.profile_slow,
+                         args.profile_rate, args.profile_dir, args.job_timeout, **segmenter_options(args))
 
 
 
 def run_sam(args):
-    segmenter = Segmenter(args.pth)
+    segmenter = Segmenter(args.pth, **segmenter_options(args))
     img_data = Segmenter.read_file_from_disk(args.file)
     segmenter.update_image(img_data)
     points = [(tuple(int(v) for v in p.split(",")), 1) for p in args.point]
     mask, scores, logits = segmenter.predict(points, multimask_output=False)
-    contour = Segmenter.create_contours(mask, area_ratio_minimum=args.ratio)
+    contour = Segmenter.create_contours(mask, area_ratio_minimum=args.ratio, max_vertices=args.max_vertices)
     img = Segmenter.mask_to_image(mask)
     img.save(args.output)
 
 
+def load_entry_for_encoder(entry, directory, target_length, sam_size):
+    """
+        Loads the image that the frontend would send to the backend for this entry, the derivative from server.py
+        for large images, such that the embedding is found by the hash the frontend registers.
+    """
+    import server
+    return Segmenter.load_for_encoder(server.SamDerivatives.source(entry, sam_size), directory, target_length)
+
+
+def run_embed(args):
+    # Use the loader of the labelling server, such that the same entries are found.
+    import server
+
+    sidecar = args.sidecar if args.sidecar is not None else args.dir
+    entries, _ = server.Data.data_loader(args.dir, sidecar, {"classes": []})
+    print(f"Found {len(entries)} entries.")
+
+    # Spawn the workers before the model is loaded, they only decode and resize.
+    pool = concurrent.futures.ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("spawn"))
+    segmenter = Segmenter(args.pth, device=args.device, threads=args.threads)
+    target_length = segmenter.sam.image_encoder.img_size
+
+    jobs = iter(entries)
+    pending = collections.deque()
+    batch = []
+    embedded = 0
+    skipped = 0
+    start = time.time()
+    while True:
+        # Keep the workers busy while the encoder runs.
+        while len(pending) < args.workers + 2 * args.batch:
+            entry = next(jobs, None)
+            if entry is None:
+                break
+            directory = os.path.join(os.path.dirname(entry.sidecar_path), EmbeddingCache.PRECOMPUTED_DIRECTORY)
+            pending.append(pool.submit(load_entry_for_encoder, entry, directory, target_length, args.sam_size))
+        if pending:
+            try:
+                loaded = pending.popleft().result()
+            except Exception as e:
+                print(f"Failed to load image: {e}")
+                loaded = None
+            if loaded is None:
+                skipped += 1
+            else:
+                batch.append(loaded)
+        if len(batch) >= args.batch or (batch and not pending):
+            segmenter.embed_batch(batch)
+            embedded += len(batch)
+            batch = []
+            duration = time.time() - start
+            print(f"Embedded {embedded}, skipped {skipped} of {len(entries)}, {embedded / duration:.2f} images/s")
+        if not pending and not batch:
+            break
+    pool.shutdown()
+    print(f"Done, embedded {embedded} and skipped {skipped} in {time.time() - start:.1f}s")
+
+
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="A segment anything backend.")
     parser.add_argument('--pth', help="The pth file to load, by default read from SAM_PTH, which currently is: %(default)s", default=os.environ.get("SAM_PTH"))
 
+    parser.add_argument('--device', help="The device to run the model on, defaults to %(default)s.", choices=["auto", "cpu", "cuda"], default="auto")
+    parser.add_argument('--threads', type=int, help="Number of threads torch uses, 0 for the torch default, defaults to %(default)s.", default=0)
+    parser.add_argument('--decoder', help="Implementation of the decoder that runs on every click, defaults to %(default)s.", choices=Segmenter.DECODERS, default="torch")
+    parser.add_argument('--onnx-file', help="The exported onnx decoder, exported to the temporary directory if not given.", default=None)
+
     subparsers = parser.add_subparsers(dest="command")
 
     sam_parser = subparsers.add_parser('sam')
@@ -329,6 +1423,7 @@ if __name__ == "__main__":
     sam_parser.add_argument('point', help="The x,y of the point we're working on.", nargs="+")
     sam_parser.add_argument('--output', help="The output file, defaults to %(default)s.", default="/tmp/mask.png")
     sam_parser.add_argument('--ratio', type=float, help="The minimum ratio of the total surface area. Defaults to %(default)s.", default=0.0)
+    sam_parser.add_argument('--max-vertices', type=int, help="Simplify contours to at most this many points, 0 disables simplification. Defaults to %(default)s.", default=0)
     sam_parser.set_defaults(func=run_sam)
 
     host_parser = subparsers.add_parser('host')
@@ -340,8 +1435,26 @@ if __name__ == "__main__":
                         help="The interface on which to listen.",
                         type=str,
                         default="127.0.0.1")
+    host_parser.add_argument('--embedding-cache', type=int, help="Size in MiB of the in memory embedding cache, defaults to %(default)s.", default=1024)
+    host_parser.add_argument('--embedding-dir', help="Directory to store embeddings in, such that they survive restarts, disabled by default.", default=None)
+    host_parser.add_argument('--precomputed', help="Folder to search for embeddings created with embed, usually the sidecar folder, disabled by default.", default=None)
+    host_parser.add_argument('--queue-size', type=int, help="Number of queued requests before responding with 429, defaults to %(default)s.", default=32)
+    host_parser.add_argument('--max-batch', type=int, help="Maximum number of requests for the same image passed to the decoder at once, defaults to %(default)s.", default=8)
+    host_parser.add_argument('--workers', type=int, help="Number of processes that each run the model, requests are divided by image, defaults to %(default)s.", default=1)
+    host_parser.add_argument('--job-timeout', type=float, help="Seconds to wait for the model before responding with 503, defaults to %(default)s.", default=60.0)
+    host_parser.add_argument('--profile-slow', type=float, help="Write a cProfile profile of requests that take longer than this many seconds, 0 disables profiling, defaults to %(default)s.", default=0.0)
+    host_parser.add_argument('--profile-rate', type=float, help="Fraction of the requests that is profiled if --profile-slow is set, defaults to %(default)s.", default=0.1)
+    host_parser.add_argument('--profile-dir', help="Folder the profiles of slow requests are written to, defaults to a folder in the temporary directory.", default=None)
     host_parser.set_defaults(func=run_host)
 
+    embed_parser = subparsers.add_parser('embed')
+    embed_parser.add_argument('--dir', '-d', help="Folder which holds the to be labelled data.", type=str, default=os.path.join(curdir, "..", "label_test"))
+    embed_parser.add_argument('--sidecar', '-s', help="Folder where the sidecar files are, embeddings are written next to them, defaults to '--dir'.", default=None)
+    embed_parser.add_argument('--batch', type=int, help="Number of images passed through the encoder at once, defaults to %(default)s.", default=4)
+    embed_parser.add_argument('--workers', type=int, help="Number of processes decoding and resizing images, defaults to %(default)s.", default=4)
+    embed_parser.add_argument('--sam-size', type=int, help="The --sam-size of server.py, larger images are embedded from the same downscaled image the frontend sends, defaults to %(default)s.", default=1024)
+    embed_parser.set_defaults(func=run_embed)
+
     args = parser.parse_args()
 
     # no command
@@ -19,14 +19,43 @@
 # SOFTWARE.
 
 import cherrypy
+import cherrypy.lib.static
 import os
 import sys
 import json
-import glob
 import yaml
 import copy
 import argparse
-import io
+import collections
+import contextlib
+import concurrent.futures
+import multiprocessing
+import math
+import time
+import shutil
+import threading
+import select
+import struct
+import errno
+import ctypes
+import ctypes.util
+import bisect
+import gzip
+import array
+import itertools
+
+from metrics import Metrics, MetricsTool
+
+try:
+    import PIL.Image
+    import PIL.ImageDraw
+except ImportError:
+    PIL = None  # Tiled images and exporting are only available if Pillow is installed.
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Responses are compressed with gzip only.
 
 
 curdir = os.path.join(os.getcwd(), os.path.dirname(__file__)) 
@@ -42,22 +71,75 @@ def extend_dict(extend_me, extend_by):
     else:
         extend_me += extend_by
 
+class ConfigStore:
+    """
+        Holds every distinct configuration once, entries refer to their configuration by its index in this store.
+        The json serialization of each configuration is created once and reused for every entry_info request.
+    """
+    def __init__(self):
+        self.configs = []
+        self.serialized = []
+        self.ids = {}  # canonical json -> id
+        self.lock = threading.Lock()
+
+    def add(self, config):
+        """Adds a configuration if an identical one isn't present yet, returns the id of the configuration."""
+        canonical = json.dumps(config, sort_keys=True)
+        with self.lock:
+            config_id = self.ids.get(canonical)
+            if config_id is None:
+                config_id = len(self.configs)
+                self.configs.append(config)
+                self.serialized.append(json.dumps(config))
+                self.ids[canonical] = config_id
+            return config_id
+
+    def get(self, config_id):
+        return self.configs[config_id]
+
+    def get_json(self, config_id):
+        """Returns the json representation of this configuration."""
+        return self.serialized[config_id]
+
+
 class Image:
     """
-        Simple class to represent a single image.
+        Simple class to represent a single image, there can be millions of these so it only holds the paths and
+        refers to its configuration by id, see ConfigStore.
     """
-    def __init__(self, path, sidecar_path, config):
-        """Initialise an image given the path and the configuration that was created for this entry."""
-        self.config = config
+    __slots__ = ("path", "sidecar_path", "config_id", "mtime", "labelled", "location")
+
+    def __init__(self, path, sidecar_path, config_id, mtime=None, labelled=False, location=None):
+        """Initialise an image given the path and the id of the configuration that was created for this entry."""
+        self.config_id = config_id
         self.path = path
-        self.data_path = sidecar_path[0:sidecar_path.rindex(".")] + ".json"
+        self.sidecar_path = sidecar_path
+        self.mtime = mtime
+        self.labelled = labelled
+        self.location = location  # location in the DataIndex.
+
+    @staticmethod
+    def sidecar_json(sidecar_path):
+        """Returns the path of the json file holding the features for an image."""
+        return sidecar_path[0:sidecar_path.rindex(".")] + ".json"
+
+    @property
+    def data_path(self):
+        return Image.sidecar_json(self.sidecar_path)
+
+    @property
+    def log_path(self):
+        """Path of the log holding operations on the features that are not yet in the sidecar json."""
+        data_path = self.data_path
+        return os.path.join(os.path.dirname(data_path), "." + os.path.basename(data_path) + ".log")
 
     def __repr__(self):
-        return "<{} - ({})>".format(self.path, ", ".join([x["label"] for x in self.config["classes"]]))
+        return "<{} - (config {})>".format(self.path, self.config_id)
 
-    def get_info(self):
-        """Return a dictionary representing the information about this image."""
-        return {"path":self.path, "config":self.config}
+    def get_info(self, configs):
+        """Return the json representation of the information about this image."""
+        return '{{"path": {}, "config_id": {}, "config": {}}}'.format(json.dumps(self.path), self.config_id,
+                                                                     configs.get_json(self.config_id))
 
     def get_mime(self):
         mimes = {
@@ -73,11 +155,20 @@ class Image:
             return f.read()
 
     def save_features(self, features):
-        """Write the features for this image to the disk."""
-        directory_name = os.path.dirname(self.data_path)
+        """
+            Write the features for this image to the disk. The features are written to a temporary file which
+            replaces the sidecar, so the sidecar is never left half written.
+        """
+        data_path = self.data_path
+        directory_name = os.path.dirname(data_path)
         os.makedirs(directory_name, exist_ok=True)
-        with open(self.data_path, "w") as f:
+        tmp_path = os.path.join(directory_name, "." + os.path.basename(data_path) + ".tmp")
+        with open(tmp_path, "w") as f:
             json.dump(features, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, data_path)
+        self.labelled = True
 
     def get_features(self):
         """Attempt to get the features for this image from the disk."""
@@ -94,84 +185,1865 @@ class Image:
     def __lt__(self, a):
         return self.path < a.path
 
-class Data:
-    def __init__(self, data_path, sidecar_path):
+class DataIndex:
+    """
+        Index of the data folder, holds one record per directory with the scan result of that directory. The index
+        can be stored in the sidecar folder, on the next start only directories whose modification times changed are
+        scanned again.
+    """
+    DIRECTORY = ".labelling_tool"
+    FILENAME = "index.json"
+    VERSION = 1
+
+    def __init__(self, data_path, sidecar_path, threads=8, persistent=True):
         self.data_path = data_path
         self.sidecar_path = sidecar_path
-        self.update_data()
+        self.threads = threads
+        self.index_path = os.path.join(sidecar_path, DataIndex.DIRECTORY, DataIndex.FILENAME) if persistent else None
+        self.records = {}  # relative directory -> record.
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
 
     @staticmethod
-    def data_loader(data_path, sidecar_path, context):
+    def scan_directory(data_path, sidecar_path):
         """
-            Recursive functions that combines yaml files from each directory into one context that specifies classes.
-            If it encounters a data file it creates an Image object with the current context.
+            Performs a single non-recursive scan of one directory and returns the record for it. The record holds the
+            data files (sorted) with their mtimes and whether they are labelled, the subdirectory names (sorted), the
+            parsed yaml documents from the sidecar directory and the contents of csv files. This does not touch any
+            state, so it can safely be called from multiple threads.
         """
-        entries = []
-        print(f"loading data {data_path}  sidecar: {sidecar_path}")
+        record = {"mtime": DataIndex.mtime(data_path), "sidecar_mtime": DataIndex.mtime(sidecar_path),
+                  "files": [], "mtimes": [], "labelled": [], "subdirs": [], "yaml_mtimes": {}, "yamls": [],
+                  "lists": {}}
+        files = []
+        try:
+            with os.scandir(data_path) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        record["subdirs"].append(entry.name)
+                    elif "." in entry.name:
+                        files.append(entry)
+        except OSError as e:
+            print("Failed scanning {}: {}".format(data_path, e))
+        record["subdirs"].sort()
 
-        # first, we parse the yaml files in the sidecar directories.
-        yamlfiles = glob.glob(os.path.join(sidecar_path, "*.yaml"))
-        for yaml_fname in yamlfiles:
-            print("Yamlfile: {}".format(yaml_fname))
-            yaml_path = os.path.join(yaml_fname)
+        sidecar_names = set()
+        try:
+            with os.scandir(sidecar_path) as it:
+                sidecar_names = set(e.name for e in it if not e.name.startswith("."))
+        except OSError:
+            pass  # a sidecar directory doesn't need to exist.
+
+        for yaml_fname in sorted(n for n in sidecar_names if n.endswith(".yaml")):
+            yaml_path = os.path.join(sidecar_path, yaml_fname)
+            print("Yamlfile: {}".format(yaml_path))
+            record["yaml_mtimes"][yaml_fname] = DataIndex.mtime(yaml_path)
             with open(yaml_path, 'r') as f:
                 try:
-                    # we combine the current context with the yaml we load.
-                    extend_dict(context, yaml.safe_load(f))
+                    record["yamls"].append(yaml.safe_load(f))
                 except yaml.YAMLError as exc:
-                    print("Failed parsing {}: {}".format(yaml_path, selfexc))
+                    print("Failed parsing {}: {}".format(yaml_path, exc))
 
-        # then we parse the data files in this directory.
-        for content_fname in sorted(glob.glob(os.path.join(data_path, "*.*"))):
-            relative = os.path.relpath(content_fname, data_path)
-            if (content_fname.endswith("yaml") or content_fname.endswith("json")):
+        for entry in sorted(files, key=lambda e: e.name):
+            if (entry.name.endswith("yaml") or entry.name.endswith("json")):
                 continue
             # csv files contain a list of paths to image files to be loaded
-            elif content_fname.endswith("csv"):
-                with open(os.path.join(content_fname), 'r') as list_file:
-                    for filename in list_file:
-                        entries.append(Image(filename.strip(), filename.strip(), context))
+            elif entry.name.endswith("csv"):
+                with open(entry.path, 'r') as list_file:
+                    paths = [filename.strip() for filename in list_file]
+                record["lists"][entry.name] = {"mtime": entry.stat().st_mtime, "paths": paths,
+                    "mtimes": [DataIndex.mtime(x) for x in paths],
+                    "labelled": [int(os.path.isfile(Image.sidecar_json(x))) for x in paths]}
+                record["files"].append(entry.name)
+                record["mtimes"].append(entry.stat().st_mtime)
+                record["labelled"].append(0)
             else:
-                image_sidecar_path = os.path.join(sidecar_path, relative)
-                entries.append(Image(content_fname, image_sidecar_path, context))
-
-        # finally, we iterate down, copying the context.
-        for root, dirs, files in os.walk(data_path):
-            for d in sorted(dirs):
-                combined = os.path.join(root, d)
-                relative = os.path.relpath(combined, data_path)
-                final_sidecar = os.path.join(sidecar_path, relative)
-                entries.extend(Data.data_loader(combined, final_sidecar, copy.deepcopy(context)))
+                record["files"].append(entry.name)
+                record["mtimes"].append(entry.stat().st_mtime)
+                json_name = os.path.basename(Image.sidecar_json(entry.name))
+                record["labelled"].append(int(json_name in sidecar_names))
+        return record
+
+    @staticmethod
+    def check_directory(data_path, sidecar_path, record):
+        """Returns the record if the directory is unchanged since it was created, otherwise rescans it."""
+        if record is not None and record["mtime"] == DataIndex.mtime(data_path) and \
+           record["sidecar_mtime"] == DataIndex.mtime(sidecar_path) and \
+           all(DataIndex.mtime(os.path.join(sidecar_path, k)) == v for k, v in record["yaml_mtimes"].items()) and \
+           all(DataIndex.mtime(os.path.join(data_path, k)) == v["mtime"] for k, v in record["lists"].items()):
+            return record, False
+        return DataIndex.scan_directory(data_path, sidecar_path), True
+
+    def load(self):
+        """Loads the index from the sidecar folder, if it exists and is compatible."""
+        if self.index_path is None:
+            return False
+        # Create the directory now, such that writing the index doesn't modify the mtime of the sidecar folder.
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        except OSError as e:
+            print("Can't create index directory, not persisting the index: {}".format(e))
+            self.index_path = None
+            return False
+        if not os.path.isfile(self.index_path):
+            return False
+        try:
+            with open(self.index_path, "r") as f:
+                stored = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            print("Failed to read index {}: {}".format(self.index_path, e))
+            return False
+        if stored.get("version") != DataIndex.VERSION:
+            return False
+        self.records = stored["directories"]
+        return True
+
+    def save(self):
+        """Atomically writes the index to the sidecar folder."""
+        if self.index_path is None:
+            return
+        with self.lock:
+            content = json.dumps({"version": DataIndex.VERSION, "directories": self.records},
+                                 separators=(",", ":"))
+            self.dirty = False
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, self.index_path)
+
+    def flush(self):
+        """Writes the index if it was modified since the last write."""
+        if self.dirty:
+            self.save()
+
+    def refresh(self, changed=None):
+        """
+            Walks the directory tree, directories are checked in parallel by a thread pool, only the directories that
+            changed since the index was created are scanned again. If a set of changed relative directories is given
+            only those are scanned and the other known directories are trusted without checking their mtimes.
+            Returns the set of directories that were rescanned or removed.
+        """
+        records = {}
+        rescanned = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.threads)) as pool:
+            def submit(relative):
+                data_dir = os.path.normpath(os.path.join(self.data_path, relative))
+                sidecar_dir = os.path.normpath(os.path.join(self.sidecar_path, relative))
+                record = self.records.get(relative)
+                if changed is not None:
+                    if record is not None and relative not in changed:
+                        future = concurrent.futures.Future()
+                        future.set_result((record, False))
+                        return future
+                    record = None  # force a rescan.
+                return pool.submit(DataIndex.check_directory, data_dir, sidecar_dir, record)
+
+            pending = {submit("."): "."}
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    relative = pending.pop(future)
+                    records[relative], scanned = future.result()
+                    if scanned:
+                        rescanned.add(relative)
+                    for d in records[relative]["subdirs"]:
+                        child = os.path.normpath(os.path.join(relative, d))
+                        pending[submit(child)] = child
+
+        rescanned |= self.records.keys() - records.keys()  # removed directories are changes too.
+        with self.lock:
+            self.dirty = self.dirty or bool(rescanned)
+            self.records = records
+        return rescanned
+
+    def entries(self, context, configs, directories=None):
+        """
+            Assembles the entries from the records, combining the yaml files from each directory into a context that
+            specifies the classes, this context propagates down to subdirectories. The entries are in depth first
+            order; data files in a directory first, then its subdirectories. Directories without yaml files share
+            the context object of their parent. The contexts are added to the config store, the entries hold
+            the id of their context. If a set of relative directories is given only the entries of those are
+            created, the contexts are still assembled from all directories.
+        """
+        entries = []
+        # Iteratively, to avoid recursion limits on deep trees.
+        stack = [(".", context, configs.add(context))]
+        while stack:
+            relative, current_context, config_id = stack.pop()
+            record = self.records[relative]
+            current_data = os.path.normpath(os.path.join(self.data_path, relative))
+            current_sidecar = os.path.normpath(os.path.join(self.sidecar_path, relative))
+
+            if record["yamls"]:
+                # we combine the parent context with the yaml files from this directory.
+                current_context = copy.deepcopy(current_context)
+                for loaded in record["yamls"]:
+                    # copy, such that extending the context can't modify the records.
+                    extend_dict(current_context, copy.deepcopy(loaded))
+                config_id = configs.add(current_context)
+
+            # then we create the data files in this directory.
+            files = record["files"] if directories is None or relative in directories else []
+            for i, content_name in enumerate(files):
+                if content_name in record["lists"]:
+                    listed = record["lists"][content_name]
+                    for j, filename in enumerate(listed["paths"]):
+                        entries.append(Image(filename, filename, config_id, listed["mtimes"][j],
+                                             bool(listed["labelled"][j]), (relative, content_name, j)))
+                else:
+                    path = os.path.join(current_data, content_name)
+                    # Share the string if the sidecar is in the data directory.
+                    sidecar = path if current_data == current_sidecar else os.path.join(current_sidecar, content_name)
+                    entries.append(Image(path, sidecar, config_id, record["mtimes"][i], bool(record["labelled"][i]),
+                                         (relative, None, i)))
+
+            # finally, we iterate down, in reverse as the stack pops from the back.
+            for d in reversed(record["subdirs"]):
+                stack.append((os.path.normpath(os.path.join(relative, d)), current_context, config_id))
         return entries
 
+    def directory_mtimes(self, location):
+        """
+            Returns the current mtimes of the data and sidecar directory holding the entry at this location, as well
+            as those of its parents that change if the sidecar directory is created, by relative directory.
+        """
+        relative = location[0]
+        mtimes = {}
+        while True:
+            sidecar_dir = os.path.join(self.sidecar_path, relative)
+            mtimes[relative] = (DataIndex.mtime(os.path.join(self.data_path, relative)), DataIndex.mtime(sidecar_dir))
+            if relative == "." or os.path.isdir(sidecar_dir):
+                return mtimes
+            relative = os.path.normpath(os.path.dirname(relative))
+
+    def wrote(self, location, before, labelled=False):
+        """
+            Records a write of this process to the directory of the entry at this location, with labelled the entry
+            is marked as labelled. For each directory whose mtimes the write changed, if the mtimes from before the
+            write, `before` as returned by directory_mtimes, still equal the stored ones those advance to the current
+            mtimes, such that the write doesn't cause a rescan. Otherwise something else changed in the directory as
+            well and True is returned, it has to be scanned again.
+        """
+        relative, list_name, position = location
+        record = self.records.get(relative)
+        if record is None:
+            return False  # directory was removed in the meantime.
+        changed = False
+        with self.lock:
+            if labelled:
+                flags = record["labelled"] if list_name is None else record["lists"][list_name]["labelled"]
+                if not flags[position]:
+                    flags[position] = 1
+                    self.dirty = True
+            if list_name is not None:
+                return False  # the sidecars of listed files are elsewhere.
+            for directory, previous in before.items():
+                record = self.records.get(directory)
+                data_dir = os.path.join(self.data_path, directory)
+                sidecar_dir = os.path.join(self.sidecar_path, directory)
+                after = (DataIndex.mtime(data_dir), DataIndex.mtime(sidecar_dir))
+                if record is None or after == previous:
+                    continue
+                # Writes of this process only change the data directory if the sidecars are stored next to the data.
+                if previous != (record["mtime"], record["sidecar_mtime"]) or \
+                   (after[0] != previous[0] and data_dir != sidecar_dir):
+                    changed = True
+                    continue
+                record["mtime"], record["sidecar_mtime"] = after
+                self.dirty = True
+        return changed
+
+
+tile_progress = None  # queue on which the worker processes of TilePyramids report completed levels.
+
+
+def init_tile_worker(progress):
+    global tile_progress
+    tile_progress = progress
+
+
+def write_tile_level(img, level_dir, tile_size, version):
+    """
+        Writes the tiles of one level, tiles at the edges are padded with transparency, and marks it as done with
+        the version of the image it was created from.
+    """
+    os.makedirs(level_dir, exist_ok=True)
+    for y in range(math.ceil(img.height / tile_size)):
+        for x in range(math.ceil(img.width / tile_size)):
+            tile = img.crop((x * tile_size, y * tile_size, min((x + 1) * tile_size, img.width),
+                             min((y + 1) * tile_size, img.height)))
+            if tile.size != (tile_size, tile_size):
+                padded = PIL.Image.new("RGBA", (tile_size, tile_size), (0, 0, 0, 0))
+                padded.paste(tile, (0, 0))
+                tile = padded
+            tile.save(os.path.join(level_dir, "{}_{}.png".format(x, y)))
+    with open(os.path.join(level_dir, ".done"), "w") as f:
+        json.dump({"version": list(version)}, f)
+
+
+def build_tile_pyramid(image_path, tile_dir, tile_size, version):
+    """
+        Creates the tiles for all zoom levels of an image, runs in a worker process. Level 0 fits the image in a
+        single tile, the highest level is the full resolution. Tiles are stored as tile_dir/z/x_y.png, a level is
+        complete when its .done file holds the version of the image and is reported on tile_progress. The levels
+        up to COARSE_SIZE pixels are reduced from the image at once and written first, such that an overview is
+        available quickly. The other levels are written from high to low resolution, each is reduced from the
+        previous one which is then released. The meta.json file is written last, its presence marks completion of
+        the pyramid.
+    """
+    PIL.Image.MAX_IMAGE_PIXELS = None  # these images are large by definition.
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    with PIL.Image.open(image_path) as source:
+        alpha = source.mode in ("RGBA", "RGBa", "LA", "La", "PA") or "transparency" in source.info
+        img = source.convert("RGBA" if alpha else "RGB")
+    width, height = img.size
+    levels = TilePyramids.levels(width, height, tile_size)
+    top = levels - 1
+
+    def written(z):
+        if tile_progress is not None:
+            tile_progress.put((tile_dir, z))
+
+    # Level 0 fits in a tile, so there is at least one coarse level.
+    coarse = max(z for z in range(levels) if max(width, height) / 2 ** (top - z) <= TilePyramids.COARSE_SIZE)
+    images = [img.reduce(2 ** (top - coarse)) if coarse < top else img]
+    for z in range(coarse):
+        images.append(images[-1].reduce(2))
+    for z, level in enumerate(reversed(images)):
+        write_tile_level(level, os.path.join(tile_dir, str(z)), tile_size, version)
+        written(z)
+    del images
+
+    level = img
+    del img
+    for z in range(top, coarse, -1):
+        write_tile_level(level, os.path.join(tile_dir, str(z)), tile_size, version)
+        written(z)
+        level = level.reduce(2) if z - 1 > coarse else None
+
+    meta = {"version": list(version), "width": width, "height": height, "tile_size": tile_size, "levels": levels}
+    tmp_path = os.path.join(tile_dir, "meta.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(tile_dir, "meta.json"))
+    return meta
+
+
+class TilePyramids:
+    """
+        Creates and tracks tile pyramids for large images, such that the frontend only needs to retrieve the tiles
+        in view. Pyramids are created on first use by a process pool and stored in the sidecar directory. Requests
+        for a tile of a pyramid in progress wait until its level is written, at most WAIT_TIMEOUT seconds.
+    """
+    COARSE_SIZE = 2048
+    WAIT_TIMEOUT = 30.0
+
+    def __init__(self, threshold=4096, workers=2, tile_size=256, prepare=None):
+        self.threshold = threshold
+        self.workers = workers
+        self.tile_size = tile_size
+        self.prepare = prepare  # called with the entry before its pyramid is created.
+        self.pool = None
+        self.progress = None  # levels written by the worker processes, as (tile dir, level)
+        self.listener = None
+        self.pending = {}  # tile dir -> future
+        self.completed = {}  # tile dir -> levels written of a pyramid in progress
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+    @staticmethod
+    def levels(width, height, tile_size):
+        """Returns the number of zoom levels needed such that level 0 fits in one tile."""
+        return max(0, math.ceil(math.log2(max(width, height) / tile_size))) + 1
+
+    @staticmethod
+    def tile_dir(entry):
+        return os.path.join(os.path.dirname(entry.sidecar_path), DataIndex.DIRECTORY, "tiles",
+                            os.path.basename(entry.path))
+
+    @staticmethod
+    def read_meta(tile_dir, version):
+        """Returns the metadata of a complete pyramid for this version of the image, or None."""
+        try:
+            with open(os.path.join(tile_dir, "meta.json"), "r") as f:
+                meta = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            return None
+        return meta if meta["version"] == list(version) else None
+
+    @staticmethod
+    def level_done(level_dir, version):
+        """Returns whether the level is complete and was created from this version of the image."""
+        try:
+            with open(os.path.join(level_dir, ".done"), "r") as f:
+                return json.load(f)["version"] == list(version)
+        except (OSError, KeyError, TypeError, json.decoder.JSONDecodeError):
+            return False
+
+    def enabled(self):
+        return PIL is not None and self.threshold > 0
+
+    def info(self, entry):
+        """Returns whether the entry is tiled, and if so the dimensions of the pyramid. Starts creating it if needed."""
+        if not self.enabled():
+            return {"tiled": False}
+        version = Data.file_version(entry.path)
+        if version is None:
+            return {"tiled": False}
+        tile_dir = TilePyramids.tile_dir(entry)
+        meta = TilePyramids.read_meta(tile_dir, version)
+        if meta is None:
+            with PIL.Image.open(entry.path) as img:  # only reads the header.
+                width, height = img.size
+            if max(width, height) <= self.threshold:
+                return {"tiled": False}
+            self.submit(entry, tile_dir, version)
+            meta = {"width": width, "height": height, "tile_size": self.tile_size,
+                    "levels": TilePyramids.levels(width, height, self.tile_size)}
+        return {"tiled": True, "width": meta["width"], "height": meta["height"], "tile_size": meta["tile_size"],
+                "levels": meta["levels"]}
+
+    def submit(self, entry, tile_dir, version):
+        """Submits the creation of a pyramid if it isn't in progress, returns the future."""
+        with self.lock:
+            future = self.pending.get(tile_dir)
+            if future is None:
+                if self.pool is None:
+                    self.progress = multiprocessing.Queue()
+                    self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, self.workers),
+                                                                       initializer=init_tile_worker,
+                                                                       initargs=(self.progress,))
+                    self.listener = threading.Thread(target=self.listen, name="TileProgress", daemon=True)
+                    self.listener.start()
+                if self.prepare is not None:
+                    self.prepare(entry)
+                future = self.pool.submit(build_tile_pyramid, entry.path, tile_dir, self.tile_size, version)
+                self.pending[tile_dir] = future
+                future.add_done_callback(lambda f: self.done(tile_dir, f))
+            return future
+
+    def listen(self):
+        """Records the levels reported by the worker processes and wakes the requests waiting for them."""
+        while True:
+            written = self.progress.get()
+            if written is None:
+                return
+            tile_dir, z = written
+            with self.condition:
+                if tile_dir in self.pending:
+                    self.completed.setdefault(tile_dir, set()).add(z)
+                    self.condition.notify_all()
+
+    def done(self, tile_dir, future):
+        with self.condition:
+            self.pending.pop(tile_dir, None)
+            self.completed.pop(tile_dir, None)
+            self.condition.notify_all()
+        if future.exception() is not None:
+            print("Failed creating tiles in {}: {}".format(tile_dir, future.exception()))
+
+    def tile(self, entry, z, x, y):
+        """Returns the path to a tile, waits for its level to be created if necessary."""
+        version = Data.file_version(entry.path)
+        tile_dir = TilePyramids.tile_dir(entry)
+        z = int(z)
+        level_dir = os.path.join(tile_dir, str(z))
+        if version is None:
+            raise cherrypy.NotFound()
+        if TilePyramids.read_meta(tile_dir, version) is None and not TilePyramids.level_done(level_dir, version):
+            future = self.submit(entry, tile_dir, version)
+            # Levels of a pyramid in progress can be used once they are complete.
+            with self.condition:
+                ready = self.condition.wait_for(lambda: z in self.completed.get(tile_dir, ()) or future.done(),
+                                                timeout=TilePyramids.WAIT_TIMEOUT)
+            if not ready:
+                raise cherrypy.HTTPError(503, "The tiles of this image are being created, try again later.")
+            if future.done():
+                future.result()
+            if not TilePyramids.level_done(level_dir, version):
+                # Created from an older version of the image, the next request starts over.
+                raise cherrypy.HTTPError(503, "The tiles of this image are being created, try again later.")
+        return os.path.join(level_dir, "{}_{}.png".format(int(x), int(y)))
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.progress.put(None)
+            self.listener.join()
+
+
+def build_sam_derivative(image_path, path, longest_side, version):
+    """
+        Creates the RGB image that the SAM encoder sees, runs in a worker process. The image is resized such that
+        its longest side is longest_side, like the encoder does, and stored as a png next to a json file holding
+        the version of the original and the scale from derivative to original pixels, which is written last.
+    """
+    PIL.Image.MAX_IMAGE_PIXELS = None
+    with PIL.Image.open(image_path) as img:
+        width, height = img.size
+        # Same rounding as the ResizeLongestSide transform of the encoder.
+        factor = longest_side / max(width, height)
+        size = (int(width * factor + 0.5), int(height * factor + 0.5))
+        img.draft("RGB", size)  # lets jpeg decode at a lower resolution.
+        derivative = img.convert("RGB").resize(size, PIL.Image.BILINEAR)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    derivative.save(tmp_path, format="png")
+    os.replace(tmp_path, path + ".png")
+    meta = {"version": list(version), "longest_side": longest_side, "width": size[0], "height": size[1],
+            "original_width": width, "original_height": height, "scale": [width / size[0], height / size[1]]}
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path + ".json")
+    return meta
+
+
+class SamDerivatives:
+    """
+        Creates and tracks the images sent to the SAM backend, downscaled to the resolution of its encoder such that
+        less is uploaded and decoded for large images. Derivatives are created by a process pool and stored in the
+        sidecar directory. Once the frontend requested one, those of the prefetched entries are created as well.
+    """
+    def __init__(self, longest_side=1024, workers=2, prepare=None):
+        self.longest_side = longest_side
+        self.workers = workers
+        self.prepare = prepare  # called with the entry before its derivative is created.
+        self.pool = None
+        self.pending = {}  # derivative path -> future
+        self.lock = threading.Lock()
+        self.used = False
+
+    @staticmethod
+    def path(entry):
+        """Returns the path of the derivative without extension, the image is .png and its metadata .json."""
+        return os.path.join(os.path.dirname(entry.sidecar_path), DataIndex.DIRECTORY, "sam",
+                            os.path.basename(entry.path))
+
+    @staticmethod
+    def read_meta(path, version, longest_side):
+        """Returns the metadata of the derivative for this version of the image and size, or None."""
+        try:
+            with open(path + ".json", "r") as f:
+                meta = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            return None
+        if meta["version"] != list(version) or meta.get("longest_side") != longest_side:
+            return None
+        return meta
+
+    def enabled(self):
+        return PIL is not None and self.longest_side > 0
+
+    def needed(self, entry):
+        """Returns whether the image is larger than the encoder input, only reads the header."""
+        with PIL.Image.open(entry.path) as img:
+            return max(img.size) > self.longest_side
+
+    def submit(self, entry, path, version):
+        """Submits the creation of a derivative if it isn't in progress, returns the future."""
+        with self.lock:
+            future = self.pending.get(path)
+            if future is None:
+                if self.pool is None:
+                    self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, self.workers))
+                if self.prepare is not None:
+                    self.prepare(entry)
+                future = self.pool.submit(build_sam_derivative, entry.path, path, self.longest_side, version)
+                self.pending[path] = future
+                future.add_done_callback(lambda f: self.done(path, f))
+            return future
+
+    def done(self, path, future):
+        with self.lock:
+            self.pending.pop(path, None)
+        if future.exception() is not None:
+            print("Failed creating the SAM image {}: {}".format(path, future.exception()))
+
+    def warm(self, entry):
+        """Creates the derivative of an entry in the background, if the frontend uses them."""
+        if not self.used or not self.enabled():
+            return
+        version = Data.file_version(entry.path)
+        path = SamDerivatives.path(entry)
+        if version is not None and SamDerivatives.read_meta(path, version, self.longest_side) is None and self.needed(entry):
+            self.submit(entry, path, version)
+
+    @staticmethod
+    def source(entry, longest_side):
+        """
+            Returns the path of the image the frontend sends to the SAM backend for this entry, creating the
+            derivative in this process if it doesn't exist. Used by the embed command of the backend, such that
+            embeddings are stored by the hash of the same bytes that the frontend uploads.
+        """
+        version = Data.file_version(entry.path)
+        if version is None or PIL is None or longest_side <= 0:
+            return entry.path
+        path = SamDerivatives.path(entry)
+        if SamDerivatives.read_meta(path, version, longest_side) is None:
+            with PIL.Image.open(entry.path) as img:
+                if max(img.size) <= longest_side:
+                    return entry.path
+            build_sam_derivative(entry.path, path, longest_side, version)
+        return path + ".png"
+
+    def get(self, entry):
+        """
+            Returns (path, (scale x, scale y)) of the image to send to the SAM backend, that is the original image
+            if it isn't larger than the encoder input. Waits for the derivative to be created if necessary.
+        """
+        self.used = True
+        version = Data.file_version(entry.path)
+        if version is None:
+            raise cherrypy.NotFound()
+        if not self.enabled():
+            return entry.path, (1.0, 1.0)
+        path = SamDerivatives.path(entry)
+        meta = SamDerivatives.read_meta(path, version, self.longest_side)
+        if meta is None:
+            if not self.needed(entry):
+                return entry.path, (1.0, 1.0)
+            meta = self.submit(entry, path, version).result()
+        return path + ".png", tuple(meta["scale"])
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+
+class FeatureWriter:
+    """
+        Write-behind for the features of entries. Saves are held in memory for at most `delay` seconds, a newer
+        save for the same entry replaces the pending one, such that rapid edits result in a single write. A
+        background thread writes the features once their delay expired. The written callback is called with the
+        entry after its features are written.
+
+        Patches, operations on single features, are appended to a log next to the sidecar right away and applied
+        to the pending features. Writing the features compacts the log into the sidecar and removes the log.
+        Operations on features are idempotent, so replaying a log that was already compacted is harmless.
+
+        Features stay pending until their sidecar is replaced, a failed write is retried with an exponential backoff
+        of at most MAX_BACKOFF seconds and its error is returned by saves and patches of that entry until it succeeds.
+    """
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, delay=1.0, written=None, metrics=None, guard=None):
+        self.delay = delay
+        self.written = written
+        # Context manager wrapping every write to the sidecar directory of an entry, called with the entry and
+        # whether the write creates its sidecar.
+        self.guard = guard if guard is not None else (lambda entry, labelled: contextlib.nullcontext())
+        self.metrics = metrics if metrics is not None else Metrics("labelling_tool")
+        self.pending = {}  # sidecar json path -> (entry, features, deadline, logged)
+        self.failures = {}  # sidecar json path -> (number of failed writes, last error)
+        self.changes = 0  # number of saves and patches since the start, identifies the pending features.
+        self.versions = {}  # sidecar json path -> value of changes when its pending features were scheduled
+        self.condition = threading.Condition()
+        # Writing and patching a sidecar is serialised by one of these locks, selected by the sidecar path.
+        self.path_locks = [threading.Lock() for _ in range(64)]
+        self.stopping = False
+        self.writes = 0
+        self.saves = 0
+        self.patches = 0
+        self.thread = threading.Thread(target=self.run, name="FeatureWriter", daemon=True)
+        self.thread.start()
+
+    def path_lock(self, data_path):
+        return self.path_locks[hash(data_path) % len(self.path_locks)]
+
+    @staticmethod
+    def apply(features, ops):
+        """
+            Returns a new feature collection with the operations applied. An operation is either
+            {"op": "add" or "modify", "feature": feature}, which stores the feature by its id, or
+            {"op": "delete", "id": id}, which removes the feature with that id.
+        """
+        if features is None:
+            features = {"type": "FeatureCollection", "features": []}
+        result = list(features.get("features", []))
+        positions = {f.get("id"): i for i, f in enumerate(result)}
+        for op in ops:
+            if op["op"] in ("add", "modify"):
+                feature_id = op["feature"]["id"]
+                if positions.get(feature_id) is None:
+                    positions[feature_id] = len(result)
+                    result.append(op["feature"])
+                else:
+                    result[positions[feature_id]] = op["feature"]
+            elif op["op"] == "delete":
+                position = positions.pop(op["id"], None)
+                if position is not None:
+                    result[position] = None
+            else:
+                raise ValueError("Unknown operation {}".format(op["op"]))
+        return dict(features, features=[f for f in result if f is not None])
+
+    @staticmethod
+    def read_log(log_path):
+        """Returns the operations in a log, a partially written last line is ignored."""
+        ops = []
+        try:
+            with open(log_path, "r") as f:
+                for line in f:
+                    try:
+                        ops.append(json.loads(line))
+                    except json.decoder.JSONDecodeError:
+                        break
+        except FileNotFoundError:
+            pass
+        return ops
+
+    def schedule(self, entry, features, logged):
+        """Stores the pending features, must hold the path lock."""
+        with self.condition:
+            previous = self.pending.get(entry.data_path)
+            # Keep the deadline of the first unwritten save, that bounds the time until it is durable.
+            deadline = previous[2] if previous is not None else time.monotonic() + self.delay
+            logged = logged or (previous is not None and previous[3])
+            self.pending[entry.data_path] = (entry, features, deadline, logged)
+            self.changes += 1
+            self.versions[entry.data_path] = self.changes
+            self.condition.notify()
+
+    def submit(self, entry, features):
+        """
+            Schedules the features to be written, if the delay is zero they are written immediately. Returns the
+            error of the last failed write of this sidecar, None if it didn't fail.
+        """
+        with self.condition:
+            self.saves += 1
+        with self.path_lock(entry.data_path):
+            self.schedule(entry, features, os.path.isfile(entry.log_path))
+        if self.delay <= 0:
+            return self.write(entry.data_path)
+        return self.error(entry.data_path)
+
+    def patch(self, entry, ops, load):
+        """
+            Appends operations to the log of the entry and applies them to its features. The load function is
+            called to retrieve the current features if none are pending. Returns the resulting features and the
+            error of the last failed write of this sidecar, see submit.
+        """
+        with self.condition:
+            self.patches += 1
+        with self.path_lock(entry.data_path):
+            pending, features = self.get(entry.data_path)
+            if not pending:
+                features = load()
+            features = FeatureWriter.apply(features, ops)
+            with self.guard(entry, False), self.metrics.span("feature_log"):
+                os.makedirs(os.path.dirname(entry.log_path), exist_ok=True)
+                with open(entry.log_path, "a") as f:
+                    f.write("".join(json.dumps(op) + "\n" for op in ops))
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.schedule(entry, features, True)
+        if self.delay <= 0:
+            return features, self.write(entry.data_path)
+        return features, self.error(entry.data_path)
+
+    def get(self, data_path):
+        """Returns (True, features) if features are pending for this sidecar, (False, None) otherwise."""
+        with self.condition:
+            pending = self.pending.get(data_path)
+        if pending is None:
+            return False, None
+        return True, pending[1]
+
+    def version(self, data_path):
+        """Returns a number that changes with every save or patch of the pending features, None if none are pending."""
+        with self.condition:
+            return self.versions.get(data_path)
+
+    def error(self, data_path):
+        """Returns the error of the last failed write of this sidecar, None if it didn't fail."""
+        with self.condition:
+            return self.failures.get(data_path, (0, None))[1]
+
+    def write(self, data_path):
+        """
+            Writes the pending features of this sidecar, compacting its log. The features are only removed from the
+            pending ones once the sidecar is replaced, if that fails the write is retried later. Returns the error if
+            the write failed, None otherwise.
+        """
+        with self.path_lock(data_path):
+            # Holding the path lock, so the pending features of this sidecar can't change while writing them.
+            with self.condition:
+                pending = self.pending.get(data_path)
+            if pending is None:
+                return None
+            entry, features, _, logged = pending
+            try:
+                with self.guard(entry, True):
+                    with self.metrics.span("feature_save"):
+                        entry.save_features(features)
+                    if logged:
+                        os.remove(entry.log_path)
+            except OSError as e:
+                error = "Failed to write features of {}: {}".format(entry.path, e)
+                print(error)
+                with self.condition:
+                    failed = self.failures.get(data_path, (0, None))[0] + 1
+                    self.failures[data_path] = (failed, error)
+                    backoff = min(max(self.delay, 0.5) * 2 ** failed, FeatureWriter.MAX_BACKOFF)
+                    self.pending[data_path] = (entry, features, time.monotonic() + backoff, logged)
+                    self.condition.notify()
+                return error
+            with self.condition:
+                self.pending.pop(data_path)
+                self.versions.pop(data_path, None)
+                self.failures.pop(data_path, None)
+                self.writes += 1
+        if self.written is not None:
+            self.written(entry)
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopping:
+                    now = time.monotonic()
+                    due = [k for k, v in self.pending.items() if v[2] <= now]
+                    if due:
+                        break
+                    timeout = min((v[2] for v in self.pending.values()), default=now + 60.0) - now
+                    self.condition.wait(timeout)
+                if self.stopping:
+                    return
+            # A save that arrives while writing is written later.
+            for data_path in due:
+                self.write(data_path)
+
+    def flush(self):
+        """Writes all pending features now, returns the errors of the sidecars that failed to write by path."""
+        with self.condition:
+            paths = list(self.pending.keys())
+        errors = {}
+        for data_path in paths:
+            error = self.write(data_path)
+            if error is not None:
+                errors[data_path] = error
+        return errors
+
+    def stop(self):
+        """Stops the writer thread and writes all pending features, returns the errors as flush does."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+        return self.flush()
+
+    def stats(self):
+        with self.condition:
+            return {"pending": len(self.pending), "saves": self.saves, "patches": self.patches,
+                    "writes": self.writes, "failed": len(self.failures)}
+
+
+class LRUCache:
+    """
+        Thread safe least recently used cache, bounded by the total size in bytes of the values it holds. Values are
+        stored with a version, a lookup only succeeds if the version matches; for files this is their mtime and size.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.values = collections.OrderedDict()  # key -> (version, value, size)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        """Returns the value stored for this key and version, or None."""
+        with self.lock:
+            stored = self.values.get(key)
+            if stored is None or stored[0] != version:
+                self.misses += 1
+                return None
+            self.values.move_to_end(key)
+            self.hits += 1
+            return stored[1]
+
+    def contains(self, key, version):
+        with self.lock:
+            return key in self.values and self.values[key][0] == version
+
+    def put(self, key, version, value, size):
+        """Stores a value, evicting the least recently used values to stay within the size limit."""
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.discard_locked(key)
+            self.values[key] = (version, value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted_size) = self.values.popitem(last=False)
+                self.size -= evicted_size
+
+    def discard(self, key):
+        with self.lock:
+            self.discard_locked(key)
+
+    def discard_locked(self, key):
+        stored = self.values.pop(key, None)
+        if stored is not None:
+            self.size -= stored[2]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.values), "bytes": self.size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+class Data:
+    def __init__(self, data_path, sidecar_path, loader_threads=8, persistent_index=True, cache_bytes=256 * 2**20,
+                 prefetch=3, prefetch_threads=4, tile_threshold=4096, tile_workers=2, save_delay=1.0, stats_workers=4,
+                 sam_size=1024, sam_workers=2):
+        self.data_path = data_path
+        self.sidecar_path = sidecar_path
+        self.index = DataIndex(data_path, sidecar_path, loader_threads, persistent_index)
+        self.index.load()
+        self.entries = []
+        self.configs = ConfigStore()
+        self.generation = 0  # incremented whenever the entries change.
+        self.lock = threading.Lock()
+        self.cache = LRUCache(cache_bytes)  # holds image bytes and parsed features of entries.
+        self.prefetch_count = prefetch
+        self.prefetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, prefetch_threads))
+        self.prefetching = set()  # entries currently being read by the prefetch pool.
+        self.tiles = TilePyramids(tile_threshold, tile_workers, prepare=self.tool_directory)
+        self.derivatives = SamDerivatives(sam_size, sam_workers, prepare=self.tool_directory)
+        self.metrics = Metrics("labelling_tool")
+        self.writer = FeatureWriter(save_delay, None, self.metrics, self.own_write)
+        self.positions = {}  # path -> index of the entry.
+        self.directory_entries = collections.defaultdict(set)  # relative directory -> indices of its entries.
+        self.started = time.time_ns()
+        self.labels = LabelStats(stats_workers)
+        self.update_data()
+
+    @staticmethod
+    def data_loader(data_path, sidecar_path, context, threads=8):
+        """
+            Walks the data directory once and returns the entries and the config store they refer to, without using
+            a persistent index.
+        """
+        index = DataIndex(data_path, sidecar_path, threads, persistent=False)
+        index.refresh()
+        configs = ConfigStore()
+        return index.entries(context, configs), configs
 
     def data_extent(self):
         """Returns information about the extent of the data."""
-        return {"entries":len(self.entries)}
+        return {"entries":len(self.entries), "generation":self.generation}
 
-    def update_data(self):
-        """Updates the data object by traversing through the path again in search of yaml and data files."""
-        self.entries = self.data_loader(self.data_path, self.sidecar_path, {"classes":[]})
-        print("Entries:")
-        for index, img in enumerate(self.entries):
-            print("{: >5d} {}".format(index, img))
+    def update_data(self, changed=None):
+        """
+            Updates the data object by traversing through the path again in search of yaml and data files, only
+            directories that changed are scanned again, see DataIndex.refresh. Only the entries of those directories
+            are created again, unless the yaml files of one of them changed, which affects the directories below it.
+            Existing entries keep their index; they are updated in place, new entries are appended and removed
+            entries are kept. The generation only increments if entries were added, removed or changed config.
+        """
+        with self.lock:
+            previous = self.index.records
+            rescanned = self.index.refresh(changed)
+            if not rescanned and self.entries:
+                return
+            records = self.index.records
+            directories = rescanned
+            if not self.entries or any(r in previous and r in records and previous[r]["yamls"] != records[r]["yamls"]
+                                       for r in rescanned):
+                directories = None
+            entries = self.index.entries({"classes":[]}, self.configs, directories)
+            if directories is None:
+                stale = range(len(self.entries))
+            else:
+                stale = [i for r in rescanned for i in self.directory_entries.get(r, ())]
+            start = len(self.entries)
+            modified = False
+            found = set()
+            for entry in entries:
+                index = self.positions.get(entry.path)
+                found.add(entry.path)
+                if index is None:
+                    index = len(self.entries)
+                    self.positions[entry.path] = index
+                    self.entries.append(entry)
+                else:
+                    old = self.entries[index]
+                    modified = modified or old.location is None or old.config_id != entry.config_id
+                    if old.location is not None:
+                        self.directory_entries[old.location[0]].discard(index)
+                    self.entries[index] = entry
+                self.directory_entries[entry.location[0]].add(index)
+            for index in stale:
+                entry = self.entries[index]
+                if entry.path not in found and entry.location is not None:
+                    self.directory_entries[entry.location[0]].discard(index)
+                    entry.location = None
+                    modified = True
+            for relative in rescanned - records.keys():
+                self.directory_entries.pop(relative, None)
+            if modified or len(self.entries) > start:
+                self.generation += 1
+            self.labels.add_entries(self.entries, start)
+            print("Rescanned {} of {} directories, {} entries.".format(len(rescanned), len(records),
+                                                                       len(self.entries)))
+        self.index.flush()
 
     def entry_info(self, index):
-        """Returns the info from a specific entry."""
-        return self.entries[index].get_info()
+        """Returns the info from a specific entry, as json."""
+        return self.entries[index].get_info(self.configs)
 
     def entry_data(self, index):
         """Gets the mimetype and the data for the given entry."""
         entry = self.entries[index]
         return entry.get_mime(), entry.get_data()
 
+    def entry_file(self, index):
+        """Gets the mimetype and the path of the file for the given entry."""
+        entry = self.entries[index]
+        return entry.get_mime(), entry.path
+
+    @staticmethod
+    def file_version(path):
+        """Returns the version of a file as used in the cache, None if it doesn't exist."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def cached_data(self, index, version):
+        """Returns the image bytes for this entry if they are in the cache, None otherwise."""
+        return self.cache.get(("data", self.entries[index].path), version)
+
+    @contextlib.contextmanager
+    def own_write(self, entry, labelled=False):
+        """
+            Wraps a write of this process to the sidecar directory of an entry, such that the index doesn't consider
+            the directory changed by it, see DataIndex.wrote. If it changed otherwise as well it is rescanned.
+        """
+        location = entry.location
+        before = self.index.directory_mtimes(location) if location is not None else None
+        yield
+        if location is not None and self.index.wrote(location, before, labelled):
+            self.update_data({location[0]})
+
+    def tool_directory(self, entry):
+        """Creates the hidden directory next to the sidecar of an entry, which holds its tiles and SAM image."""
+        directory = os.path.join(os.path.dirname(entry.sidecar_path), DataIndex.DIRECTORY)
+        if not os.path.isdir(directory):
+            with self.own_write(entry):
+                os.makedirs(directory, exist_ok=True)
+
     def save_features(self, index, features):
-        """Saves features for this index."""
-        self.entries[index].save_features(features)
+        """Saves features for this index, returns the error if writing them failed, see FeatureWriter.submit."""
+        entry = self.entries[index]
+        error = self.writer.submit(entry, features)
+        entry.labelled = True
+        self.cache.discard(("features", entry.data_path))
+        self.labels.update(index, features)
+        return error
+
+    def patch_features(self, index, ops):
+        """
+            Applies operations on single features for this index, see FeatureWriter.apply. Returns the error if
+            writing them failed, see FeatureWriter.submit.
+        """
+        entry = self.entries[index]
+        features, error = self.writer.patch(entry, ops, lambda: self.load_features(entry))
+        entry.labelled = True
+        self.cache.discard(("features", entry.data_path))
+        self.labels.update(index, features)
+        return error
+
+    @staticmethod
+    def assign_ids(features):
+        """
+            Gives every feature without an id one derived from its position, such that reading the same sidecar
+            always results in the same ids. They end up on disk with the next save or patch of the entry.
+        """
+        for i, feature in enumerate(features.get("features", [])):
+            if feature.get("id") is None:
+                feature["id"] = "legacy-{}".format(i)
+
+    @staticmethod
+    def load_features(entry):
+        """Loads the features from the sidecar and applies the operations in its log, if there is one."""
+        features = entry.get_features()
+        if features is not None:
+            # Features are patched by id, so each of them needs one before the log is applied.
+            Data.assign_ids(features)
+        ops = FeatureWriter.read_log(entry.log_path)
+        if ops:
+            features = FeatureWriter.apply(features, ops)
+        return features
+
+    def features_version(self, index):
+        """
+            Returns a string that changes whenever the features of this entry change, used as their ETag. Retrieve
+            it before the features, such that a change in between results in a newer version next time.
+        """
+        entry = self.entries[index]
+        pending = self.writer.version(entry.data_path)
+        if pending is not None:
+            # Pending features are identified by the save or patch that scheduled them, in this process.
+            return "p{}-{}".format(self.started, pending)
+        versions = (Data.file_version(entry.data_path), Data.file_version(entry.log_path))
+        return "f" + "-".join("{}-{}".format(*v) if v else "0" for v in versions)
 
     def get_features(self, index):
-        """Retrieves features for this index."""
-        return self.entries[index].get_features()
+        """Retrieves features for this index, from the cache if the sidecar didn't change."""
+        entry = self.entries[index]
+        data_path = entry.data_path
+        pending, features = self.writer.get(data_path)
+        if pending:
+            return features
+        version = (Data.file_version(data_path), Data.file_version(entry.log_path))
+        if version == (None, None):
+            return None
+        features = self.cache.get(("features", data_path), version)
+        if features is None:
+            with self.metrics.span("feature_load"):
+                features = self.load_features(entry)
+            if features is None:
+                return None
+            # The size of the parsed features is approximated by their size on disk.
+            self.cache.put(("features", data_path), version, features, sum(v[1] for v in version if v))
+        return features
+
+    def warm(self, index):
+        """Reads the image and features of an entry into the cache."""
+        try:
+            entry = self.entries[index]
+            version = Data.file_version(entry.path)
+            if version is not None and not self.cache.contains(("data", entry.path), version):
+                with self.metrics.span("image_read"):
+                    data = entry.get_data()
+                self.cache.put(("data", entry.path), version, data, version[1])
+            self.get_features(index)
+            self.derivatives.warm(entry)
+        except Exception as e:
+            print("Failed to prefetch entry {}: {}".format(index, e))
+        finally:
+            with self.lock:
+                self.prefetching.discard(index)
+
+    def prefetch(self, index):
+        """Warms the cache for the entries following this index in the background."""
+        for i in range(index + 1, min(index + 1 + self.prefetch_count, len(self.entries))):
+            with self.lock:
+                if i in self.prefetching:
+                    continue
+                self.prefetching.add(i)
+            self.prefetch_pool.submit(self.warm, i)
+
+    def entry_tile_info(self, index):
+        """Returns whether the entry is served as tiles, and the dimensions of the tile pyramid."""
+        return self.tiles.info(self.entries[index])
+
+    def entry_tile(self, index, z, x, y):
+        """Returns the path of a tile of the entry."""
+        return self.tiles.tile(self.entries[index], z, x, y)
+
+    def entry_sam_image(self, index):
+        """Returns the mimetype, path and scale of the image to send to the SAM backend for this entry."""
+        entry = self.entries[index]
+        path, scale = self.derivatives.get(entry)
+        return ("image/png" if path != entry.path else entry.get_mime()), path, scale
+
+    def entry_batch(self, index, count):
+        """Returns the info, features and the version of the features of count entries starting at index, as json."""
+        parts = []
+        for i in range(index, min(index + count, len(self.entries))):
+            version = self.features_version(i)
+            parts.append('{{"entry": {}, "info": {}, "version": {}, "features": {}}}'.format(
+                i, self.entry_info(i), json.dumps(version), json.dumps(self.get_features(i))))
+        self.prefetch(index + count - 1)
+        return "[" + ", ".join(parts) + "]"
+
+def export_entry(entry, relative, output, write_masks, version):
+    """
+        Exports the features of an entry, runs in a worker process. Writes a 1 bit png for each label in the entry
+        if write_masks is set, and returns the fragment of the COCO file for this entry. The fragment is also
+        written to the export directory with the version of the sidecar as its mtime, such that a later export
+        can reuse it if the sidecar didn't change.
+    """
+    features = Data.load_features(entry)
+    with PIL.Image.open(entry.path) as img:  # only reads the header.
+        width, height = img.size
+
+    # Features are stored with the origin in the bottom left, flip them to image coordinates.
+    polygons = collections.defaultdict(list)  # label -> list of rings, the first ring of each polygon is the outside.
+    for feature in (features or {}).get("features", []):
+        geometry = feature.get("geometry") or {}
+        label = (feature.get("properties") or {}).get("label")
+        if geometry.get("type") == "Polygon":
+            parts = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            parts = geometry["coordinates"]
+        else:
+            continue
+        for rings in parts:
+            polygons[label].append([[(x, height - y) for x, y in ring] for ring in rings])
+
+    annotations = []
+    for label, label_polygons in polygons.items():
+        for rings in label_polygons:
+            outside = rings[0]
+            xs = [p[0] for p in outside]
+            ys = [p[1] for p in outside]
+            # Shoelace formula, COCO polygons only hold the outside ring.
+            area = abs(sum(xs[i] * ys[i - 1] - xs[i - 1] * ys[i] for i in range(len(outside)))) / 2.0
+            annotations.append({"label": label, "segmentation": [[v for p in outside for v in p]], "area": area,
+                                "bbox": [min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys)], "iscrowd": 0})
+
+    if write_masks:
+        mask_dir = os.path.join(output, "masks", os.path.splitext(relative)[0])
+        os.makedirs(mask_dir, exist_ok=True)
+        for label, label_polygons in polygons.items():
+            mask = PIL.Image.new("1", (width, height), 0)
+            draw = PIL.ImageDraw.Draw(mask)
+            for rings in label_polygons:
+                draw.polygon(rings[0], fill=1)
+                for hole in rings[1:]:
+                    draw.polygon(hole, fill=0)
+            mask.save(os.path.join(mask_dir, str(label).replace(os.sep, "_") + ".png"))
+
+    fragment = {"file_name": relative, "width": width, "height": height, "annotations": annotations,
+                "masks": write_masks}
+    fragment_path = DatasetExport.fragment_path(output, relative)
+    os.makedirs(os.path.dirname(fragment_path), exist_ok=True)
+    with open(fragment_path + ".tmp", "w") as f:
+        json.dump(fragment, f)
+    os.utime(fragment_path + ".tmp", ns=(version, version))
+    os.replace(fragment_path + ".tmp", fragment_path)
+    return fragment
+
+
+def summarize_features(features):
+    """Returns {label: [polygons, area]} of a feature collection, the area excludes holes."""
+    summary = {}
+    for feature in (features or {}).get("features", []):
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "Polygon":
+            parts = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            parts = geometry["coordinates"]
+        else:
+            continue
+        label = (feature.get("properties") or {}).get("label")
+        label_summary = summary.setdefault(label, [0, 0.0])
+        for rings in parts:
+            label_summary[0] += 1
+            for i, ring in enumerate(rings):
+                # Shoelace formula, holes are subtracted.
+                area = abs(sum(ring[j][0] * ring[j - 1][1] - ring[j - 1][0] * ring[j][1]
+                               for j in range(len(ring)))) / 2.0
+                label_summary[1] += area if i == 0 else -area
+    return summary
+
+
+def summarize_entries(entries):
+    """Returns the summaries of the features of a number of entries, runs in a worker process."""
+    return [summarize_features(Data.load_features(entry)) for entry in entries]
+
+
+class LabelStats:
+    """
+        Index of the labels in the sidecars; which entries hold each label, the number of polygons and their area per
+        label for each entry and which entries are unlabelled. The sidecars of labelled entries are read by a process
+        pool in the background, saved features update the index directly.
+    """
+    CHUNK = 256
+
+    def __init__(self, workers=4):
+        self.workers = max(1, workers)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.summaries = {}  # entry index -> {label: [polygons, area]}
+        self.by_label = collections.defaultdict(set)  # label -> entry indices
+        self.sorted_by_label = {}  # label -> sorted entry indices, dropped when the set changes.
+        self.totals = collections.defaultdict(lambda: [0, 0.0])  # label -> [polygons, area]
+        self.unlabelled = []  # sorted entry indices
+        self.building = 0  # entries waiting to be read.
+
+    def add_entries(self, entries, start):
+        """Adds the entries from index start onwards, the labelled ones are read in the background."""
+        labelled = []
+        with self.lock:
+            for index in range(start, len(entries)):
+                if entries[index].labelled:
+                    labelled.append((index, entries[index]))
+                else:
+                    self.unlabelled.append(index)
+            self.count = len(entries)
+            self.building += len(labelled)
+        if labelled:
+            threading.Thread(target=self.build, args=(labelled,), daemon=True).start()
+
+    def build(self, labelled):
+        chunks = [labelled[i:i + LabelStats.CHUNK] for i in range(0, len(labelled), LabelStats.CHUNK)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(summarize_entries, [entry for _, entry in chunk]): chunk for chunk in chunks}
+            for future in concurrent.futures.as_completed(futures):
+                chunk = futures[future]
+                try:
+                    summaries = future.result()
+                except Exception as e:
+                    print("Failed reading labels: {}".format(e))
+                    summaries = [{} for _ in chunk]
+                with self.lock:
+                    for (index, _), summary in zip(chunk, summaries):
+                        # Features saved in the meantime are newer than those read from the sidecar.
+                        if index not in self.summaries:
+                            self.set_locked(index, summary)
+                    self.building -= len(chunk)
+
+    def update(self, index, features):
+        """Updates the index with the features saved for an entry."""
+        summary = summarize_features(features)
+        with self.lock:
+            self.set_locked(index, summary)
+
+    def set_locked(self, index, summary):
+        for label, (polygons, area) in self.summaries.get(index, {}).items():
+            self.totals[label][0] -= polygons
+            self.totals[label][1] -= area
+            self.by_label[label].discard(index)
+            self.sorted_by_label.pop(label, None)
+        self.summaries[index] = summary
+        for label, (polygons, area) in summary.items():
+            self.totals[label][0] += polygons
+            self.totals[label][1] += area
+            self.by_label[label].add(index)
+            self.sorted_by_label.pop(label, None)
+        # Entries of which all polygons were removed count as unlabelled again.
+        position = bisect.bisect_left(self.unlabelled, index)
+        present = position < len(self.unlabelled) and self.unlabelled[position] == index
+        if summary and present:
+            del self.unlabelled[position]
+        elif not summary and not present:
+            self.unlabelled.insert(position, index)
+
+    def next_unlabelled(self, after):
+        """Returns the first unlabelled entry after this index, or None."""
+        with self.lock:
+            position = bisect.bisect_right(self.unlabelled, after)
+            return self.unlabelled[position] if position < len(self.unlabelled) else None
+
+    def entries_with_label(self, label, after=-1, count=100):
+        """Returns the number of entries with this label and up to count of them after the index."""
+        with self.lock:
+            indices = self.sorted_by_label.get(label)
+            if indices is None:
+                indices = sorted(self.by_label.get(label, ()))
+                self.sorted_by_label[label] = indices
+            position = bisect.bisect_right(indices, after)
+            return {"label": label, "total": len(indices), "entries": indices[position:position + count]}
+
+    def entry(self, index):
+        with self.lock:
+            summary = self.summaries.get(index, {})
+            return {label: {"polygons": polygons, "area": area} for label, (polygons, area) in summary.items()}
+
+    def stats(self):
+        with self.lock:
+            return {"entries": self.count, "unlabelled": len(self.unlabelled), "building": self.building,
+                    "labels": {label: {"entries": len(self.by_label[label]), "polygons": polygons, "area": area}
+                               for label, (polygons, area) in self.totals.items() if self.by_label[label]}}
+
+
+class DatasetExport:
+    """
+        Exports the labels of all entries to a COCO json file and optionally per label masks. Entries are exported
+        by a process pool, their results are streamed into the COCO file in the order of the entries. Entries whose
+        sidecar didn't change since the previous export into the same directory are not exported again.
+    """
+    DIRECTORY = ".export"
+    CATEGORIES = "categories.json"
+    ANNOTATIONS = "annotations.json"
+
+    def __init__(self, data_path, sidecar_path, output, write_coco=True, write_masks=False, workers=4, full=False,
+                 loader_threads=8):
+        self.data_path = data_path
+        self.sidecar_path = sidecar_path
+        self.output = output
+        self.write_coco = write_coco
+        self.write_masks = write_masks
+        self.workers = max(1, workers)
+        self.full = full
+        self.loader_threads = loader_threads
+
+    @staticmethod
+    def fragment_path(output, relative):
+        return os.path.join(output, DatasetExport.DIRECTORY, relative + ".json")
+
+    @staticmethod
+    def entry_version(entry):
+        """The latest mtime in ns of the sidecar and its log, None if the entry has no labels."""
+        versions = [Data.file_version(entry.data_path), Data.file_version(entry.log_path)]
+        versions = [v[0] for v in versions if v is not None]
+        return max(versions) if versions else None
+
+    def relative(self, entry):
+        relative = os.path.relpath(entry.path, self.data_path)
+        if relative.startswith(os.pardir):
+            # Entries from lists may be outside of the data directory.
+            relative = entry.path.lstrip(os.sep)
+        return relative
+
+    def load_categories(self, configs, entries):
+        """Categories of a previous export keep their id, classes from the configurations are added after those."""
+        try:
+            with open(os.path.join(self.output, DatasetExport.CATEGORIES), "r") as f:
+                categories = json.load(f)
+        except FileNotFoundError:
+            categories = []
+        known = {c["name"] for c in categories}
+        for config_id in sorted({e.config_id for e in entries}):
+            for c in configs.get(config_id).get("classes", []):
+                if c.get("label") not in known:
+                    known.add(c.get("label"))
+                    categories.append({"id": len(categories) + 1, "name": c.get("label"), "color": c.get("color")})
+        return categories
+
+    def jobs(self, entries):
+        """Yields (entry, relative, version, reuse) of the entries with labels."""
+        for entry in entries:
+            version = DatasetExport.entry_version(entry)
+            if version is None:
+                continue
+            relative = self.relative(entry)
+            reuse = False
+            if not self.full:
+                fragment_version = Data.file_version(DatasetExport.fragment_path(self.output, relative))
+                reuse = fragment_version is not None and fragment_version[0] == version
+            yield entry, relative, version, reuse
+
+    def fragments(self, pool, entries):
+        """Yields (fragment, reused) in order of the entries, at most a few entries per worker are in flight."""
+        pending = collections.deque()
+        jobs = self.jobs(entries)
+        while True:
+            while len(pending) < self.workers * 4:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                entry, relative, version, reuse = job
+                if reuse:
+                    with open(DatasetExport.fragment_path(self.output, relative), "r") as f:
+                        fragment = json.load(f)
+                    # The previous export may not have written the masks.
+                    reuse = fragment["masks"] or not self.write_masks
+                if reuse:
+                    pending.append((None, fragment))
+                else:
+                    pending.append((pool.submit(export_entry, entry, relative, self.output, self.write_masks,
+                                                version), None))
+            if not pending:
+                return
+            future, fragment = pending.popleft()
+            if future is None:
+                yield fragment, True
+            else:
+                yield future.result(), False
+
+    def run(self):
+        if PIL is None:
+            raise Exception("Exporting needs Pillow to be installed.")
+        start = time.time()
+        entries, configs = Data.data_loader(self.data_path, self.sidecar_path, {"classes": []}, self.loader_threads)
+        print("Found {} entries in {:.1f}s.".format(len(entries), time.time() - start))
+        os.makedirs(self.output, exist_ok=True)
+        categories = self.load_categories(configs, entries)
+        category_ids = {c["name"]: c["id"] for c in categories}
+
+        # Images and annotations are written to separate files as they come in, then joined into the COCO file.
+        images_path = os.path.join(self.output, ".images.part")
+        annotations_path = os.path.join(self.output, ".annotations.part")
+        exported = 0
+        reused = 0
+        annotation_count = 0
+        last_report = time.time()
+        with open(images_path, "w") as images_file, open(annotations_path, "w") as annotations_file, \
+             concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for image_id, (fragment, was_reused) in enumerate(self.fragments(pool, entries), start=1):
+                image = {"id": image_id, "file_name": fragment["file_name"], "width": fragment["width"],
+                         "height": fragment["height"]}
+                images_file.write(("," if image_id > 1 else "") + json.dumps(image))
+                for annotation in fragment["annotations"]:
+                    label = annotation.pop("label")
+                    if label not in category_ids:
+                        category_ids[label] = len(categories) + 1
+                        categories.append({"id": category_ids[label], "name": label, "color": None})
+                    annotation_count += 1
+                    annotation.update(id=annotation_count, image_id=image_id, category_id=category_ids[label])
+                    annotations_file.write(("," if annotation_count > 1 else "") + json.dumps(annotation))
+                reused += was_reused
+                exported += not was_reused
+                if time.time() - last_report > 5.0:
+                    last_report = time.time()
+                    print("Exported {}, reused {}, {:.1f} entries/s".format(exported, reused,
+                          (exported + reused) / (last_report - start)))
+
+        with open(os.path.join(self.output, DatasetExport.CATEGORIES + ".tmp"), "w") as f:
+            json.dump(categories, f)
+        os.replace(os.path.join(self.output, DatasetExport.CATEGORIES + ".tmp"),
+                   os.path.join(self.output, DatasetExport.CATEGORIES))
+        if self.write_coco:
+            coco_path = os.path.join(self.output, DatasetExport.ANNOTATIONS)
+            with open(coco_path + ".tmp", "w") as f:
+                f.write('{{"info": {{"description": {}}}, "categories": {}, "images": ['.format(
+                        json.dumps(self.data_path), json.dumps(categories)))
+                with open(images_path, "r") as part:
+                    shutil.copyfileobj(part, f)
+                f.write('], "annotations": [')
+                with open(annotations_path, "r") as part:
+                    shutil.copyfileobj(part, f)
+                f.write(']}')
+            os.replace(coco_path + ".tmp", coco_path)
+        os.remove(images_path)
+        os.remove(annotations_path)
+
+        duration = time.time() - start
+        print("Exported {} and reused {} entries with {} annotations in {:.1f}s, {:.1f} entries/s".format(
+              exported, reused, annotation_count, duration, (exported + reused) / duration))
+
+
+class Inotify:
+    """
+        Minimal inotify binding through ctypes, only available on Linux.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    DIRECTORY_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                      IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask=DIRECTORY_MASK):
+        """Adds a watch for the path, returns the watch descriptor."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """Waits up to timeout seconds for events, returns a list of (wd, mask, name) tuples."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = Inotify.EVENT_HEADER.unpack_from(data, offset)
+            offset += Inotify.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class IndexWatcher(cherrypy.process.plugins.SimplePlugin):
+    """
+        Keeps the entries of a Data object up to date with the filesystem. With inotify only the directories in
+        which something changed are scanned again, otherwise (or if the watch limit is reached) the index is
+        refreshed periodically, which only checks the mtimes of the directories.
+    """
+    def __init__(self, bus, data, interval=5.0, use_inotify=True):
+        super().__init__(bus)
+        self.data = data
+        self.interval = interval
+        self.use_inotify = use_inotify
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="IndexWatcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        if self.use_inotify:
+            try:
+                self.run_inotify()
+            except OSError as e:
+                self.bus.log("Inotify unavailable, polling the data folder instead: {}".format(e))
+        while not self.stopping.wait(self.interval):
+            self.data.update_data()
+
+    def run_inotify(self):
+        inotify = Inotify()
+        watches = {}  # path -> wd
+        relatives = {}  # wd -> relative directory.
+
+        def sync_watches():
+            wanted = {}
+            for relative in self.data.index.records:
+                wanted[os.path.normpath(os.path.join(self.data.data_path, relative))] = relative
+                wanted[os.path.normpath(os.path.join(self.data.sidecar_path, relative))] = relative
+            for path in list(watches.keys() - wanted.keys()):
+                wd = watches.pop(path)
+                relatives.pop(wd, None)
+                inotify.rm_watch(wd)
+            for path in wanted.keys() - watches.keys():
+                try:
+                    wd = inotify.add_watch(path)
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        raise  # watch limit reached, fall back to polling.
+                    continue  # sidecar directories may not exist, retry on next sync.
+                watches[path] = wd
+                relatives[wd] = wanted[path]
+
+        try:
+            sync_watches()
+            changed = set()
+            overflow = False
+            while not self.stopping.is_set():
+                events = inotify.read(timeout=min(1.0, self.interval))
+                for wd, mask, name in events:
+                    if mask & Inotify.IN_Q_OVERFLOW:
+                        overflow = True
+                    # Our own sidecar writes and the index directory don't influence the entries.
+                    if name.startswith(".") or (name.endswith(".json") and not mask & Inotify.IN_ISDIR):
+                        continue
+                    if wd in relatives:
+                        changed.add(relatives[wd])
+                # Apply changes once things settled down.
+                if not events and (changed or overflow):
+                    self.data.update_data(None if overflow else changed)
+                    sync_watches()
+                    changed = set()
+                    overflow = False
+        finally:
+            inotify.close()
+
+
+class GeometryTransport:
+    """
+        Negotiates how features travel between the server and the frontend, the sidecars stay GeoJSON. Bodies are
+        compressed with brotli or gzip if the other side accepts that. With the compact encoding the coordinates of
+        every Polygon and MultiPolygon in a json document are moved to a flat array of int32; multiplied by the
+        first of SCALES that makes them integers without losing precision and delta encoded, such that they compress
+        well. Documents of which the coordinates aren't exactly represented with any of the scales are sent as json.
+        The layout is "LTG1", the length of the json header as uint32, the header padded with spaces to a multiple
+        of 4 bytes, the ring lengths as uint32 and the coordinates as int32, all little endian. In the header an
+        encoded geometry is {"type", "c": offset in the ring lengths, "v": offset in the points}, its ring lengths
+        are the number of polygons for a MultiPolygon, then for every polygon the number of rings followed by the
+        number of points in each ring.
+    """
+    MIME = "application/x-labelling-geometry"
+    MAGIC = b"LTG1"
+    SCALES = (1, 2, 4, 8, 10, 16, 32, 64, 100, 128, 256, 512, 1000, 1024)
+    MIN_COMPRESS = 1024
+
+    @staticmethod
+    def encode(document):
+        """Returns the compact encoding of a json document, raises ValueError if the coordinates can't be encoded."""
+        counts = array.array("I")
+        values = []
+
+        def walk(node):
+            if isinstance(node, list):
+                return [walk(v) for v in node]
+            if not isinstance(node, dict):
+                return node
+            if node.get("type") in ("Polygon", "MultiPolygon") and isinstance(node.get("coordinates"), list):
+                polygons = node["coordinates"] if node["type"] == "MultiPolygon" else [node["coordinates"]]
+                geometry_counts = [len(polygons)] if node["type"] == "MultiPolygon" else []
+                geometry_values = []
+                encodable = True
+                try:
+                    for rings in polygons:
+                        geometry_counts.append(len(rings))
+                        for ring in rings:
+                            flat = list(itertools.chain.from_iterable(ring))
+                            # Only 2d geometries are encoded, others stay in the header.
+                            encodable = encodable and len(flat) == 2 * len(ring)
+                            geometry_counts.append(len(ring))
+                            geometry_values.extend(flat)
+                except TypeError:
+                    encodable = False
+                if encodable:
+                    encoded = {k: walk(v) for k, v in node.items() if k != "coordinates"}
+                    encoded.update(c=len(counts), v=len(values) // 2)
+                    counts.extend(geometry_counts)
+                    values.extend(geometry_values)
+                    return encoded
+            return {k: walk(v) for k, v in node.items()}
+
+        header = {"document": walk(document)}
+        deltas = array.array("i")
+        try:
+            for scale in GeometryTransport.SCALES:
+                # Decoding divides by the scale, which has to result in the same coordinate, stops at the first
+                # coordinate that doesn't.
+                if all(round(v * scale) / scale == v for v in values):
+                    break
+            else:
+                raise ValueError("Coordinates can't be represented exactly in the compact encoding.")
+            quantized = [round(v * scale) for v in values]
+            deltas.extend(quantized[:2])
+            deltas.extend([b - a for a, b in zip(quantized, quantized[2:])])
+        except (TypeError, OverflowError):
+            raise ValueError("Coordinates can't be represented in the compact encoding.")
+        header.update(scale=scale, counts=len(counts), values=len(deltas))
+        header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        header += b" " * (-len(header) % 4)
+        if sys.byteorder == "big":
+            counts.byteswap()
+            deltas.byteswap()
+        return GeometryTransport.MAGIC + struct.pack("<I", len(header)) + header + counts.tobytes() + deltas.tobytes()
+
+    @staticmethod
+    def decode(payload):
+        """Returns the json document of a compact encoding."""
+        if payload[:4] != GeometryTransport.MAGIC:
+            raise ValueError("Not a compact geometry encoding.")
+        length, = struct.unpack("<I", payload[4:8])
+        header = json.loads(payload[8:8 + length])
+        offset = 8 + length
+        counts = array.array("I", payload[offset:offset + 4 * header["counts"]])
+        offset += 4 * header["counts"]
+        deltas = array.array("i", payload[offset:offset + 4 * header["values"]])
+        if sys.byteorder == "big":
+            counts.byteswap()
+            deltas.byteswap()
+        scale = header["scale"]
+        xs = list(itertools.accumulate(deltas[0::2]))
+        ys = list(itertools.accumulate(deltas[1::2]))
+        if scale != 1:
+            xs = [x / scale for x in xs]
+            ys = [y / scale for y in ys]
+
+        def geometry(node):
+            c, v = node.pop("c"), node.pop("v")
+            multi = node["type"] == "MultiPolygon"
+            polygon_count = 1
+            if multi:
+                polygon_count = counts[c]
+                c += 1
+            polygons = []
+            for _ in range(polygon_count):
+                ring_count = counts[c]
+                c += 1
+                rings = []
+                for n in counts[c:c + ring_count]:
+                    rings.append([[x, y] for x, y in zip(xs[v:v + n], ys[v:v + n])])
+                    v += n
+                c += ring_count
+                polygons.append(rings)
+            node["coordinates"] = polygons if multi else polygons[0]
+            return node
+
+        def walk(node):
+            if isinstance(node, list):
+                return [walk(v) for v in node]
+            if not isinstance(node, dict):
+                return node
+            node = {k: walk(v) for k, v in node.items()}
+            if "v" in node and "coordinates" not in node and node.get("type") in ("Polygon", "MultiPolygon"):
+                return geometry(node)
+            return node
+
+        return walk(header["document"])
+
+    @staticmethod
+    def accepted_encodings():
+        return [e.split(";")[0].strip() for e in cherrypy.request.headers.get("Accept-Encoding", "").split(",")]
+
+    @staticmethod
+    def compress(body):
+        """Compresses the response body if the client accepts that, sets Content-Encoding."""
+        if len(body) < GeometryTransport.MIN_COMPRESS:
+            return body
+        encodings = GeometryTransport.accepted_encodings()
+        if "br" in encodings and brotli is not None:
+            cherrypy.response.headers["Content-Encoding"] = "br"
+            return brotli.compress(body, quality=5)
+        if "gzip" in encodings:
+            cherrypy.response.headers["Content-Encoding"] = "gzip"
+            return gzip.compress(body, compresslevel=6)
+        return body
+
+    @staticmethod
+    def respond(document):
+        """Returns the body for a json document, in the compact encoding if the client lists it in Accept."""
+        cherrypy.response.headers["Vary"] = "Accept, Accept-Encoding"
+        body = None
+        if GeometryTransport.MIME in cherrypy.request.headers.get("Accept", "") and isinstance(document, dict):
+            try:
+                body = GeometryTransport.encode(document)
+                cherrypy.response.headers["Content-Type"] = GeometryTransport.MIME
+            except ValueError:
+                body = None
+        if body is None:
+            body = json.dumps(document).encode("utf-8")
+            cherrypy.response.headers["Content-Type"] = "application/json"
+        return GeometryTransport.compress(body)
+
+    @staticmethod
+    def read_request():
+        """Returns the json document in the request body, which may be compressed or in the compact encoding."""
+        request = cherrypy.request
+        body = request.body.read()
+        encoding = request.headers.get("Content-Encoding", "identity")
+        try:
+            if encoding == "gzip":
+                body = gzip.decompress(body)
+            elif encoding == "br" and brotli is not None:
+                body = brotli.decompress(body)
+            elif encoding != "identity":
+                raise cherrypy.HTTPError(415, "Unsupported content encoding {}.".format(encoding))
+            if request.headers.get("Content-Type", "").startswith(GeometryTransport.MIME):
+                return GeometryTransport.decode(body)
+            return json.loads(body)
+        except cherrypy.HTTPError:
+            raise
+        except Exception as e:
+            # Decompression and decoding errors of the different libraries don't share a base class.
+            raise cherrypy.HTTPError(400, "Invalid request body: {}".format(e))
+
 
 class Web(object):
     """
@@ -180,47 +2052,173 @@ class Web(object):
     def __init__(self, data):
         self.data = data
 
+    @staticmethod
+    def serve_bytes(data, content_type):
+        """
+            Serves bytes from memory with support for a single Range, cherrypy.lib.static.serve_fileobj only handles
+            ranges for objects that are files on disk. Requests for multiple ranges get the whole content.
+        """
+        response = cherrypy.response
+        response.headers['Content-Type'] = content_type
+        length = len(data)
+        if cherrypy.request.protocol >= (1, 1):
+            response.headers['Accept-Ranges'] = 'bytes'
+            ranges = cherrypy.lib.httputil.get_ranges(cherrypy.request.headers.get('Range'), length)
+            if ranges == []:
+                response.headers['Content-Range'] = 'bytes */{}'.format(length)
+                raise cherrypy.HTTPError(416, "Invalid Range (first-byte-pos greater than Content-Length)")
+            if ranges is not None and len(ranges) == 1:
+                start, stop = ranges[0][0], min(ranges[0][1], length)
+                response.status = '206 Partial Content'
+                response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, length)
+                data = data[start:stop]
+        response.headers['Content-Length'] = len(data)
+        return data
+
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def info_data_extent(self):
         return self.data.data_extent()
 
     @cherrypy.expose
-    @cherrypy.tools.json_out()
     def entry_info(self, entry):
-        return self.data.entry_info(int(entry))
+        # The config is serialized once per config, so this is json already.
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        info = self.data.entry_info(int(entry))
+        # Annotators usually move on to the next entry, so read those in the background.
+        self.data.prefetch(int(entry))
+        return info.encode("utf-8")
+
+    @cherrypy.expose
+    def entry_batch(self, entry, count=4):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return self.data.entry_batch(int(entry), min(int(count), 64)).encode("utf-8")
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def entry_tile_info(self, entry):
+        return self.data.entry_tile_info(int(entry))
+
+    @cherrypy.expose
+    def entry_tile(self, entry, z, x, y):
+        path = self.data.entry_tile(int(entry), int(z), int(x), int(y))
+        if not os.path.isfile(path):
+            raise cherrypy.NotFound()
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return cherrypy.lib.static.serve_file(os.path.abspath(path), content_type="image/png")
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def info_label_stats(self):
+        return self.data.labels.stats()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def entry_label_stats(self, entry):
+        return self.data.labels.entry(int(entry))
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def entry_next_unlabelled(self, entry=-1):
+        return {"entry": self.data.labels.next_unlabelled(int(entry))}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def entries_with_label(self, label, after=-1, count=100):
+        return self.data.labels.entries_with_label(label, int(after), min(int(count), 10000))
+
+    @cherrypy.expose
+    def metrics(self):
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return self.data.metrics.render().encode("utf-8")
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def info_cache(self):
+        return dict(self.data.cache.stats(), writer=self.data.writer.stats())
 
     @cherrypy.expose
     def entry_data(self, entry):
-        mime, data = self.data.entry_data(int(entry))
-        cherrypy.response.headers['Content-Type'] = mime
-        buffer = io.BytesIO(data)
-        return cherrypy.lib.file_generator(buffer)
+        mime, path = self.data.entry_file(int(entry))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise cherrypy.NotFound()
+        # Browsers revalidate every time, which results in a 304 if the image didn't change.
+        cherrypy.response.headers['ETag'] = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        cherrypy.lib.cptools.validate_etags()
+        cached = self.data.cached_data(int(entry), (stat.st_mtime_ns, stat.st_size))
+        if cached is not None:
+            cherrypy.response.headers['Last-Modified'] = cherrypy.lib.httputil.HTTPDate(stat.st_mtime)
+            cherrypy.lib.cptools.validate_since()
+            return Web.serve_bytes(cached, mime)
+        # Streams from disk, handles Last-Modified, If-Modified-Since and Range requests.
+        return cherrypy.lib.static.serve_file(os.path.abspath(path), content_type=mime)
+
+    @cherrypy.expose
+    def entry_sam_image(self, entry):
+        """The image for the SAM backend, X-Sam-Scale holds the x and y scale from its pixels to those of the entry."""
+        mime, path, scale = self.data.entry_sam_image(int(entry))
+        cherrypy.response.headers['X-Sam-Scale'] = "{},{}".format(*scale)
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return cherrypy.lib.static.serve_file(os.path.abspath(path), content_type=mime)
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
-    @cherrypy.tools.json_in()
     def entry_save_features(self, *args, **kwargs):
-        input_json = cherrypy.request.json
+        input_json = GeometryTransport.read_request()
         entry = input_json["entry"]
         features = input_json["features"]
-        self.data.save_features(entry, features)
+        error = self.data.save_features(entry, features)
+        if error is not None:
+            raise cherrypy.HTTPError(500, "Features are held in memory but not saved: {}".format(error))
         return {}
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
+    def entry_patch_features(self, *args, **kwargs):
+        input_json = GeometryTransport.read_request()
+        try:
+            error = self.data.patch_features(int(input_json["entry"]), input_json["ops"])
+        except (KeyError, ValueError) as e:
+            raise cherrypy.HTTPError(400, "Invalid operation: {}".format(e))
+        if error is not None:
+            raise cherrypy.HTTPError(500, "Features are held in memory but not saved: {}".format(error))
+        return {}
+
+    @cherrypy.expose
     def entry_features(self, entry):
-        return self.data.get_features(int(entry))
+        # The version is the ETag, the frontend revalidates the features it prefetched with If-None-Match.
+        version = '"{}"'.format(self.data.features_version(int(entry)))
+        cherrypy.response.headers["ETag"] = version
+        if cherrypy.request.headers.get("If-None-Match") == version:
+            cherrypy.response.status = 304
+            return b""
+        return GeometryTransport.respond(self.data.get_features(int(entry)))
 
-def start_classification_server(http_port, http_host, data):
+def start_classification_server(http_port, http_host, data, watch="inotify", watch_interval=5.0, profile_slow=0.0,
+                                profile_rate=0.1, profile_dir=None):
     # set cherrypy configuration.
     cherrypy.config.update({"server.socket_port": http_port})
     cherrypy.config.update({"server.socket_host": http_host})
 
     web_root = Web(data)
+    cherrypy.tools.metrics = MetricsTool(data.metrics, web_root, profile_slow, profile_rate, profile_dir)
+
+    # Periodically write the index if it changed, and make sure it is written on shutdown.
+    cherrypy.process.plugins.Monitor(cherrypy.engine, data.index.flush, frequency=10, name="IndexFlush").subscribe()
+    cherrypy.engine.subscribe("stop", data.writer.flush)
+    cherrypy.engine.subscribe("stop", data.index.flush)
+    cherrypy.engine.subscribe("stop", data.tiles.shutdown)
+    cherrypy.engine.subscribe("stop", data.derivatives.shutdown)
+
+    if watch != "off":
+        IndexWatcher(cherrypy.engine, data, watch_interval, watch == "inotify").subscribe()
 
     cherrypy.quickstart(web_root, "/", config={
         "/": {"tools.staticdir.on": True,
+                "tools.metrics.on": True,
                 "tools.staticdir.dir": os.path.join(curdir, "static"),
                 "tools.staticdir.index": "index.html",
                 'tools.staticdir.content_types' : {
@@ -244,12 +2242,43 @@ if __name__ == "__main__":
     parser.add_argument('--dir', '-d', help="Folder which holds the to be labelled data.", type=str,
                         default=os.path.join(curdir, "label_test"))
     parser.add_argument('--sidecar', '-s', help="Folder where the sidecar files and label information is present, defaults to '--dir'.", default=None)
+    parser.add_argument('--no-index', help="Don't store the index of the data folder in the sidecar folder.", action="store_true", default=False)
+    parser.add_argument('--watch', help="How to watch the data folder for changes, defaults to %(default)s.", choices=["inotify", "poll", "off"], default="inotify")
+    parser.add_argument('--watch-interval', help="Seconds between polls of the data folder, defaults to %(default)s.", type=float, default=5.0)
+    parser.add_argument('--cache-size', help="Size in MiB of the cache for images and features, defaults to %(default)s.", type=int, default=256)
+    parser.add_argument('--prefetch', help="Number of following entries to read into the cache, defaults to %(default)s.", type=int, default=3)
+    parser.add_argument('--tile-threshold', help="Images larger than this many pixels in width or height are served as tiles, 0 disables tiles, defaults to %(default)s.", type=int, default=4096)
+    parser.add_argument('--tile-workers', help="Number of processes creating tiles, defaults to %(default)s.", type=int, default=2)
+    parser.add_argument('--sam-size', help="Longest side of the images sent to the SAM backend, larger images are downscaled in the background, 0 sends the original images, defaults to %(default)s.", type=int, default=1024)
+    parser.add_argument('--sam-workers', help="Number of processes downscaling images for the SAM backend, defaults to %(default)s.", type=int, default=2)
+    parser.add_argument('--save-delay', help="Maximum number of seconds saved labels are held in memory before they are written, 0 writes immediately, defaults to %(default)s.", type=float, default=1.0)
+    parser.add_argument('--stats-workers', help="Number of processes reading the sidecars for the label statistics, defaults to %(default)s.", type=int, default=4)
+    parser.add_argument('--profile-slow', help="Write a cProfile profile of requests that take longer than this many seconds, 0 disables profiling, defaults to %(default)s.", type=float, default=0.0)
+    parser.add_argument('--profile-rate', help="Fraction of the requests that is profiled if --profile-slow is set, defaults to %(default)s.", type=float, default=0.1)
+    parser.add_argument('--profile-dir', help="Folder the profiles of slow requests are written to, defaults to a folder in the temporary directory.", default=None)
+    parser.add_argument('--loader-threads', help="Number of threads used to scan the data folder, defaults to %(default)s.", type=int, default=8)
+
+    subparsers = parser.add_subparsers(dest="command")
+    export_parser = subparsers.add_parser('export', help="Export the labels instead of starting the server.")
+    export_parser.add_argument('output', help="Folder to write the export to, a previous export in it is updated.")
+    export_parser.add_argument('--format', help="What to export, defaults to %(default)s.", choices=["coco", "masks", "both"], default="coco")
+    export_parser.add_argument('--workers', help="Number of processes exporting entries, defaults to %(default)s.", type=int, default=os.cpu_count())
+    export_parser.add_argument('--full', help="Export all entries, also those that didn't change since the previous export.", action="store_true", default=False)
 
     args = parser.parse_args()
-    print("Traversing data folder in search of data.")
     data_dir = args.dir
     sidecar_dir = args.dir if args.sidecar is None else args.sidecar
-    data = Data(args.dir, sidecar_dir)
+
+    if args.command == "export":
+        DatasetExport(data_dir, sidecar_dir, args.output, args.format in ("coco", "both"),
+                      args.format in ("masks", "both"), args.workers, args.full, args.loader_threads).run()
+        sys.exit(0)
+
+    print("Traversing data folder in search of data.")
+    data = Data(args.dir, sidecar_dir, args.loader_threads, not args.no_index, args.cache_size * 2**20, args.prefetch,
+                tile_threshold=args.tile_threshold, tile_workers=args.tile_workers, save_delay=args.save_delay,
+                stats_workers=args.stats_workers, sam_size=args.sam_size, sam_workers=args.sam_workers)
     print("Found {} entries.".format(len(data.entries)))
    
-    start_classification_server(args.port, args.host, data)
+    start_classification_server(args.port, args.host, data, args.watch, args.watch_interval, args.profile_slow,
+                                args.profile_rate, args.profile_dir)
@@ -34,10 +34,11 @@ let sam_backend_url  = () => {
 /**
  * @brief init function that registers all callbacks and initialises state variables.
  */
-Control.prototype.init = function(static_layer, edit_layer, sam_mask_layer,sam_vector_layer, map, edit_bar, projection, undo_interaction)
+Control.prototype.init = function(static_layer, edit_layer, sam_mask_layer,sam_vector_layer, map, edit_bar, projection, undo_interaction, tile_layer)
 {
   var self = this;
   this.static_layer = static_layer;
+  this.tile_layer = tile_layer;
   this.edit_layer = edit_layer;
   this.sam_mask_layer = sam_mask_layer;
   this.sam_vector_layer = sam_vector_layer;
@@ -70,15 +71,21 @@ Control.prototype.init = function(static_layer, edit_layer, sam_mask_layer,sam_v
   self.entry_current_label = "unknown";  // the current label we'll add.
   self.entry_labels = {};    // holds all labels that we know for this entry.
   self.entry_features = new Set([]);  // always holds the current features.
+  self.entry_feature_snapshot = new Map();  // feature id to GeoJSON string, as last known by the backend.
 
   self.sam_point_features = new Set([]);
   self.sam_contours = [];
 
+  self.entry_batch_cache = {};  // info and features of upcoming entries, by backend entry index.
+  self.prefetch_count = 3;
+
   // Retrieve the max entry index from the backend.
   $.getJSON("info_data_extent", function( data ) {
     self.info_data_extent = data;
     self.updateInfoBox();
     self.setEntry(1);
+    // Keep polling, the backend may find new entries or configuration changes.
+    setInterval(function() { self.pollDataExtent(); }, 5000);
   });
 
   // Default the sam backend to false;
@@ -88,6 +95,10 @@ Control.prototype.init = function(static_layer, edit_layer, sam_mask_layer,sam_v
   $.getJSON(sam_backend_url() + "present", function( data ) {
     console.log("Found sam backend, setting it to true.");
     self.sam_backend = true;
+    // Backends that map points and contours with a scale get the image downscaled to the size of their encoder.
+    self.sam_scale = (data.scale === true);
+    // Backends without sam_image get the image with every sam_trigger.
+    self.sam_image_hashes = (data.image_hash === true);
     $("#sam_control").removeClass("gone");
     //  self.samTrigger();
   });
@@ -105,6 +116,12 @@ Control.prototype.init = function(static_layer, edit_layer, sam_mask_layer,sam_v
     event.preventDefault();
   });
 
+  $("#info_next_unlabelled").click(function (event)
+  {
+    self.nextUnlabelledClick();
+    event.preventDefault();
+  });
+
   // Bind sam trigger
   $("#sam_convert").click(function (event)
   {
@@ -394,6 +411,31 @@ Control.prototype.updateInfoBox = function()
   $("#info_entry_count").text(self.info_data_extent.entries);
 };
 
+/**
+ * @brief Poll the data extent, if the generation of the index changed update the entry count and labels.
+ */
+Control.prototype.pollDataExtent = function()
+{
+  var self = this;
+  $.getJSON("info_data_extent", function( data ) {
+    if (data.generation == self.info_data_extent.generation)
+    {
+      return;
+    }
+    self.info_data_extent = data;
+    self.entry_batch_cache = {};
+    $("#info_entry_current").attr({"max" : data.entries});
+    $("#info_entry_count").text(data.entries);
+
+    // The configuration of the current entry may have changed.
+    $.getJSON( "entry_info", {entry:self.getEntry()}, function( info ) {
+      self.entry_info = info;
+      self.updateAvailableLabels();
+      self.updateLayers();
+    });
+  });
+};
+
 //! Advance the current entry index.
 Control.prototype.nextClick = function()
 {
@@ -409,6 +451,20 @@ Control.prototype.prevClick = function()
   self.setEntry(self.current - 1);
 };
 
+//! Advance to the next entry that has no labels yet.
+Control.prototype.nextUnlabelledClick = function()
+{
+  var self = this;
+  $.getJSON( "entry_next_unlabelled", {entry:self.getEntry()}, function( data ) {
+    if (data.entry === null)
+    {
+      console.log("No unlabelled entries after this one.");
+      return;
+    }
+    self.setEntry(data.entry + 1);
+  });
+};
+
 Control.prototype.haveSam = function()
 {
   return this.sam_backend;
@@ -441,30 +497,75 @@ Control.prototype.setEntry = function (entry)
   // Update the html value.
   $("#info_entry_current").val(this.current);
 
-  // grab entry info from the backend
+  // Use the prefetched entry if we have it, else grab entry info from the backend
+  let batched = self.entry_batch_cache[self.getEntry()];
+  if (batched !== undefined)
+  {
+    delete self.entry_batch_cache[self.getEntry()];
+    self.showEntry(batched.info, batched);
+    return;
+  }
   $.getJSON( "entry_info", {entry:self.getEntry()}, function( data ) {
-    console.log("entry_info:", data)
-    self.entry_info = data;
-    self.entry_image_url = "entry_data?entry=" + (self.getEntry());
+    self.showEntry(data, undefined);
+  });
 
-    $("#entry_filename").text(self.entry_info.path);
+}
 
-    // update the image.
-    self.setStaticImage(self.entry_image_url);
+/**
+ * @brief Show an entry, the features are retrieved from the backend unless the prefetched ones are still current.
+ */
+Control.prototype.showEntry = function (data, batched)
+{
+  var self = this;
+  console.log("entry_info:", data)
+  self.entry_info = data;
+  self.entry_image_url = "entry_data?entry=" + (self.getEntry());
 
-    // Update the label handler.
-    self.updateAvailableLabels();
+  $("#entry_filename").text(self.entry_info.path);
 
+  // update the image.
+  self.setImage(self.entry_image_url);
 
-    // Trigger sam if we have that.
-    //  self.samTrigger();
-    // Clear the sam layer.
-    self.samClear();
+  // Update the label handler.
+  self.updateAvailableLabels();
 
-    // Load the features from the server.
-    self.loadFeatures();
-  });
 
+  // Trigger sam if we have that.
+  //  self.samTrigger();
+  // Clear the sam layer.
+  self.samClear();
+
+  // Load the features from the server.
+  self.loadFeatures(batched);
+
+  self.prefetchEntries();
+}
+
+/**
+ * @brief Retrieve the info and features of the next entries in one request, and let the browser load their images.
+ */
+Control.prototype.prefetchEntries = function ()
+{
+  var self = this;
+  let first = self.getEntry() + 1;
+  let count = 0;
+  while ((count < self.prefetch_count) && (first + count < self.info_data_extent.entries)
+         && (self.entry_batch_cache[first + count] === undefined))
+  {
+    count++;
+  }
+  if (count == 0)
+  {
+    return;
+  }
+  $.getJSON("entry_batch", {entry: first, count: count}, function( data ) {
+    for (let batched of data)
+    {
+      self.entry_batch_cache[batched.entry] = batched;
+      var img = new Image();
+      img.src = "entry_data?entry=" + batched.entry;
+    }
+  });
 }
 
 Control.prototype.setStaticSource = function (url, width, height)
@@ -483,9 +584,77 @@ Control.prototype.setStaticSource = function (url, width, height)
     attributions: layer_attributions,
     interpolate: this.image_interpolation,
   }));
+  self.tile_layer.setSource(null);
+  $("#filter_msg").text("");
+}
+
+/**
+ * @brief Show the current entry from its tile pyramid.
+ */
+Control.prototype.setTiledSource = function (tile_info)
+{
+  var self = this;
+  let width = tile_info.width;
+  let height = tile_info.height;
+  self.projection.setExtent([0, 0, width, height]);
+  var layer_attributions = undefined;
+  if (self.entry_info["config"]["attributions"])
+  {
+    layer_attributions = self.entry_info["config"]["attributions"];
+  }
+
+  // Level 0 fits in a single tile, the last level is the full resolution.
+  let resolutions = [];
+  for (let z = 0; z < tile_info.levels; z++)
+  {
+    resolutions.push(Math.pow(2, tile_info.levels - 1 - z));
+  }
+  let entry = self.getEntry();
+  self.tile_layer.setSource(new ol.source.TileImage({
+    projection: self.projection,
+    tileGrid: new ol.tilegrid.TileGrid({
+      extent: [0, 0, width, height],
+      origin: [0, height],
+      resolutions: resolutions,
+      tileSize: tile_info.tile_size,
+    }),
+    tileUrlFunction: function (tile_coord) {
+      return "entry_tile?entry=" + entry + "&z=" + tile_coord[0] + "&x=" + tile_coord[1] + "&y=" + tile_coord[2];
+    },
+    attributions: layer_attributions,
+    interpolate: self.image_interpolation,
+  }));
+  self.static_layer.setSource(new Static({
+    url: EMPTY_LAYER,
+    projection: self.projection,
+    imageExtent: [0, 0, width, height],
+  }));
   $("#filter_msg").text("");
 }
 
+/**
+ * @brief Show the current entry, large images are shown from tiles, others as a static image.
+ */
+Control.prototype.setImage = function(img_path)
+{
+  var self = this;
+  let entry = self.getEntry();
+  $.getJSON("entry_tile_info", {entry: entry}, function( tile_info ) {
+    if (entry != self.getEntry())
+    {
+      return;  // moved to another entry in the meantime.
+    }
+    if (tile_info.tiled)
+    {
+      self.setTiledSource(tile_info);
+    }
+    else
+    {
+      self.setStaticImage(img_path);
+    }
+  });
+};
+
 
 /**
  * @brief Retrieve a static image and set the layer.
@@ -872,41 +1041,131 @@ Control.prototype.layerStyleFunction = function(feature, view_res)
 }
 
 /**
- * @brief Load features from the backend.
+ * @brief Load features from the backend, the prefetched features of a batched entry are used if still current.
  */
-Control.prototype.loadFeatures = function ()
+Control.prototype.loadFeatures = function (batched)
 {
   var self = this;
   self.entry_features = new Set([]);  // clear currently known features
-
-  // Request new features from the server.
-  $.getJSON( "entry_features", {entry: self.getEntry()}, function( data ) {
-    if (data != undefined)
-    {
-      self.entry_features = new Set((new ol.format.GeoJSON()).readFeatures(data));
+  self.entry_feature_snapshot = new Map();
+
+  // Request new features from the server, preferably in the compact encoding. Prefetched features may have been
+  // changed by another client or on disk since, the server responds with 304 if their version is still current.
+  let entry = self.getEntry();
+  let headers = {"accept": GEOMETRY_MIME + ", application/json"};
+  if (batched !== undefined) {
+    headers["if-none-match"] = '"' + batched.version + '"';
+  }
+  fetch("entry_features?entry=" + entry, {headers: headers}).then(
+    response => {
+      if (response.status == 304) {
+        return batched.features;
+      }
+      if ((response.headers.get("content-type") || "").startsWith(GEOMETRY_MIME)) {
+        return response.arrayBuffer().then(readGeometryFeatures);
+      }
+      return response.json();
+    }
+  ).then(data => {
+    if (entry == self.getEntry()) {
+      self.setFeatures(data);
     }
-    self.updateLayers();
   });
 }
 
 /**
- * @brief Save features to the backend.
+ * @brief Set the features of the current entry from a GeoJSON object, or from an array of features.
  */
-Control.prototype.saveFeatures = function (event)
+Control.prototype.setFeatures = function (data)
+{
+  var self = this;
+  self.entry_features = new Set([]);
+  if (Array.isArray(data))
+  {
+    self.entry_features = new Set(data);
+  }
+  else if (data != undefined)
+  {
+    self.entry_features = new Set((new ol.format.GeoJSON()).readFeatures(data));
+  }
+  self.entry_feature_snapshot = self.snapshotFeatures();
+  self.updateLayers();
+}
+
+/**
+ * @brief Returns a unique id for a new feature.
+ */
+let newFeatureId = function()
+{
+  return Date.now().toString(36) + Math.random().toString(36).substring(2, 12);
+};
+
+/**
+ * @brief Returns a map of feature id to the GeoJSON string of the current features, assigns ids where missing.
+ */
+Control.prototype.snapshotFeatures = function ()
 {
   var self = this;
-  // Post all the features to the server!
   var writer = new ol.format.GeoJSON();
-  var geojson_str = writer.writeFeaturesObject(Array.from(self.entry_features), {rightHanded:true});
-  $.ajax({
-    type: "POST",
-    url: "entry_save_features",
-    data: JSON.stringify({entry: self.getEntry(), features:geojson_str}),
-    dataType: 'JSON',
-    contentType: 'application/json',
-  }).fail(function() {
+  let snapshot = new Map();
+  for (let feature of self.entry_features)
+  {
+    if (feature.getId() === undefined)
+    {
+      feature.setId(newFeatureId());
+    }
+    snapshot.set(feature.getId(), JSON.stringify(writer.writeFeatureObject(feature, {rightHanded:true})));
+  }
+  return snapshot;
+};
+
+/**
+ * @brief Save features to the backend, only the features that changed since the last successful save are sent.
+ */
+Control.prototype.saveFeatures = function (event)
+{
+  var self = this;
+  let snapshot = self.snapshotFeatures();
+  let ops = [];
+  for (let [id, feature_str] of snapshot)
+  {
+    let previous = self.entry_feature_snapshot.get(id);
+    if (previous === undefined)
+    {
+      ops.push({op: "add", feature: JSON.parse(feature_str)});
+    }
+    else if (previous !== feature_str)
+    {
+      ops.push({op: "modify", feature: JSON.parse(feature_str)});
+    }
+  }
+  for (let id of self.entry_feature_snapshot.keys())
+  {
+    if (!snapshot.has(id))
+    {
+      ops.push({op: "delete", id: id});
+    }
+  }
+  if (ops.length == 0)
+  {
+    return;
+  }
+  // The snapshot only advances once the server has the operations, until then later saves send them again. That
+  // is harmless, as operations are stored by feature id.
+  let entry = self.getEntry();
+  delete self.entry_batch_cache[entry];
+  encodeRequestBody({entry: entry, ops: ops}).then(request => {
+    return fetch("entry_patch_features", {method: "POST", body: request.body, headers: request.headers});
+  }).then(response => {
+    if (!response.ok) {
+      throw new Error("Server responded with " + response.status);
+    }
+    if (entry == self.getEntry()) {
+      self.entry_feature_snapshot = snapshot;
+    }
+  }).catch(function() {
     alert( "Failed to submit data to the server, closing page will lose changes." );
-  })
+  });
 };
 
 /**
@@ -1044,6 +1303,273 @@ function arrayBufferToBase64( buffer ) {
     return window.btoa( binary );
 }
 
+/**
+ * The compact geometry encoding of the server, see GeometryTransport in server.py. Polygon and MultiPolygon
+ * coordinates are moved out of the json document into delta encoded int32, multiplied by a scale that makes them
+ * integers without losing precision.
+ */
+const GEOMETRY_MIME = "application/x-labelling-geometry";
+const GEOMETRY_SCALES = [1, 2, 4, 8, 10, 16, 32, 64, 100, 128, 256, 512, 1000, 1024];
+
+/**
+ * @brief Returns the compact encoding of a json document as an ArrayBuffer, or null if the coordinates can't be
+ *        represented exactly, in which case the document should be sent as json.
+ */
+function encodeGeometryDocument(document)
+{
+  let counts = [];
+  let values = [];
+  let walk = function(node) {
+    if (Array.isArray(node)) {
+      return node.map(walk);
+    }
+    if ((node === null) || (typeof node !== "object")) {
+      return node;
+    }
+    if (((node.type === "Polygon") || (node.type === "MultiPolygon")) && Array.isArray(node.coordinates)) {
+      let polygons = (node.type === "MultiPolygon") ? node.coordinates : [node.coordinates];
+      // Only 2d geometries are encoded, others stay in the header.
+      if (polygons.every(rings => rings.every(ring => ring.every(p => p.length == 2)))) {
+        let encoded = {};
+        for (let key in node) {
+          if (key !== "coordinates") {
+            encoded[key] = walk(node[key]);
+          }
+        }
+        encoded.c = counts.length;
+        encoded.v = values.length / 2;
+        if (node.type === "MultiPolygon") {
+          counts.push(polygons.length);
+        }
+        for (let rings of polygons) {
+          counts.push(rings.length);
+          for (let ring of rings) {
+            counts.push(ring.length);
+            for (let p of ring) {
+              values.push(p[0], p[1]);
+            }
+          }
+        }
+        return encoded;
+      }
+    }
+    let result = {};
+    for (let key in node) {
+      result[key] = walk(node[key]);
+    }
+    return result;
+  };
+  let header = {document: walk(document)};
+  // Decoding divides by the scale, which has to result in the same coordinate.
+  let scale = GEOMETRY_SCALES.find(s => values.every(v => Math.round(v * s) / s === v));
+  if (scale === undefined) {
+    return null;
+  }
+  let deltas = new Int32Array(values.length);
+  let previous = [0, 0];
+  for (let i = 0; i < values.length; i++) {
+    let q = Math.round(values[i] * scale);
+    if (Math.abs(q) >= 2 ** 30) {
+      return null;  // deltas could overflow.
+    }
+    deltas[i] = q - previous[i % 2];
+    previous[i % 2] = q;
+  }
+  header.scale = scale;
+  header.counts = counts.length;
+  header.values = deltas.length;
+  let header_bytes = new TextEncoder().encode(JSON.stringify(header));
+  let header_length = Math.ceil(header_bytes.length / 4) * 4;
+  let buffer = new ArrayBuffer(8 + header_length + 4 * counts.length + 4 * deltas.length);
+  let bytes = new Uint8Array(buffer);
+  bytes.set(new TextEncoder().encode("LTG1"), 0);
+  new DataView(buffer).setUint32(4, header_length, true);
+  bytes.fill(32, 8, 8 + header_length);  // pad with spaces.
+  bytes.set(header_bytes, 8);
+  new Uint32Array(buffer, 8 + header_length, counts.length).set(counts);
+  new Int32Array(buffer, 8 + header_length + 4 * counts.length, deltas.length).set(deltas);
+  return buffer;
+}
+
+/**
+ * @brief Decodes the compact encoding, geometry(type, flat_coordinates, counts, c) is called for every encoded
+ *        geometry, its result replaces the geometry in the returned document.
+ */
+function decodeGeometryDocument(buffer, geometry)
+{
+  if (new TextDecoder().decode(new Uint8Array(buffer, 0, 4)) !== "LTG1") {
+    throw new Error("Not a compact geometry encoding.");
+  }
+  let header_length = new DataView(buffer).getUint32(4, true);
+  let header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, header_length)));
+  let counts = new Uint32Array(buffer, 8 + header_length, header.counts);
+  let deltas = new Int32Array(buffer, 8 + header_length + 4 * header.counts, header.values);
+  let values = new Float64Array(deltas.length);
+  let x = 0;
+  let y = 0;
+  for (let i = 0; i < deltas.length; i += 2) {
+    x += deltas[i];
+    y += deltas[i + 1];
+    values[i] = x / header.scale;
+    values[i + 1] = y / header.scale;
+  }
+  let walk = function(node) {
+    if (Array.isArray(node)) {
+      return node.map(walk);
+    }
+    if ((node === null) || (typeof node !== "object")) {
+      return node;
+    }
+    if ((node.v !== undefined) && (node.coordinates === undefined) &&
+        ((node.type === "Polygon") || (node.type === "MultiPolygon"))) {
+      return geometry(node.type, values.subarray(2 * node.v), counts, node.c);
+    }
+    let result = {};
+    for (let key in node) {
+      result[key] = walk(node[key]);
+    }
+    return result;
+  };
+  return walk(header.document);
+}
+
+/**
+ * @brief Decodes a feature collection in the compact encoding straight into OpenLayers features, the encoded
+ *        geometries are created from their flat coordinates.
+ */
+function readGeometryFeatures(buffer)
+{
+  let geometry = function(type, flat, counts, c) {
+    let polygon_count = 1;
+    if (type === "MultiPolygon") {
+      polygon_count = counts[c++];
+    }
+    let endss = [];
+    let end = 0;
+    for (let p = 0; p < polygon_count; p++) {
+      let ends = [];
+      let ring_count = counts[c++];
+      for (let r = 0; r < ring_count; r++) {
+        end += 2 * counts[c++];
+        ends.push(end);
+      }
+      endss.push(ends);
+    }
+    let coordinates = Array.from(flat.subarray(0, end));
+    if (type === "MultiPolygon") {
+      return new ol.geom.MultiPolygon(coordinates, "XY", endss);
+    }
+    return new ol.geom.Polygon(coordinates, "XY", endss[0]);
+  };
+  let collection = decodeGeometryDocument(buffer, geometry);
+  if (collection === null) {
+    return undefined;
+  }
+  let format = new ol.format.GeoJSON();
+  return collection.features.map(f => {
+    let feature = new ol.Feature(f.properties || {});
+    if (f.id !== undefined) {
+      feature.setId(f.id);
+    }
+    if (f.geometry instanceof ol.geom.Geometry) {
+      feature.setGeometry(f.geometry);
+    } else if (f.geometry) {
+      feature.setGeometry(format.readGeometry(f.geometry));
+    }
+    return feature;
+  });
+}
+
+/**
+ * @brief Returns the body and headers to post a json document with, in the compact encoding if possible and
+ *        compressed with gzip if the browser supports that, as a promise.
+ */
+function encodeRequestBody(document)
+{
+  let body = encodeGeometryDocument(document);
+  let headers = {"content-type": GEOMETRY_MIME};
+  if (body === null) {
+    body = new TextEncoder().encode(JSON.stringify(document));
+    headers["content-type"] = "application/json";
+  }
+  if ((typeof CompressionStream === "undefined") || (body.byteLength < 1024)) {
+    return Promise.resolve({body: body, headers: headers});
+  }
+  let stream = new Blob([body]).stream().pipeThrough(new CompressionStream("gzip"));
+  return new Response(stream).arrayBuffer().then(compressed => {
+    headers["content-encoding"] = "gzip";
+    return {body: compressed, headers: headers};
+  });
+}
+
+/**
+ * @brief Renders a COCO style run length encoded mask (column major, starting with zeros) to the data url of an
+ *        image that is white inside the mask and transparent outside of it.
+ */
+function rleMaskToDataUrl(mask)
+{
+  let height = mask.size[0];
+  let width = mask.size[1];
+  let canvas = document.createElement("canvas");
+  canvas.width = width;
+  canvas.height = height;
+  let context = canvas.getContext("2d");
+  let image_data = context.createImageData(width, height);
+  let data = image_data.data;
+  let index = 0;
+  for (let i = 0; i < mask.counts.length; i++) {
+    let count = mask.counts[i];
+    if (i % 2 == 1) {
+      for (let j = index; j < index + count; j++) {
+        let x = Math.floor(j / height);
+        let y = j - x * height;
+        data.fill(255, (y * width + x) * 4, (y * width + x) * 4 + 4);
+      }
+    }
+    index += count;
+  }
+  context.putImageData(image_data, 0, 0);
+  return canvas.toDataURL();
+}
+
+/**
+ * @brief Registers the image with the SAM backend, returns a promise for its hash. Only uploads if needed. The scale
+ *        of a downscaled image is kept in sam_image_scale. For backends without sam_image the promise resolves to
+ *        undefined and the image is kept in sam_image_data, to be sent with the points.
+ */
+Control.prototype.samRegisterImage = function(image_url)
+{
+  var self = this;
+  if ((self.sam_image_url === image_url) &&
+      ((self.sam_image_hash !== undefined) || (self.sam_image_data !== undefined))) {
+    return Promise.resolve(self.sam_image_hash);
+  }
+  let scale = undefined;
+  return fetch(image_url).then(response => {
+    let header = response.headers.get("X-Sam-Scale");
+    if (header !== null) {
+      scale = header.split(",").map(parseFloat);
+    }
+    return response.arrayBuffer();
+  }).then(buf => {
+    let image = arrayBufferToBase64(buf);
+    if (!self.sam_image_hashes) {
+      return {image: image};
+    }
+    return fetch(sam_backend_url() + "sam_image", {
+        method : "POST",
+        body : JSON.stringify({image: image}),
+        headers: new Headers({'content-type': 'application/json'}),
+    }).then(response => response.json());
+  }).then(d => {
+    self.sam_image_url = image_url;
+    self.sam_image_hash = d.image_hash;
+    self.sam_image_data = d.image;
+    self.sam_image_scale = scale;
+    return d.image_hash;
+  });
+};
+
 Control.prototype.samTrigger = function()
 {
   var self = this;
@@ -1055,56 +1581,108 @@ Control.prototype.samTrigger = function()
     console.log("Can't trigger sam, no image url.");
     return;
   }
-  let img_width = self.projection.getExtent()[2];
   let img_height = self.projection.getExtent()[3];
-  fetch(self.entry_image_url).then(response => response.arrayBuffer()).then(buf => {
-    //  console.log("buf:", buf);
-    let image_bytes = arrayBufferToBase64(buf);
-    let z = [];
-    // Collect the points of the currently selected category.
-    for (let f of self.sam_point_features) {
-      //  console.log(f);
-      let geom = f.getGeometry();
-      if (f.getGeometry() instanceof ol.geom.Point) {
-        let p = geom.getFirstCoordinate();
-        //  let label_type = f.getProperties()["label"];
-        //  if (label_type != self.entry_current_label) {
-          //  continue;
-        //  }
-        let category = "Include";
-        if (f.get("sam_negative")) {
-          category = "Exclude";
-        }
-
-        //  let nx = p[0] / img_width;
-        //  let ny = 1.0 - (p[1] / img_height);
-        let nx = p[0];
-        let ny = img_height - p[1];
-        z.push({"x": nx, "y": ny, "category": category});
+  let z = [];
+  // Collect the points of the currently selected category.
+  for (let f of self.sam_point_features) {
+    let geom = f.getGeometry();
+    if (f.getGeometry() instanceof ol.geom.Point) {
+      let p = geom.getFirstCoordinate();
+      let category = "Include";
+      if (f.get("sam_negative")) {
+        category = "Exclude";
       }
+      let nx = p[0];
+      let ny = img_height - p[1];
+      z.push({"x": nx, "y": ny, "category": category});
     }
+  }
+
+  // The backend drops older requests of the same client when a newer one arrives, responses to an older request
+  // are ignored as well.
+  if (self.sam_client === undefined) {
+    self.sam_client = Math.random().toString(36).slice(2);
+    self.sam_request = 0;
+  }
+  self.sam_request += 1;
+  let request = self.sam_request;
+
+  // The image is registered with the backend once, after that only its hash is sent with the points. The server
+  // downscales large images to the size of the encoder, points and contours stay in pixels of the original.
+  let image_url = self.sam_scale ? "entry_sam_image?entry=" + self.getEntry() : self.entry_image_url;
+
+  // The backend keeps the points and the previous mask of this image, if points were only added, only send the new
+  // ones to refine the previous mask. Otherwise, send all points to start over.
+  let session = self.sam_session;
+  let refine = self.sam_refine && (session !== undefined) && (session.image_url === image_url) &&
+               (session.points.length > 0) &&
+               (z.length > session.points.length) &&
+               session.points.every((p, i) => JSON.stringify(p) === JSON.stringify(z[i]));
+  let new_points = refine ? z.slice(session.points.length) : z;
+  self.sam_session = {image_url: image_url, points: z};
+
+  let trigger = (image_hash, retry, points, refine) => {
     fetch(sam_backend_url() + "sam_trigger", {
         method : "POST",
         body : JSON.stringify({
-            points: z,
-            image: image_bytes,
+            points: points,
+            refine: refine,
+            image_hash: image_hash,
+            image: (image_hash === undefined) ? self.sam_image_data : undefined,
             threshold: self.sam_threshold,
+            client: self.sam_client,
+            mask_format: "rle",
+            scale: self.sam_image_scale,
         }),
         headers: new Headers({'content-type': 'application/json'}),
     }).then(
-        response => response.json()
+        response => {
+          if (!response.ok) {
+            // The backend is busy (429), the next change of the points triggers it again with all points.
+            console.log("Sam backend responded with " + response.status);
+            self.sam_session = undefined;
+            return {stale: true};
+          }
+          return response.json();
+        }
     ).then(d => {
-        let img_payload = "data:image/png;base64,"+d.image;
-        if (d.image.length == 0) {
+        if (d.stale || request !== self.sam_request) {
+          return;
+        }
+        if (d.need_image) {
+          // Backend doesn't have the image (anymore), register it again.
+          if (self.sam_image_url === image_url) {
+            self.sam_image_url = undefined;
+          }
+          if (retry) {
+            self.samRegisterImage(image_url).then(h => trigger(h, false, z, false));
+          }
+          return;
+        }
+        if (d.need_reset) {
+          // Backend no longer has the previous points, send all of them.
+          if (retry) {
+            trigger(image_hash, false, z, false);
+          }
+          return;
+        }
+        // Only backends that support mask_format keep the previous points.
+        self.sam_refine = (d.mask_format !== undefined);
+        let img_payload = EMPTY_LAYER;
+        if (d.mask) {
+          img_payload = rleMaskToDataUrl(d.mask);
+        } else if (d.image) {
+          // Backends that don't support mask_format return a png.
+          img_payload = "data:image/png;base64," + d.image;
+        } else {
           console.log("Setting empty layer");
-          img_payload = EMPTY_LAYER;
         }
-        //  console.log(img_payload);
         self.setSamImage(img_payload);
         if (d.contours !== undefined) {
           self.setSamContours(d.contours);
         }
     });
-  });
+  };
+  self.samRegisterImage(image_url).then(h => trigger(h, true, new_points, refine));
 
 }